@@ -0,0 +1,406 @@
+"""Load test for the support chat pipeline.
+
+Drives create_session and accept_conversation through Django's AsyncClient,
+then opens a visitor and an agent ConversationConsumer socket per
+conversation with Channels' WebsocketCommunicator and has every visitor send
+messages concurrently. Reports throughput, end-to-end delivery latency
+(visitor send -> agent socket receive), DB queries per operation and memory
+per connection, and can compare the run against an earlier result file.
+
+    python -m benchmarks.run --conversations 200 --messages 50 --output after.json
+    python -m benchmarks.run --output after.json --compare before.json
+
+Pass --redis redis://127.0.0.1:6379/0 to use channels_redis and a Redis cache
+instead of the in-memory layer, or --settings to run against your own
+project settings (database included).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from importlib import metadata
+
+DEFAULT_SETTINGS = 'benchmarks.settings'
+
+
+class QueryCounter:
+    """Counts SQL statements on every connection, whichever thread runs them."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        connection_created.connect(self._connection_created, weak=False)
+        for connection in connections.all(initialized_only=True):
+            self._attach(connection)
+
+    def _connection_created(self, sender, connection, **kwargs):
+        self._attach(connection)
+
+    def _attach(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed, operations, queries):
+    """Turn raw latencies (seconds) into the numbers stored in the result file."""
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'operations': operations,
+        'elapsed_s': round(elapsed, 4),
+        'ops_per_sec': round(operations / elapsed, 2) if elapsed else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(max(latencies) if latencies else None),
+        'queries': queries,
+        'queries_per_op': round(queries / operations, 3) if operations else None,
+    }
+
+
+def create_agents(count):
+    from support_chat import models
+    from support_chat.services import auth
+
+    agents = []
+    for index in range(count):
+        agent = models.SupportAgent.objects.create(
+            name=f'Bench agent {index}',
+            email=f'bench-{os.getpid()}-{index}@example.com',
+            is_online=True,
+            max_concurrent_chats=10 ** 6,
+        )
+        agents.append((agent, auth.create_agent_session(agent).session_token))
+    return agents
+
+
+async def bench_create_session(client, count, counter):
+    latencies, sessions = [], []
+    counter.reset()
+    started = time.perf_counter()
+    for index in range(count):
+        body = json.dumps({'name': f'Visitor {index}', 'email': f'visitor{index}@example.com'})
+        t0 = time.perf_counter()
+        response = await client.post('/support_chat/api/create_session/', body, content_type='application/json')
+        latencies.append(time.perf_counter() - t0)
+        sessions.append(response.json())
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed, count, counter.count), sessions
+
+
+async def bench_accept(client, sessions, agents, counter):
+    latencies, accepted = [], 0
+    counter.reset()
+    started = time.perf_counter()
+    for index, session in enumerate(sessions):
+        agent, _ = agents[index % len(agents)]
+        body = json.dumps({'conversation_id': session['conversation_id'], 'agent_id': str(agent.id)})
+        t0 = time.perf_counter()
+        response = await client.post('/support_chat/api/accept_conversation/', body, content_type='application/json')
+        latencies.append(time.perf_counter() - t0)
+        accepted += bool(response.json().get('ok'))
+    elapsed = time.perf_counter() - started
+    result = summarize(latencies, elapsed, len(sessions), counter.count)
+    # Auto-assigned conversations are no longer waiting and count as misses
+    result['accepted'] = accepted
+    return result
+
+
+async def bench_messages(sessions, agents, args, counter):
+    from channels.routing import URLRouter
+    from channels.testing import WebsocketCommunicator
+
+    from support_chat import models
+    from support_chat.routing import websocket_urlpatterns
+    from support_chat.services.messages import get_write_buffer
+    from support_chat.settings import get_setting
+
+    application = URLRouter(websocket_urlpatterns)
+    stored_before = await models.Message.objects.acount()
+
+    # With --auto-assign the engine chose the agent, so ask the database
+    tokens = {agent.id: token for agent, token in agents}
+    assigned = {
+        str(conversation_id): agent_id
+        async for conversation_id, agent_id in models.Conversation.objects.filter(
+            id__in=[session['conversation_id'] for session in sessions]
+        ).values_list('id', 'assigned_agent_id')
+    }
+
+    # Socket memory is measured on its own so tracing does not skew timings
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    pairs = []
+    for session in sessions:
+        conversation_id = session['conversation_id']
+        token = tokens.get(assigned.get(conversation_id))
+        if token is None:
+            raise RuntimeError(f'Conversation {conversation_id} is not assigned to a benchmark agent')
+        visitor = WebsocketCommunicator(
+            application, f'/ws/support/conversation/{conversation_id}/?token={session["token"]}'
+        )
+        agent = WebsocketCommunicator(
+            application, f'/ws/support/conversation/{conversation_id}/',
+            headers=[(b'cookie', f'agent_session_token={token}'.encode())],
+        )
+        for socket in (visitor, agent):
+            connected, _ = await socket.connect(timeout=args.timeout)
+            if not connected:
+                raise RuntimeError(f'Socket for conversation {conversation_id} was rejected')
+        pairs.append((conversation_id, visitor, agent))
+    sockets = 2 * len(pairs)
+    memory_per_connection = (tracemalloc.get_traced_memory()[0] - baseline) / sockets if sockets else 0
+    tracemalloc.stop()
+
+    sent_at, latencies = {}, []
+    lost = 0
+
+    async def send(conversation_id, socket):
+        for seq in range(args.messages):
+            text = f'{conversation_id}:{seq}'
+            sent_at[text] = time.perf_counter()
+            await socket.send_json_to({'type': 'message', 'message': text})
+            if args.interval:
+                await asyncio.sleep(args.interval)
+
+    async def receive(socket, record):
+        nonlocal lost
+        received = 0
+        while received < args.messages:
+            try:
+                frame = await socket.receive_json_from(timeout=args.timeout)
+            except asyncio.TimeoutError:
+                lost += args.messages - received
+                return
+            if frame.get('type') != 'message':
+                continue
+            text = frame['payload']['message']
+            if text in sent_at:
+                if record:
+                    latencies.append(time.perf_counter() - sent_at[text])
+                received += 1
+
+    counter.reset()
+    started = time.perf_counter()
+    tasks = []
+    for conversation_id, visitor, agent in pairs:
+        tasks.append(send(conversation_id, visitor))
+        tasks.append(receive(agent, record=True))
+        tasks.append(receive(visitor, record=False))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    if get_setting('MESSAGE_WRITE_BEHIND'):
+        await get_write_buffer().drain()
+    queries = counter.count
+
+    for _, visitor, agent in pairs:
+        await visitor.disconnect()
+        await agent.disconnect()
+
+    sent = len(sent_at)
+    result = summarize(latencies, elapsed, sent, queries)
+    result.update({
+        'conversations': len(pairs),
+        'deliveries': 2 * sent - lost,
+        'lost_deliveries': lost,
+        'stored': await models.Message.objects.acount() - stored_before,
+        'memory_per_connection_bytes': round(memory_per_connection),
+    })
+    return result
+
+
+async def run(args, counter, agents):
+    from django.test import AsyncClient
+
+    client = AsyncClient()
+    results = {}
+    results['create_session'], sessions = await bench_create_session(client, args.conversations, counter)
+    results['accept_conversation'] = await bench_accept(client, sessions, agents, counter)
+    results['messages'] = await bench_messages(sessions, agents, args, counter)
+    return results
+
+
+def environment(args):
+    import channels
+    import django
+    from django.conf import settings
+    from django.db import connection
+
+    def version(name):
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            return None
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'package_version': version('django-support-chat'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'channels': channels.__version__,
+        'platform': platform.platform(),
+        'database': connection.vendor,
+        'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+        'support_chat': dict(getattr(settings, 'SUPPORT_CHAT', {})),
+        'parameters': {
+            'conversations': args.conversations,
+            'messages': args.messages,
+            'agents': args.agents,
+            'interval': args.interval,
+        },
+    }
+
+
+# Metrics compared between runs; everything else is context (counts, totals)
+COMPARED_METRICS = {
+    'ops_per_sec': False,
+    'p50_ms': True,
+    'p95_ms': True,
+    'p99_ms': True,
+    'queries_per_op': True,
+    'memory_per_connection_bytes': True,
+    'peak_rss_kb': True,
+}
+
+
+def compare(baseline, current, threshold):
+    """Print metric deltas against a baseline; returns the regressed metrics."""
+    regressions = []
+    print(f'\nCompared with {baseline["environment"].get("git_commit") or baseline["environment"]["timestamp"]}:')
+    for section, metrics in current['results'].items():
+        old_metrics = baseline['results'].get(section, {})
+        for metric, value in metrics.items():
+            old = old_metrics.get(metric)
+            if metric not in COMPARED_METRICS or value is None or not old:
+                continue
+            change = (value - old) / old * 100
+            worse = change > threshold if COMPARED_METRICS[metric] else change < -threshold
+            flag = '  REGRESSION' if worse else ''
+            print(f'  {section}.{metric}: {old} -> {value} ({change:+.1f}%){flag}')
+            if worse:
+                regressions.append(f'{section}.{metric}')
+    return regressions
+
+
+def report(results):
+    for section, metrics in results.items():
+        print(f'{section}:')
+        for metric, value in metrics.items():
+            print(f'  {metric}: {value}')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--conversations', type=int, default=100, help='concurrent conversations (2 sockets each)')
+    parser.add_argument('--messages', type=int, default=20, help='messages each visitor sends')
+    parser.add_argument('--agents', type=int, default=10, help='agents sharing the conversations')
+    parser.add_argument('--interval', type=float, default=0, help='seconds between a visitor\'s messages')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for a frame')
+    parser.add_argument('--write-behind', action='store_true', help='enable MESSAGE_WRITE_BEHIND')
+    parser.add_argument('--auto-assign', action='store_true', help='enable AUTO_ASSIGN')
+    parser.add_argument('--redis', help='Redis URL for the channel layer and cache')
+    parser.add_argument('--settings', default=DEFAULT_SETTINGS, help='Django settings module')
+    parser.add_argument('--output', help='write the results as JSON to this path')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    parser.add_argument('--threshold', type=float, default=10, help='percent change reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 on regressions')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.redis:
+        os.environ['SUPPORT_CHAT_BENCH_REDIS'] = args.redis
+    os.environ['DJANGO_SETTINGS_MODULE'] = args.settings
+
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connections
+
+    django.setup()
+    overrides = {}
+    if args.write_behind:
+        overrides['MESSAGE_WRITE_BEHIND'] = True
+    if args.auto_assign:
+        overrides['AUTO_ASSIGN'] = True
+    if overrides:
+        settings.SUPPORT_CHAT = {**getattr(settings, 'SUPPORT_CHAT', {}), **overrides}
+
+    counter = QueryCounter()
+    counter.install()
+    call_command('migrate', verbosity=0, interactive=False)
+    agents = create_agents(args.agents)
+    connections.close_all()
+
+    try:
+        results = asyncio.run(run(args, counter, agents))
+    finally:
+        if args.settings == DEFAULT_SETTINGS and 'SUPPORT_CHAT_BENCH_DB' not in os.environ:
+            connections.close_all()
+            os.remove(settings.DATABASES['default']['NAME'])
+            search_index = settings.SUPPORT_CHAT.get('SEARCH_INDEX_PATH')
+            if search_index and os.path.exists(search_index):
+                os.remove(search_index)
+
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['process'] = {'peak_rss_kb': peak_rss // 1024 if sys.platform == 'darwin' else peak_rss}
+    output = {'environment': environment(args), 'results': results}
+
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(output, fh, indent=2)
+        print(f'\nWrote {args.output}')
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(json.load(fh), output, args.threshold)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Standalone Django settings for the support chat benchmarks.
+
+Uses a throwaway SQLite database and the in-memory channel layer by default.
+Set SUPPORT_CHAT_BENCH_REDIS (e.g. redis://127.0.0.1:6379/0) to run against
+channels_redis and a Redis cache instead.
+"""
+import os
+import tempfile
+
+SECRET_KEY = 'support-chat-benchmarks'
+DEBUG = False
+USE_TZ = True
+ALLOWED_HOSTS = ['*']
+
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'channels',
+    'support_chat',
+]
+MIDDLEWARE = []
+ROOT_URLCONF = 'benchmarks.urls'
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'APP_DIRS': True,
+}]
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get(
+            'SUPPORT_CHAT_BENCH_DB',
+            os.path.join(tempfile.gettempdir(), f'support_chat_bench_{os.getpid()}.sqlite3'),
+        ),
+    },
+}
+
+REDIS_URL = os.environ.get('SUPPORT_CHAT_BENCH_REDIS')
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [REDIS_URL], 'capacity': 10000},
+        },
+    }
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': 10000},
+        },
+    }
+
+# run.py adds --write-behind / --auto-assign to this
+SUPPORT_CHAT = {
+    # Every simulated visitor shares one address
+    'RATE_LIMIT_ENABLED': False,
+    'SEARCH_INDEX_PATH': os.path.join(tempfile.gettempdir(), f'support_chat_bench_{os.getpid()}.search.jsonl'),
+}
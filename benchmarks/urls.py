@@ -0,0 +1,5 @@
+from django.urls import include, path
+
+urlpatterns = [
+    path('support_chat/', include('support_chat.urls')),
+]
@@ -16,7 +16,7 @@ class SupportAgentAdmin(admin.ModelAdmin):
 
 @admin.register(models.Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'visitor', 'assigned_agent', 'status', 'started_at', 'ended_at')
+    list_display = ('id', 'visitor', 'assigned_agent', 'status', 'started_at', 'ended_at', 'archived_at')
     list_filter = ('status',)
     search_fields = ('visitor__name', 'visitor__email')
 
@@ -25,6 +25,7 @@ class ConversationAdmin(admin.ModelAdmin):
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('conversation', 'sender_type', 'created_at')
     list_filter = ('sender_type',)
+    ordering = ('-created_at',)
 
 
 @admin.register(models.ConversationRating)
@@ -34,10 +35,11 @@ class ConversationRatingAdmin(admin.ModelAdmin):
 
 @admin.register(models.AgentOTP)
 class AgentOTPAdmin(admin.ModelAdmin):
-    list_display = ('email', 'otp', 'is_verified', 'attempts', 'created_at', 'is_expired_status')
+    list_display = ('email', 'otp', 'is_verified', 'attempts', 'created_at', 'sent_at', 'is_expired_status')
     search_fields = ('email',)
     list_filter = ('is_verified', 'created_at')
-    readonly_fields = ('otp', 'email', 'created_at', 'is_expired_status')
+    readonly_fields = ('otp', 'email', 'created_at', 'sent_at', 'is_expired_status')
+    ordering = ('-created_at',)
     
     def is_expired_status(self, obj):
         return "✓ Expired" if obj.is_expired() else "✗ Valid"
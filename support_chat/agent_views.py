@@ -1,13 +1,24 @@
 import json
+from asgiref.sync import sync_to_async
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.shortcuts import render, redirect
-from django.utils import timezone
 
 from .services import auth as auth_service
+from .services.fanout import apublish_conversation_event, apublish_message
+from .services.messages import acreate_message, serialize_message
+from .services.history import get_conversation_page, InvalidCursor
+from .services.conversations import get_agent_conversations, get_queue_version
+from .services.queue import apublish_queue_event
+from .services.assignment import aassign_conversation, aclose_conversation, reserve_agent_capacity
+from .services.presence import set_agents_offline
+from .services.search import get_search_backend, search_conversations
+from .services.visitors import get_visitor_conversations
+from .views import aget_object_or_404
 from .decorators import agent_login_required
 from . import models
+from .metrics import MESSAGES
 
 
 @csrf_exempt
@@ -101,24 +112,14 @@ def agent_dashboard(request):
     """Agent dashboard showing waiting and active conversations."""
     agent = request.agent
     
-    # Fetch conversations assigned to this agent
-    conversations = models.Conversation.objects.filter(
-        assigned_agent=agent
-    ).select_related('visitor').order_by('-started_at')
-    
-    # Separate by status
-    waiting = models.Conversation.objects.filter(
-        status=models.Conversation.STATUS_WAITING
-    ).select_related('visitor')
-    
-    active = conversations.filter(status=models.Conversation.STATUS_ACTIVE)
-    closed = conversations.filter(status=models.Conversation.STATUS_CLOSED)
+    # One grouped (and cached) query for all three buckets
+    buckets = get_agent_conversations(agent)
     
     context = {
         'agent': agent,
-        'waiting_conversations': waiting,
-        'active_conversations': active,
-        'closed_conversations': closed,
+        'waiting_conversations': buckets['waiting'],
+        'active_conversations': buckets['active'],
+        'closed_conversations': buckets['closed'],
     }
     return render(request, 'support_chat/agent_dashboard.html', context)
 
@@ -127,23 +128,12 @@ def agent_dashboard(request):
 @require_http_methods(["GET"])
 def agent_sidebar(request):
     """Return just the sidebar HTML for real-time updates."""
-    agent = request.agent
-    
-    waiting = models.Conversation.objects.filter(
-        status=models.Conversation.STATUS_WAITING
-    ).select_related('visitor')
-    
-    conversations = models.Conversation.objects.filter(
-        assigned_agent=agent
-    ).select_related('visitor').order_by('-started_at')
-    
-    active = conversations.filter(status=models.Conversation.STATUS_ACTIVE)
-    closed = conversations.filter(status=models.Conversation.STATUS_CLOSED)
+    buckets = get_agent_conversations(request.agent)
     
     context = {
-        'waiting_conversations': waiting,
-        'active_conversations': active,
-        'closed_conversations': closed,
+        'waiting_conversations': buckets['waiting'],
+        'active_conversations': buckets['active'],
+        'closed_conversations': buckets['closed'],
     }
     return render(request, 'support_chat/sidebar.html', context)
 
@@ -163,21 +153,94 @@ def agent_chat(request, conversation_id):
     if conversation.assigned_agent != agent:
         return render(request, 'support_chat/error.html', {'error': 'Not authorized'}, status=403)
     
-    messages = conversation.messages.all()
+    # Only the latest window is rendered; older pages load on scroll
+    messages, history_cursor = get_conversation_page(conversation)
     
     context = {
         'agent': agent,
         'conversation': conversation,
         'messages': messages,
+        'history_cursor': history_cursor,
         'visitor': conversation.visitor,
     }
     return render(request, 'support_chat/agent_chat.html', context)
 
 
+@agent_login_required
+@require_http_methods(["GET"])
+def agent_messages_api(request, conversation_id):
+    """Return a page of message history, newest first, as JSON.
+
+    Pass the returned ``next_cursor`` back as ``?cursor=`` to fetch the
+    previous page.
+    """
+    agent = request.agent
+    
+    conversation = models.Conversation.objects.filter(id=conversation_id, assigned_agent=agent).first()
+    if conversation is None:
+        return JsonResponse({'ok': False, 'error': 'Not authorized'}, status=403)
+    
+    try:
+        limit = int(request.GET.get('limit', 0))
+    except ValueError:
+        limit = 0
+    try:
+        messages, next_cursor = get_conversation_page(
+            conversation, before=request.GET.get('cursor') or None, limit=limit
+        )
+    except InvalidCursor:
+        return JsonResponse({'ok': False, 'error': 'Invalid cursor'}, status=400)
+    
+    return JsonResponse({
+        'ok': True,
+        'messages': [serialize_message(m) for m in messages],
+        'next_cursor': next_cursor,
+    })
+
+
+@agent_login_required
+@require_http_methods(["GET"])
+def agent_visitor_history_api(request, conversation_id):
+    """Return the visitor's other conversations, newest first, as JSON.
+
+    At most ``?limit=`` (capped by VISITOR_HISTORY_LIMIT) are returned.
+    """
+    try:
+        limit = int(request.GET.get('limit', 0))
+    except ValueError:
+        limit = 0
+    conversations = get_visitor_conversations(conversation_id, request.agent, limit)
+    if conversations is None:
+        return JsonResponse({'ok': False, 'error': 'Not authorized'}, status=403)
+    return JsonResponse({'ok': True, 'conversations': conversations})
+
+
+@agent_login_required
+@require_http_methods(["GET"])
+def agent_search_api(request):
+    """Search the agent's conversations by message text and visitor details.
+
+    ``?q=`` is matched against whole words; results are ranked, one per
+    conversation, and paginated with ``?page=`` and ``?page_size=``.
+    """
+    if get_search_backend() is None:
+        return JsonResponse({'ok': False, 'error': 'Search is not enabled'}, status=404)
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'ok': False, 'error': 'Query required'}, status=400)
+    try:
+        page = int(request.GET.get('page', 1))
+        page_size = int(request.GET.get('page_size', 0))
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': 'Invalid page'}, status=400)
+    
+    return JsonResponse({'ok': True, **search_conversations(request.agent, query, page, page_size)})
+
+
 @agent_login_required
 @csrf_exempt
 @require_http_methods(["POST"])
-def agent_accept_conversation(request):
+async def agent_accept_conversation(request):
     """Agent accepts a waiting conversation."""
     agent = request.agent
     try:
@@ -189,20 +252,18 @@ def agent_accept_conversation(request):
             status=models.Conversation.STATUS_WAITING
         )
         
-        from .services.assignment import assign_conversation
-        ok = assign_conversation(conv_qs, agent)
+        shard, started_at = await conv_qs.values_list('queue_shard', 'started_at').afirst() or ('', None)
+        ok = await aassign_conversation(conv_qs, agent, started_at)
         
         if ok:
-            # Broadcast to all agents that this conversation was accepted
-            from asgiref.sync import async_to_sync
-            from channels.layers import get_channel_layer
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)('support_queue', {
+            await sync_to_async(reserve_agent_capacity)(agent.id)
+            # Broadcast to the agents of its queue shard that it was accepted
+            await apublish_queue_event({
                 'type': 'conversation.accepted',
                 'conversation_id': conv_id,
                 'agent_id': str(agent.id),
                 'agent_name': agent.name,
-            })
+            }, shard)
             
             return JsonResponse({'ok': True, 'message': 'Conversation accepted'})
         else:
@@ -214,7 +275,7 @@ def agent_accept_conversation(request):
 @agent_login_required
 @csrf_exempt
 @require_http_methods(["POST"])
-def agent_send_message(request):
+async def agent_send_message(request):
     """Agent sends a message in a conversation."""
     agent = request.agent
     try:
@@ -222,33 +283,16 @@ def agent_send_message(request):
         conv_id = data.get('conversation_id')
         message_text = data.get('message', '').strip()
         
-        conversation = models.Conversation.objects.get(id=conv_id)
-        if conversation.assigned_agent != agent:
+        conversation = await models.Conversation.objects.aget(id=conv_id)
+        if conversation.assigned_agent_id != agent.id:
             return JsonResponse({'ok': False, 'error': 'Not authorized'}, status=403)
         
         # Create message
-        m = models.Message.objects.create(
-            conversation=conversation,
-            sender_type='agent',
-            sender_id=agent.id,
-            message=message_text
-        )
+        m = await acreate_message(conversation.id, 'agent', agent.id, message_text)
+        MESSAGES.inc(sender_type=m.sender_type, transport='http')
         
         # Broadcast via Channels
-        from asgiref.sync import async_to_sync
-        from channels.layers import get_channel_layer
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(f'visitor_{conv_id}', {
-            'type': 'chat.message',
-            'message': {
-                'id': str(m.id),
-                'conversation': str(conv_id),
-                'sender_type': 'agent',
-                'sender_id': str(agent.id),
-                'message': m.message,
-                'created_at': m.created_at.isoformat(),
-            }
-        })
+        await apublish_message(conversation.id, serialize_message(m))
         
         return JsonResponse({'ok': True})
     except Exception as e:
@@ -258,7 +302,7 @@ def agent_send_message(request):
 @agent_login_required
 @csrf_exempt
 @require_http_methods(["POST"])
-def agent_close_conversation(request):
+async def agent_close_conversation(request):
     """Allow agent to close a conversation and submit rating/feedback.
 
     Expected JSON body: {
@@ -274,7 +318,7 @@ def agent_close_conversation(request):
         if not conv_id:
             return JsonResponse({'ok': False, 'error': 'conversation_id required'}, status=400)
 
-        conv = get_object_or_404(models.Conversation, id=conv_id)
+        conv = await aget_object_or_404(models.Conversation, id=conv_id)
 
         # Only assigned agent may close (security)
         agent = request.agent
@@ -293,22 +337,20 @@ def agent_close_conversation(request):
         feedback = data.get('feedback', '')
 
         # Mark conversation closed
-        conv.status = models.Conversation.STATUS_CLOSED
-        conv.ended_at = timezone.now()
-        conv.save()
+        closed = await aclose_conversation(conv)
 
         # Save rating
-        models.ConversationRating.objects.update_or_create(
+        await models.ConversationRating.objects.aupdate_or_create(
             conversation=conv,
             defaults={'agent_rating': agent_rating, 'system_rating': system_rating, 'comment': feedback}
         )
 
-        # Broadcast closure to visitor group
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(f'visitor_{conv_id}', {
-            'type': 'conversation.closed',
-            'conversation_id': conv_id,
-        })
+        # Broadcast closure to the conversation
+        if closed:
+            await apublish_conversation_event(conv.id, {
+                'type': 'conversation.closed',
+                'conversation_id': str(conv.id),
+            })
 
         return JsonResponse({'ok': True})
     except Exception as e:
@@ -329,6 +371,7 @@ def agent_logout(request):
     token = request.COOKIES.get('agent_session_token')
     if token:
         auth_service.logout_agent(token)
+    set_agents_offline([request.agent.id])
     response = redirect('support_chat:agent_login')
     response.delete_cookie('agent_session_token')
     return response
@@ -338,55 +381,16 @@ def agent_logout(request):
 @require_http_methods(["GET"])
 def agent_conversations_api(request):
     """API endpoint to return all conversations for the agent as JSON."""
-    agent = request.agent
-    
-    # Waiting conversations - visible to ALL agents (not yet assigned)
-    waiting = models.Conversation.objects.filter(
-        status=models.Conversation.STATUS_WAITING
-    ).select_related('visitor').values('id', 'visitor__name', 'visitor__email', 'status', 'started_at')
-    
-    # Conversations assigned to this specific agent (both assigned and active statuses)
-    my_conversations = models.Conversation.objects.filter(
-        assigned_agent=agent
-    ).select_related('visitor').order_by('-started_at')
-    
-    # Active conversations assigned to me (includes both "assigned" and "active" statuses for ongoing chats)
-    active = my_conversations.filter(
-        status__in=[models.Conversation.STATUS_ASSIGNED, models.Conversation.STATUS_ACTIVE]
-    ).values('id', 'visitor__name', 'visitor__email', 'status', 'started_at')
-    
-    # Closed conversations assigned to me
-    closed = my_conversations.filter(status=models.Conversation.STATUS_CLOSED).values(
-        'id', 'visitor__name', 'visitor__email', 'status', 'started_at'
-    )
+    # Read the queue position first so the client never skips an event
+    seq = get_queue_version()
+    buckets = get_agent_conversations(request.agent)
     
+    # Waiting conversations are visible to ALL agents; active (assigned or
+    # active status) and closed ones are this agent's own
+    fields = ('id', 'visitor_name', 'visitor_email', 'status')
     data = {
-        'waiting': [
-            {
-                'id': str(c['id']),
-                'visitor_name': c['visitor__name'],
-                'visitor_email': c['visitor__email'],
-                'status': c['status'],
-            }
-            for c in waiting
-        ],
-        'active': [
-            {
-                'id': str(c['id']),
-                'visitor_name': c['visitor__name'],
-                'visitor_email': c['visitor__email'],
-                'status': c['status'],
-            }
-            for c in active
-        ],
-        'closed': [
-            {
-                'id': str(c['id']),
-                'visitor_name': c['visitor__name'],
-                'visitor_email': c['visitor__email'],
-                'status': c['status'],
-            }
-            for c in closed
-        ],
+        name: [{field: c[field] for field in fields} for c in conversations]
+        for name, conversations in buckets.items()
     }
-    return JsonResponse(data)
\ No newline at end of file
+    data['seq'] = seq
+    return JsonResponse(data)
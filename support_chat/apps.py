@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class SupportChatConfig(AppConfig):
     name = 'support_chat'
     verbose_name = 'Support Chat'
+
+    def ready(self):
+        from django.core import checks
+
+        from .checks import check_metrics_token, check_shared_cache
+        checks.register(check_shared_cache, checks.Tags.caches)
+        checks.register(check_metrics_token, checks.Tags.security)
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core import checks
+
+from .settings import get_setting
+
+# Cache backends whose entries other processes cannot see
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def default_cache_is_shared():
+    """True unless the default cache lives inside each process."""
+    return settings.CACHES.get('default', {}).get('BACKEND') not in PER_PROCESS_CACHES
+
+
+def check_metrics_token(app_configs, **kwargs):
+    if not get_setting('METRICS_ENABLED') or get_setting('METRICS_TOKEN'):
+        return []
+    return [checks.Warning(
+        'METRICS_ENABLED is set without METRICS_TOKEN; the metrics endpoint stays disabled.',
+        hint='Set METRICS_TOKEN and send it as "Authorization: Bearer <token>" from the scraper.',
+        id='support_chat.W003',
+    )]
+
+
+def check_shared_cache(app_configs, **kwargs):
+    if default_cache_is_shared():
+        return []
+    backend = settings.CACHES['default']['BACKEND']
+    errors = [checks.Warning(
+        'Agent presence is kept in the default cache, which is not shared between processes.',
+        hint=(
+            'With more than one worker, presence sweeps in one process cannot see heartbeats '
+            'from the others and agents flap offline. Use Redis, Memcached or the database cache.'
+        ),
+        obj=backend,
+        id='support_chat.W001',
+    )]
+    if get_setting('CONVERSATION_SWEEP_IN_PROCESS'):
+        errors.append(checks.Warning(
+            'CONVERSATION_SWEEP_IN_PROCESS needs a shared cache for its lock; agent sockets will not sweep.',
+            hint='Use a shared cache, or set it to False and run `manage.py sweep_conversations --loop`.',
+            obj=backend,
+            id='support_chat.W002',
+        ))
+    return errors
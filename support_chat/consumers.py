@@ -1,143 +1,726 @@
+import asyncio
+import functools
 import json
+import logging
+import math
+import time
+import uuid
+from collections import OrderedDict
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
-from django.utils import timezone
 from . import models
+from .metrics import (
+    CHANNEL_LAYER_SECONDS, CONNECTIONS, DB_SECONDS, MESSAGE_HANDLE_SECONDS, MESSAGES, QUEUE_DELIVERIES,
+)
+from .protocol import PROTOCOLS, V1, negotiate
+from .services.fanout import apublish_conversation_event, apublish_message, conversation_group
+from .services.messages import acreate_message, get_write_buffer, serialize_message
+from .services.conversations import get_waiting_conversations
+from .services.groups import get_group_strategy
+from .services.lifecycle import sweep_conversations
+from .services.outbound import KIND_MESSAGE, KIND_QUEUE, KIND_TRANSIENT, RESYNC_KEY, OutboundQueue
+from .services.queue import get_events_since
+from .services.assignment import aclose_conversation
+from .services.presence import EventCoalescer, agent_heartbeat
+from .services.ratelimit import get_rate_limiter
+from .services.replay import get_missed_messages
+from .settings import get_setting
 
+logger = logging.getLogger(__name__)
 
-class QueueConsumer(AsyncJsonWebsocketConsumer):
-    async def connect(self):
-        await self.channel_layer.group_add('support_queue', self.channel_name)
-        await self.accept()
+# How many delivered message ids each conversation socket remembers
+RECENT_MESSAGE_IDS = 256
+VISITOR_ACTIVITY_STATES = ('active', 'idle')
+# Close code for sockets that cannot keep up; clients reconnect and resume
+SLOW_CLIENT_CLOSE_CODE = 4008
 
-    async def disconnect(self, code):
-        await self.channel_layer.group_discard('support_queue', self.channel_name)
+
+def observe_latency(event):
+    # Events published through services.fanout / services.queue carry sent_at
+    sent_at = event.get('sent_at')
+    if sent_at is not None:
+        CHANNEL_LAYER_SECONDS.observe(max(0.0, time.time() - sent_at), event=event['type'])
+
+
+def canonical_conversation_id(value):
+    """Return the canonical string form of a conversation UUID, or None if invalid."""
+    try:
+        return str(uuid.UUID(value))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def seen_before(recent_ids, message_id):
+    """Remember a delivered message id; True if it was delivered recently.
+
+    Keeps a message published twice (e.g. a retried request) from reaching
+    a socket twice.
+    """
+    if message_id in recent_ids:
+        return True
+    recent_ids[message_id] = None
+    if len(recent_ids) > RECENT_MESSAGE_IDS:
+        recent_ids.popitem(last=False)
+    return False
+
+
+async def stop_typing(coalescer, publish):
+    """Drop pending typing/activity events and clear an indicator still shown."""
+    typing = coalescer.last_sent('typing')
+    coalescer.cancel()
+    # Do not leave the other side with a stale indicator
+    if typing and typing['typing']:
+        await publish(dict(typing, typing=False))
+
+
+async def load_missed_messages(conversation_id, content):
+    """Replay entries for a resume frame's last_id / since cursor."""
+    last_id, since = content.get('last_id'), content.get('since')
+    with DB_SECONDS.time(operation='replay_messages'):
+        return await database_sync_to_async(get_missed_messages)(
+            conversation_id,
+            last_id if isinstance(last_id, str) else None,
+            since if isinstance(since, str) else None,
+        )
+
+
+class ConnectionMetricsMixin:
+    """Counts accepted sockets in the support_chat_connections gauge."""
+
+    metrics_label = None
+    counted = False
+
+    def count_connection(self):
+        self.counted = True
+        CONNECTIONS.inc(consumer=self.metrics_label)
+
+    def uncount_connection(self):
+        if self.counted:
+            self.counted = False
+            CONNECTIONS.dec(consumer=self.metrics_label)
+
+
+class ProtocolMixin:
+    """Encodes and decodes frames with the subprotocol negotiated at connect time."""
+
+    protocol = PROTOCOLS[V1]
+
+    async def accept_protocol(self):
+        self.protocol, subprotocol = negotiate(self.scope.get('subprotocols') or ())
+        await self.accept(subprotocol)
+
+    async def send_json(self, content, close=False):
+        text_data, bytes_data = self.protocol.encode(content)
+        await self.send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        try:
+            content = self.protocol.decode(text_data, bytes_data)
+        except ValueError:
+            logger.debug('Dropping malformed %s frame', self.protocol.name)
+            return
+        await self.receive_json(content, **kwargs)
+
+
+class OutboundMixin:
+    """Sends frames to the client, through a bounded OutboundQueue if SEND_QUEUE_ENABLED.
+
+    Without the queue, frames are sent straight from the handler that
+    produced them.
+    """
+
+    outbound = None
+
+    def open_outbound(self, resync=None):
+        if get_setting('SEND_QUEUE_ENABLED'):
+            self.outbound = OutboundQueue(self.deliver, self.close_slow, self.metrics_label, resync=resync)
+            self.outbound.start()
+
+    async def send_frame(self, frame, kind=KIND_MESSAGE, key=None):
+        """Send a frame (or await an async callable that sends one)."""
+        if self.outbound is not None:
+            self.outbound.put(frame, kind, key)
+        elif callable(frame):
+            await frame()
+        else:
+            await self.deliver(frame)
+
+    def close_outbound(self):
+        if self.outbound is not None:
+            self.outbound.stop()
+
+    async def deliver(self, frame):
+        await self.send_json(frame)
+
+    async def close_slow(self):
+        await self.close(code=SLOW_CLIENT_CLOSE_CODE)
+
+
+class AgentPresenceMixin:
+    """Heartbeats the connected agent's presence while the socket is open."""
+
+    presence_task = None
+
+    def start_presence(self):
+        self.presence_task = asyncio.get_running_loop().create_task(self.heartbeat_loop())
+
+    def stop_presence(self):
+        if self.presence_task is not None:
+            self.presence_task.cancel()
+
+    async def heartbeat_loop(self):
+        agent = self.scope['support_agent']
+        while True:
+            try:
+                await database_sync_to_async(agent_heartbeat)(agent)
+            except Exception:
+                logger.exception('Presence heartbeat failed for agent %s', agent.id)
+            if get_setting('CONVERSATION_SWEEP_IN_PROCESS'):
+                try:
+                    await database_sync_to_async(sweep_conversations)()
+                except Exception:
+                    logger.exception('Conversation sweep failed')
+            await asyncio.sleep(get_setting('PRESENCE_HEARTBEAT_INTERVAL'))
+
+
+class QueueStreamMixin:
+    """Streams the events of an agent's queue shards, with resume and snapshots."""
+
+    # Events up to this seq are covered by the last snapshot sent
+    snapshot_seq = 0
+    queue_groups = ()
+
+    async def join_queue(self, agent):
+        # Subscribe to the agent's queue shards only
+        strategy = get_group_strategy()
+        self.shards = await database_sync_to_async(strategy.agent_shards)(agent)
+        self.queue_groups = [strategy.queue_group(shard) for shard in self.shards]
+        for group in self.queue_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+
+    async def leave_queue(self):
+        for group in self.queue_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    def open_outbound(self, resync=None):
+        # A client that fell behind gets one fresh snapshot instead
+        super().open_outbound(resync or self.send_snapshot)
+
+    async def handle_resume(self, last_seq):
+        """Replay missed queue events, or send a snapshot if too far behind."""
+        events = None
+        if isinstance(last_seq, int):
+            events = await sync_to_async(get_events_since)(last_seq, self.shards)
+        if events is None:
+            # Repeated requests while one is pending collapse into one snapshot
+            await self.send_frame(self.send_snapshot, KIND_QUEUE, RESYNC_KEY)
+            return
+        for event in events:
+            await self.send_frame(self.queue_frame(event), KIND_QUEUE)
+
+    async def send_snapshot(self):
+        seq, waiting = await database_sync_to_async(get_waiting_conversations)(self.shards)
+        self.snapshot_seq = seq
+        await self.send_json({
+            'type': 'queue_snapshot',
+            'seq': seq,
+            'waiting': [
+                {key: c[key] for key in ('id', 'visitor_name', 'visitor_email', 'status')}
+                for c in waiting
+            ],
+        })
+
+    async def deliver(self, frame):
+        seq = frame.get('seq')
+        if isinstance(seq, int) and seq <= self.snapshot_seq:
+            # Already reflected in a snapshot sent after it was queued
+            return
+        await self.send_json(frame)
+
+    def queue_frame(self, event):
+        """Convert a queue channel-layer event into the frame sent to clients."""
+        if event['type'] == 'conversation.accepted':
+            frame = {
+                'type': 'conversation_accepted',
+                'seq': event.get('seq'),
+                'conversation_id': event['conversation_id'],
+                'agent_id': event['agent_id'],
+                'agent_name': event['agent_name'],
+            }
+            # Present when the engine routed it, so the agent can list it;
+            # compact clients only get them on the assigned agent's socket
+            if not self.protocol.compact or event['agent_id'] == str(self.scope['support_agent'].id):
+                for key in ('visitor_name', 'visitor_email'):
+                    if key in event:
+                        frame[key] = event[key]
+            return frame
+        return event
+
+    async def send_queue_event(self, event):
+        observe_latency(event)
+        QUEUE_DELIVERIES.inc(event=event['type'])
+        await self.send_frame(self.queue_frame(event), KIND_QUEUE)
 
     async def new_conversation(self, event):
-        await self.send_json(event)
+        await self.send_queue_event(event)
 
     async def conversation_accepted(self, event):
         """Broadcast when a conversation is accepted by an agent."""
-        await self.send_json({
-            'type': 'conversation_accepted',
-            'conversation_id': event['conversation_id'],
+        await self.send_queue_event(event)
+
+    async def conversations_removed(self, event):
+        """Broadcast once per sweep with the conversations abandoned or closed."""
+        await self.send_queue_event(event)
+
+    async def agent_presence(self, event):
+        await self.send_frame({
+            'type': 'agent_presence',
             'agent_id': event['agent_id'],
             'agent_name': event['agent_name'],
-        })
+            'online': event['online'],
+        }, KIND_TRANSIENT, key=f"presence:{event['agent_id']}")
+
+
+class QueueConsumer(
+    ConnectionMetricsMixin, ProtocolMixin, QueueStreamMixin, OutboundMixin, AgentPresenceMixin,
+    AsyncJsonWebsocketConsumer,
+):
+    metrics_label = 'queue'
+
+    async def connect(self):
+        # Only logged-in agents may watch the queue
+        agent = self.scope.get('support_agent')
+        if agent is None:
+            return await self.close()
+        await self.join_queue(agent)
+        await self.accept_protocol()
+        self.count_connection()
+        self.open_outbound()
+        self.start_presence()
+
+    async def disconnect(self, code):
+        self.uncount_connection()
+        self.close_outbound()
+        self.stop_presence()
+        await self.leave_queue()
+
+    async def receive_json(self, content, **kwargs):
+        # Expect: {"type": "resume", "last_seq": <int>} after (re)connecting
+        if content.get('type') == 'resume':
+            await self.handle_resume(content.get('last_seq'))
 
 
-class AgentConsumer(AsyncJsonWebsocketConsumer):
+class AgentConsumer(
+    ConnectionMetricsMixin, ProtocolMixin, OutboundMixin, AgentPresenceMixin, AsyncJsonWebsocketConsumer
+):
+    metrics_label = 'agent'
+
     async def connect(self):
         self.agent_id = self.scope['url_route']['kwargs'].get('agent_id')
-        if not self.agent_id:
+        agent = self.scope.get('support_agent')
+        # An agent may only subscribe to their own channel
+        if not self.agent_id or agent is None or str(agent.id) != self.agent_id:
             return await self.close()
-        await self.channel_layer.group_add(f'agent_{self.agent_id}', self.channel_name)
-        await self.accept()
+        await self.join_groups(agent)
+        await self.accept_protocol()
+        self.count_connection()
+        self.open_outbound()
+        self.start_presence()
 
     async def disconnect(self, code):
-        await self.channel_layer.group_discard(f'agent_{self.agent_id}', self.channel_name)
+        self.uncount_connection()
+        self.close_outbound()
+        self.stop_presence()
+        await self.leave_groups()
+
+    async def join_groups(self, agent):
+        self.group_name = get_group_strategy().agent_group(self.agent_id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+
+    async def leave_groups(self):
+        if getattr(self, 'group_name', None):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def agent_assigned(self, event):
-        await self.send_json(event)
+        await self.send_frame(event, KIND_MESSAGE)
+
 
+class ConversationConsumer(ConnectionMetricsMixin, ProtocolMixin, OutboundMixin, AsyncJsonWebsocketConsumer):
+    metrics_label = 'conversation'
 
-class ConversationConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
-        self.conversation_id = self.scope['url_route']['kwargs'].get('conversation_id')
-        if not self.conversation_id:
+        # Groups and events use the canonical form of the id
+        self.conversation_id = canonical_conversation_id(self.scope['url_route']['kwargs'].get('conversation_id'))
+        if self.conversation_id is None:
+            # The route takes any path segment; the ORM would reject it later
+            return await self.close()
+        self.conversation_checked = False
+        
+        # Pin the sender identity for the whole connection: either the visitor
+        # holding a token for this conversation or the assigned agent
+        agent = self.scope.get('support_agent')
+        if self.scope.get('visitor_conversation_id') == self.conversation_id:
+            self.sender_type, self.sender_id = models.Message.SENDER_VISITOR, None
+        elif agent is not None and await self.is_assigned_agent(agent):
+            self.sender_type, self.sender_id = models.Message.SENDER_AGENT, agent.id
+            self.conversation_checked = True
+        else:
+            self.sender_type = None
             return await self.close()
         
-        # Subscribe both visitor and agent groups
-        self.visitor_group = f'visitor_{self.conversation_id}'
-        self.agent_group = f'agent_conversation_{self.conversation_id}'
+        # One group per conversation; events carry roles when they are not
+        # meant for every participant
+        self.group_name = conversation_group(self.conversation_id)
+        self.client_ip = (self.scope.get('client') or [None])[0]
+        self.recent_message_ids = OrderedDict()
+        # Typing and activity updates are throttled per socket and never saved
+        self.coalescer = EventCoalescer(self.publish_transient, get_setting('TYPING_WINDOW'))
         
-        await self.channel_layer.group_add(self.visitor_group, self.channel_name)
-        await self.channel_layer.group_add(self.agent_group, self.channel_name)
-        await self.accept()
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept_protocol()
+        self.count_connection()
+        self.open_outbound()
 
     async def disconnect(self, code):
-        await self.channel_layer.group_discard(self.visitor_group, self.channel_name)
-        await self.channel_layer.group_discard(self.agent_group, self.channel_name)
+        self.uncount_connection()
+        self.close_outbound()
+        if getattr(self, 'sender_type', None) is None:
+            return
+        await stop_typing(self.coalescer, self.publish_transient)
+        if self.sender_type == models.Message.SENDER_VISITOR:
+            await self.publish_transient({'type': 'visitor.presence', 'state': 'offline'})
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def receive_json(self, content, **kwargs):
-        # Expect messages: {"type": "message", "sender_type": "visitor|agent", "message": "...", "sender_id": "uuid"}
+        # Expect messages: {"type": "message", "message": "..."}; the sender is
+        # the identity authorized at connect time, not fields in the frame
+        if await self.throttled(content):
+            return
         if content.get('type') == 'message':
             await self.handle_message(content)
         elif content.get('type') == 'close_conversation':
             await self.handle_close_conversation(content)
+        elif content.get('type') == 'resume':
+            # {"type": "resume", "last_id": "<message id>", "since": "<created_at>"}
+            await self.handle_resume(content)
+        elif content.get('type') == 'typing':
+            # {"type": "typing", "typing": true|false}
+            await self.coalescer.offer('typing', {
+                'type': 'typing.indicator',
+                'sender_type': self.sender_type,
+                'typing': bool(content.get('typing')),
+            })
+        elif content.get('type') == 'activity':
+            # {"type": "activity", "state": "active"|"idle"}, visitors only
+            state = content.get('state')
+            if self.sender_type == models.Message.SENDER_VISITOR and state in VISITOR_ACTIVITY_STATES:
+                await self.coalescer.offer('activity', {'type': 'visitor.presence', 'state': state})
 
-    @database_sync_to_async
-    def save_message(self, conversation_id, sender_type, sender_id, message_text):
-        conv = models.Conversation.objects.get(id=conversation_id)
-        m = models.Message.objects.create(
-            conversation=conv,
-            sender_type=sender_type,
-            sender_id=sender_id,
-            message=message_text,
-        )
-        return {
-            'id': str(m.id),
-            'conversation': str(conv.id),
-            'sender_type': m.sender_type,
-            'sender_id': str(m.sender_id) if m.sender_id else None,
-            'message': m.message,
-            'created_at': m.created_at.isoformat(),
-        }
-
-    @database_sync_to_async
-    def close_conversation(self, conversation_id):
-        """Close conversation (only visitors can close)."""
-        conv = models.Conversation.objects.get(id=conversation_id)
-        conv.status = models.Conversation.STATUS_CLOSED
-        conv.ended_at = timezone.now()
-        conv.save()
-        return str(conv.id)
+    async def throttled(self, content):
+        """Charge a visitor frame to its rate limits; True if it must be dropped."""
+        if self.sender_type != models.Message.SENDER_VISITOR:
+            return False
+        # Same message:conversation bucket as the HTTP send_message view
+        checks = [('frame:conversation', self.conversation_id)]
+        if content.get('type') == 'message':
+            checks += [('message:ip', self.client_ip), ('message:conversation', self.conversation_id)]
+        retry_after = await get_rate_limiter().acheck_all(checks)
+        if retry_after is None:
+            return False
+        # Only dropped messages are reported; other frames vanish silently
+        if content.get('type') == 'message':
+            await self.send_frame(
+                {'type': 'rate_limited', 'retry_after': max(1, math.ceil(retry_after))}, KIND_TRANSIENT, 'rate_limited'
+            )
+        return True
+
+    async def publish_transient(self, event):
+        """Send a typing/presence event to the other side of the conversation."""
+        if self.sender_type == models.Message.SENDER_VISITOR:
+            roles = [models.Message.SENDER_AGENT]
+        else:
+            roles = [models.Message.SENDER_VISITOR]
+        await apublish_conversation_event(self.conversation_id, event, roles)
+
+    async def is_assigned_agent(self, agent):
+        return await models.Conversation.objects.filter(id=self.conversation_id, assigned_agent=agent).aexists()
+
+    async def save_message(self, conversation_id, sender_type, sender_id, message_text):
+        if not get_setting('MESSAGE_WRITE_BEHIND'):
+            with DB_SECONDS.time(operation='save_message'):
+                return await self.create_message(conversation_id, sender_type, sender_id, message_text)
+        # Write-behind: validate the conversation once per connection, then
+        # stamp the message in memory and let the buffer persist it.
+        if not self.conversation_checked:
+            with DB_SECONDS.time(operation='check_conversation'):
+                await self.check_conversation(conversation_id)
+            self.conversation_checked = True
+        m = get_write_buffer().add(conversation_id, sender_type, sender_id, message_text)
+        return serialize_message(m)
+
+    async def check_conversation(self, conversation_id):
+        if not await models.Conversation.objects.filter(id=conversation_id).aexists():
+            raise models.Conversation.DoesNotExist(conversation_id)
+
+    async def create_message(self, conversation_id, sender_type, sender_id, message_text):
+        conv = await models.Conversation.objects.aget(id=conversation_id)
+        m = await acreate_message(conv.id, sender_type, sender_id, message_text)
+        return serialize_message(m)
+
+    async def close_conversation(self, conversation_id):
+        """Close conversation (only visitors can close); False if it had already ended."""
+        conv = await models.Conversation.objects.aget(id=conversation_id)
+        return await aclose_conversation(conv)
 
     async def handle_message(self, content):
-        saved = await self.save_message(
-            self.conversation_id,
-            content.get('sender_type'),
-            content.get('sender_id'),
-            content.get('message'),
-        )
-        # Broadcast to both groups (visitor and agent)
-        await self.channel_layer.group_send(
-            self.visitor_group,
-            {
-                'type': 'chat.message',
-                'message': saved,
-            },
-        )
-        await self.channel_layer.group_send(
-            self.agent_group,
-            {
-                'type': 'chat.message',
-                'message': saved,
-            },
-        )
+        message_text = content.get('message')
+        if not isinstance(message_text, str) or not message_text.strip():
+            return
+        with MESSAGE_HANDLE_SECONDS.time():
+            saved = await self.save_message(
+                self.conversation_id,
+                self.sender_type,
+                self.sender_id,
+                message_text,
+            )
+            await apublish_message(self.conversation_id, saved)
+        MESSAGES.inc(sender_type=self.sender_type, transport='websocket')
+
+    async def handle_resume(self, content):
+        """Replay the messages a reconnecting client missed, in one frame."""
+        entries = await load_missed_messages(self.conversation_id, content)
+        messages = [
+            entry['message'] for entry in entries
+            if self.is_recipient(entry) and not self.is_duplicate(entry['message']['id'])
+        ]
+        if messages:
+            await self.send_frame({'type': 'replay', 'messages': messages}, KIND_MESSAGE)
 
     async def handle_close_conversation(self, content):
         """Handle conversation closure from visitor side only."""
-        await self.close_conversation(self.conversation_id)
+        if self.sender_type != models.Message.SENDER_VISITOR:
+            return
+        if not await self.close_conversation(self.conversation_id):
+            return
         # Notify both parties that conversation is closed
-        await self.channel_layer.group_send(
-            self.visitor_group,
-            {
-                'type': 'conversation.closed',
-                'conversation_id': self.conversation_id,
-            },
-        )
-        await self.channel_layer.group_send(
-            self.agent_group,
-            {
-                'type': 'conversation.closed',
-                'conversation_id': self.conversation_id,
-            },
-        )
+        await apublish_conversation_event(self.conversation_id, {
+            'type': 'conversation.closed',
+            'conversation_id': self.conversation_id,
+        })
+
+    def is_recipient(self, event):
+        roles = event.get('roles')
+        return not roles or self.sender_type in roles
+
+    def is_duplicate(self, message_id):
+        return seen_before(self.recent_message_ids, message_id)
 
     async def chat_message(self, event):
-        await self.send_json({'type': 'message', 'payload': event['message']})
+        if not self.is_recipient(event) or self.is_duplicate(event['message']['id']):
+            return
+        observe_latency(event)
+        await self.send_frame({'type': 'message', 'payload': event['message']}, KIND_MESSAGE)
 
     async def conversation_closed(self, event):
-        await self.send_json({'type': 'conversation_closed', 'conversation_id': event['conversation_id']})
+        if not self.is_recipient(event):
+            return
+        await self.send_frame({'type': 'conversation_closed', 'conversation_id': event['conversation_id']}, KIND_MESSAGE)
+
+    async def typing_indicator(self, event):
+        if self.is_recipient(event):
+            await self.send_frame(
+                {'type': 'typing', 'sender_type': event['sender_type'], 'typing': event['typing']},
+                KIND_TRANSIENT, 'typing',
+            )
+
+    async def visitor_presence(self, event):
+        if self.is_recipient(event):
+            await self.send_frame({'type': 'visitor_presence', 'state': event['state']}, KIND_TRANSIENT, 'visitor_presence')
+
+    async def agent_presence(self, event):
+        if self.is_recipient(event):
+            await self.send_frame(
+                {'type': 'agent_presence', 'agent_name': event['agent_name'], 'online': event['online']},
+                KIND_TRANSIENT, 'agent_presence',
+            )
+
+
+class ConversationSubscription:
+    """A conversation streamed over a multiplexed agent socket."""
+
+    def __init__(self, conversation_id, publish_transient, window):
+        self.conversation_id = conversation_id
+        self.group_name = conversation_group(conversation_id)
+        self.recent_message_ids = OrderedDict()
+        # Typing updates are throttled per conversation, as on ConversationConsumer
+        self.coalescer = EventCoalescer(functools.partial(publish_transient, conversation_id), window)
+
+
+class AgentMultiplexConsumer(QueueStreamMixin, AgentConsumer):
+    """One socket per agent for their queue, their assignments and their chats.
+
+    Besides AgentConsumer's events, the socket streams the agent's queue
+    shards like QueueConsumer and any conversations it subscribes to, so a
+    dashboard needs no per-chat ConversationConsumer. Client frames:
+
+    - ``{"type": "subscribe", "conversation_id": "..."}`` joins a conversation
+      assigned to the agent (answered with ``subscribed``, or ``unsubscribed``
+      when refused); an optional ``last_id`` / ``since`` replays what was
+      missed, as a conversation ``resume`` does
+    - ``{"type": "unsubscribe", "conversation_id": "..."}``
+    - ``message``, ``typing`` and ``resume`` with a ``conversation_id`` act on
+      that subscription; ``resume`` with ``last_seq`` resumes the queue
+
+    Every conversation frame sent to the client carries its conversation_id.
+    """
+
+    metrics_label = 'agent_multiplex'
+
+    async def join_groups(self, agent):
+        self.subscriptions = {}
+        await super().join_groups(agent)
+        await self.join_queue(agent)
+
+    async def leave_groups(self):
+        await super().leave_groups()
+        await self.leave_queue()
+        for conversation_id in list(getattr(self, 'subscriptions', ())):
+            await self.unsubscribe(conversation_id)
+
+    async def receive_json(self, content, **kwargs):
+        frame_type = content.get('type')
+        conversation_id = canonical_conversation_id(content.get('conversation_id'))
+        if frame_type == 'subscribe' and conversation_id:
+            await self.handle_subscribe(conversation_id, content)
+        elif frame_type == 'unsubscribe' and conversation_id:
+            await self.unsubscribe(conversation_id)
+            await self.send_frame({'type': 'unsubscribed', 'conversation_id': conversation_id}, KIND_MESSAGE)
+        elif frame_type == 'resume' and 'last_seq' in content:
+            await self.handle_resume(content.get('last_seq'))
+        elif conversation_id in self.subscriptions:
+            subscription = self.subscriptions[conversation_id]
+            if frame_type == 'message':
+                await self.handle_message(subscription, content)
+            elif frame_type == 'typing':
+                await subscription.coalescer.offer('typing', {
+                    'type': 'typing.indicator',
+                    'sender_type': models.Message.SENDER_AGENT,
+                    'typing': bool(content.get('typing')),
+                })
+            elif frame_type == 'resume':
+                await self.replay(subscription, content)
+
+    async def handle_subscribe(self, conversation_id, content):
+        subscription = self.subscriptions.get(conversation_id)
+        if subscription is None:
+            agent = self.scope['support_agent']
+            if len(self.subscriptions) >= get_setting('AGENT_SOCKET_MAX_SUBSCRIPTIONS') or not (
+                await models.Conversation.objects.filter(id=conversation_id, assigned_agent=agent).aexists()
+            ):
+                await self.send_frame({'type': 'unsubscribed', 'conversation_id': conversation_id}, KIND_MESSAGE)
+                return
+            subscription = ConversationSubscription(
+                conversation_id, self.publish_transient, get_setting('TYPING_WINDOW')
+            )
+            self.subscriptions[conversation_id] = subscription
+            await self.channel_layer.group_add(subscription.group_name, self.channel_name)
+        await self.send_frame({'type': 'subscribed', 'conversation_id': conversation_id}, KIND_MESSAGE)
+        if content.get('last_id') or content.get('since'):
+            await self.replay(subscription, content)
+
+    async def unsubscribe(self, conversation_id):
+        subscription = self.subscriptions.pop(conversation_id, None)
+        if subscription is None:
+            return
+        await stop_typing(subscription.coalescer, functools.partial(self.publish_transient, conversation_id))
+        await self.channel_layer.group_discard(subscription.group_name, self.channel_name)
+
+    async def publish_transient(self, conversation_id, event):
+        await apublish_conversation_event(conversation_id, event, [models.Message.SENDER_VISITOR])
+
+    async def handle_message(self, subscription, content):
+        message_text = content.get('message')
+        if not isinstance(message_text, str) or not message_text.strip():
+            return
+        agent_id = self.scope['support_agent'].id
+        with MESSAGE_HANDLE_SECONDS.time():
+            if get_setting('MESSAGE_WRITE_BEHIND'):
+                # The conversation was checked when subscribing
+                m = get_write_buffer().add(
+                    subscription.conversation_id, models.Message.SENDER_AGENT, agent_id, message_text
+                )
+            else:
+                with DB_SECONDS.time(operation='save_message'):
+                    m = await acreate_message(
+                        subscription.conversation_id, models.Message.SENDER_AGENT, agent_id, message_text
+                    )
+            await apublish_message(subscription.conversation_id, serialize_message(m))
+        MESSAGES.inc(sender_type=models.Message.SENDER_AGENT, transport='websocket')
+
+    async def replay(self, subscription, content):
+        entries = await load_missed_messages(subscription.conversation_id, content)
+        messages = [
+            entry['message'] for entry in entries
+            if self.is_recipient(entry) and not seen_before(subscription.recent_message_ids, entry['message']['id'])
+        ]
+        if messages:
+            await self.send_frame(
+                {'type': 'replay', 'conversation_id': subscription.conversation_id, 'messages': messages},
+                KIND_MESSAGE,
+            )
+
+    def is_recipient(self, event):
+        roles = event.get('roles')
+        return not roles or models.Message.SENDER_AGENT in roles
+
+    def subscription_for(self, event):
+        # System messages sent by services.assignment only carry the id inside the message
+        conversation_id = event.get('conversation_id') or event.get('message', {}).get('conversation')
+        subscription = self.subscriptions.get(conversation_id)
+        if subscription is None or not self.is_recipient(event):
+            return None
+        return subscription
+
+    async def chat_message(self, event):
+        subscription = self.subscription_for(event)
+        if subscription is None or seen_before(subscription.recent_message_ids, event['message']['id']):
+            return
+        observe_latency(event)
+        await self.send_frame({
+            'type': 'message',
+            'conversation_id': subscription.conversation_id,
+            'payload': event['message'],
+        }, KIND_MESSAGE)
+
+    async def conversation_closed(self, event):
+        subscription = self.subscription_for(event)
+        if subscription is not None:
+            await self.send_frame(
+                {'type': 'conversation_closed', 'conversation_id': subscription.conversation_id}, KIND_MESSAGE
+            )
+
+    async def typing_indicator(self, event):
+        subscription = self.subscription_for(event)
+        if subscription is not None:
+            await self.send_frame({
+                'type': 'typing',
+                'conversation_id': subscription.conversation_id,
+                'sender_type': event['sender_type'],
+                'typing': event['typing'],
+            }, KIND_TRANSIENT, f'typing:{subscription.conversation_id}')
+
+    async def visitor_presence(self, event):
+        subscription = self.subscription_for(event)
+        if subscription is not None:
+            await self.send_frame({
+                'type': 'visitor_presence',
+                'conversation_id': subscription.conversation_id,
+                'state': event['state'],
+            }, KIND_TRANSIENT, f'visitor_presence:{subscription.conversation_id}')
 
+    async def agent_presence(self, event):
+        # Conversation groups relay agent presence to visitors only; the
+        # queue's presence events carry no conversation
+        if 'conversation_id' not in event:
+            await super().agent_presence(event)
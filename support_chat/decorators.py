@@ -1,10 +1,30 @@
+import math
 from functools import wraps
+from asgiref.sync import iscoroutinefunction
+from django.http import JsonResponse
 from django.shortcuts import redirect
-from .services.auth import get_agent_from_session
+from .services.auth import aget_agent_from_session, get_agent_from_session
+from .services.ratelimit import get_rate_limiter, request_key
 
 
 def agent_login_required(view_func):
-    """Decorator to require agent authentication via session cookie."""
+    """Decorator to require agent authentication via session cookie.
+
+    Works with both sync and async views; async views authenticate without
+    leaving the event loop when the session is cached.
+    """
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            token = request.COOKIES.get('agent_session_token')
+            if token:
+                agent = await aget_agent_from_session(token)
+                if agent:
+                    request.agent = agent
+                    return await view_func(request, *args, **kwargs)
+            return redirect('support_chat:agent_login')
+        return async_wrapper
+
     @wraps(view_func)
     def wrapper(request, *args, **kwargs):
         token = request.COOKIES.get('agent_session_token')
@@ -15,3 +35,39 @@ def agent_login_required(view_func):
                 return view_func(request, *args, **kwargs)
         return redirect('support_chat:agent_login')
     return wrapper
+
+
+def _throttled_response(retry_after):
+    wait = max(1, math.ceil(retry_after))
+    response = JsonResponse({'ok': False, 'error': 'Too many requests', 'retry_after': wait}, status=429)
+    response['Retry-After'] = str(wait)
+    return response
+
+
+def rate_limit(scope, keys=('ip',)):
+    """Decorator applying the RATE_LIMITS rules ``'<scope>:<key>'`` to a view.
+
+    ``keys`` are 'ip', 'email' and/or 'conversation' (read from the JSON
+    body). Throttled requests get a 429 before the view touches the database.
+    """
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                checks = [(f'{scope}:{key}', request_key(request, key)) for key in keys]
+                retry_after = await get_rate_limiter().acheck_all(checks)
+                if retry_after is not None:
+                    return _throttled_response(retry_after)
+                return await view_func(request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            limiter = get_rate_limiter()
+            waits = [limiter.check(f'{scope}:{key}', request_key(request, key)) for key in keys]
+            waits = [wait for wait in waits if wait is not None]
+            if waits:
+                return _throttled_response(waits[0])
+            return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
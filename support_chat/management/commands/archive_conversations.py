@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from support_chat.services.archive import archive_conversations
+from support_chat.services.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Archive the messages of old closed conversations to compressed JSONL files and delete them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help='Archive conversations that ended more than this many days ago (default: ARCHIVE_AFTER_DAYS).',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Conversations per archive file (default: ARCHIVE_CHUNK_SIZE).',
+        )
+        parser.add_argument('--limit', type=int, default=None, help='Archive at most this many conversations.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be archived.')
+
+    def handle(self, *args, **options):
+        stats = archive_conversations(
+            older_than_days=options['days'],
+            chunk_size=options['chunk_size'],
+            limit=options['limit'],
+            dry_run=options['dry_run'],
+        )
+        if options['dry_run']:
+            self.stdout.write(
+                f"Would archive {stats['conversations']} conversations ({stats['messages']} messages)."
+            )
+            return
+        for name in stats['files']:
+            self.stdout.write(f'Wrote {name}')
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {stats['conversations']} conversations ({stats['messages']} messages, "
+            f"{stats['deleted']} rows deleted)."
+        ))
+        backend = get_search_backend()
+        if stats['conversations'] and backend is not None:
+            # Drops the archived messages from the search index
+            backend.rebuild()
+            self.stdout.write('Search index rebuilt.')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from support_chat.services.assets import asset_dir, brotli, build_assets
+
+
+class Command(BaseCommand):
+    help = 'Build the minified, content-hashed and precompressed widget bundles into WIDGET_ASSET_DIR.'
+
+    def handle(self, *args, **options):
+        manifest = build_assets()
+        for name, hashed in manifest.items():
+            self.stdout.write(f"{name} -> {asset_dir()}/{hashed}")
+        if brotli is None:
+            self.stdout.write('brotli is not installed; only gzip variants were written.')
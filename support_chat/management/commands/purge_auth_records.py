@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from support_chat.services.auth import purge_auth_records
+
+
+class Command(BaseCommand):
+    help = 'Delete expired agent OTPs and stale agent sessions in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Rows per delete (default: AUTH_PURGE_BATCH_SIZE).',
+        )
+
+    def handle(self, *args, **options):
+        stats = purge_auth_records(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {stats['otps']} OTPs and {stats['sessions']} sessions."
+        ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from support_chat.services.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the agent search index from the conversations and messages in the database.'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        if backend is None:
+            raise CommandError('SEARCH_BACKEND is not set.')
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt.'))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from support_chat.services.otp import get_otp_outbox
+from support_chat.settings import get_setting
+
+
+class Command(BaseCommand):
+    help = 'Send queued agent OTP emails (for deployments that set OTP_OUTBOX_THREAD to False).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running, polling the outbox every --interval seconds.',
+        )
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls with --loop.')
+
+    def handle(self, *args, **options):
+        outbox = get_otp_outbox()
+        try:
+            while True:
+                failed = outbox.send_pending()
+                if failed:
+                    self.stderr.write(f'{failed} OTP emails failed and will be retried.')
+                if not options['loop']:
+                    return
+                time.sleep(get_setting('OTP_RETRY_INTERVAL') if failed else options['interval'])
+        finally:
+            outbox.close()
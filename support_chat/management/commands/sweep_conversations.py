@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from support_chat.services.lifecycle import sweep_conversations
+from support_chat.settings import get_setting
+
+
+class Command(BaseCommand):
+    help = 'Abandon stale waiting conversations and close those past MAX_CONVERSATION_TIME.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running, sweeping every CONVERSATION_SWEEP_INTERVAL seconds.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            stats = sweep_conversations(force=True)
+            self.stdout.write(f"Abandoned {stats['abandoned']} and closed {stats['closed']} conversations.")
+            if not options['loop']:
+                return
+            time.sleep(get_setting('CONVERSATION_SWEEP_INTERVAL'))
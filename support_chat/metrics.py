@@ -0,0 +1,236 @@
+"""Per-process metrics in the Prometheus text format.
+
+Counters, gauges and histograms are updated on the hot paths without locks
+or I/O: every thread writes to its own shard and the shards are only summed
+when the metrics endpoint is scraped. Values are per worker process, so
+scrape every worker (or add a ``process`` label in your scrape config).
+"""
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """Base class: a named metric with fixed label names and per-thread shards."""
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._shards = []
+        self._local = threading.local()
+        registry.register(self)
+
+    def _shard(self):
+        shard = getattr(self._local, 'values', None)
+        if shard is None:
+            shard = self._local.values = {}
+            # list.append is atomic; scrapes may see the shard a moment late
+            self._shards.append(shard)
+        return shard
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _merged(self):
+        merged = {}
+        for shard in list(self._shards):
+            for key, value in shard.copy().items():
+                merged[key] = self._combine(merged.get(key), value)
+        return merged
+
+    def _combine(self, total, value):
+        return value if total is None else total + value
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        return [(self.name, self._label_text(key), value) for key, value in sorted(self._merged().items())]
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{labels} {_format(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._merged().get(self._key(labels), 0)
+
+    def values(self):
+        """Return ``{label values: total}`` across threads."""
+        return self._merged()
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is computed by a callback at scrape time."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        try:
+            values = self.callback()
+        except Exception:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, self._label_text(key), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, plus their sum and count."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        state = shard.get(key)
+        if state is None:
+            # Per-bucket counts (the last one is +Inf), then sum
+            state = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _combine(self, total, value):
+        value = list(value)
+        if total is None:
+            return value
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self):
+        samples = []
+        for key, state in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else _format(bound)
+                samples.append((f'{self.name}_bucket', self._label_text(key, [('le', le)]), cumulative))
+            samples.append((f'{self.name}_sum', self._label_text(key), state[-1]))
+            samples.append((f'{self.name}_count', self._label_text(key), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Duplicate metric {metric.name}')
+        self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def expose(self):
+        """Return every metric in the Prometheus text exposition format."""
+        return '\n'.join(metric.expose() for metric in self._metrics.values()) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+
+
+def _queue_depth():
+    # Evaluated per scrape only, through the (status, queue_shard, ...) index
+    from django.db.models import Count
+    from . import models
+
+    rows = (
+        models.Conversation.objects
+        .filter(status=models.Conversation.STATUS_WAITING)
+        .values('queue_shard')
+        .annotate(n=Count('id'))
+    )
+    return {(row['queue_shard'],): row['n'] for row in rows}
+
+
+MESSAGES = Counter('support_chat_messages_total', 'Chat messages accepted.', ['sender_type', 'transport'])
+MESSAGE_HANDLE_SECONDS = Histogram(
+    'support_chat_message_handle_seconds',
+    'Time for a conversation socket to store and publish a message frame.',
+)
+DB_SECONDS = Histogram('support_chat_db_seconds', 'Database time of hot-path operations.', ['operation'])
+CHANNEL_LAYER_SECONDS = Histogram(
+    'support_chat_channel_layer_seconds',
+    'Time from publishing an event on the channel layer to a consumer receiving it.',
+    ['event'],
+)
+QUEUE_EVENTS = Counter('support_chat_queue_events_total', 'Queue events published.', ['event'])
+QUEUE_DELIVERIES = Counter('support_chat_queue_deliveries_total', 'Queue events sent to agent sockets.', ['event'])
+QUEUE_DEPTH = Gauge('support_chat_queue_depth', 'Conversations waiting for an agent.', ['shard'], callback=_queue_depth)
+ASSIGNMENTS = Counter('support_chat_assignments_total', 'Assignment attempts.', ['result'])
+TIME_TO_ASSIGN = Histogram(
+    'support_chat_time_to_assign_seconds',
+    'Time from a conversation starting to it being assigned.',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+CONNECTIONS = Gauge('support_chat_connections', 'Open WebSocket connections.', ['consumer'])
+OUTBOUND_FRAMES = Gauge('support_chat_outbound_frames', 'Frames waiting in socket send queues.', ['consumer'])
+OUTBOUND_DROPPED = Counter(
+    'support_chat_outbound_dropped_total',
+    'Frames dropped from socket send queues (reason: drop_oldest, coalesce or disconnect).',
+    ['consumer', 'reason'],
+)
+AUTH_REQUESTS = Counter('support_chat_auth_total', 'Agent authentication events.', ['event', 'result'])
+RATE_LIMITED = Counter('support_chat_rate_limited_total', 'Requests and frames rejected by rate limits.', ['rule'])
@@ -0,0 +1,43 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.http.cookie import parse_cookie
+
+from .services.auth import get_agent_from_session, get_conversation_from_visitor_token
+
+
+class SupportChatAuthMiddleware(BaseMiddleware):
+    """Resolve who is connecting to a support chat socket, once per connection.
+
+    Adds to the scope:
+        support_agent: the SupportAgent for the ``agent_session_token``
+            cookie, or None
+        visitor_conversation_id: the conversation a signed visitor token
+            (``?token=...``) was issued for, or None
+
+    Consumers authorize against these at connect time and keep the result
+    for the life of the socket, so frames are validated without queries.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+
+        cookies = {}
+        for name, value in scope.get('headers', []):
+            if name == b'cookie':
+                cookies = parse_cookie(value.decode('latin1'))
+                break
+        session_token = cookies.get('agent_session_token')
+        scope['support_agent'] = (
+            await database_sync_to_async(get_agent_from_session)(session_token)
+            if session_token else None
+        )
+
+        query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+        visitor_token = query.get('token', [None])[0]
+        scope['visitor_conversation_id'] = (
+            get_conversation_from_visitor_token(visitor_token) if visitor_token else None
+        )
+
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # Only PostgreSQL has the full-text search used by DatabaseSearchBackend
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('support_chat', 'Message')._meta.db_table)
+    schema_editor.execute(
+        f"CREATE INDEX IF NOT EXISTS sc_message_fts_idx ON {table} USING gin (to_tsvector('simple', message))"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS sc_message_fts_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support_chat', '0006_conversation_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,24 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support_chat', '0007_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='previous_conversation',
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+', to='support_chat.conversation',
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['visitor', '-started_at'], name='sc_conv_visitor_idx'),
+        ),
+    ]
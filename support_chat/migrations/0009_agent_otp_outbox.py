@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support_chat', '0008_conversation_previous'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='agentotp',
+            options={},
+        ),
+        migrations.AlterField(
+            model_name='agentotp',
+            name='email',
+            field=models.EmailField(max_length=254),
+        ),
+        migrations.AddField(
+            model_name='agentotp',
+            name='sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='agentotp',
+            index=models.Index(fields=['email', '-created_at'], name='sc_otp_latest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='agentotp',
+            index=models.Index(fields=['created_at'], name='sc_otp_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='agentsession',
+            index=models.Index(fields=['last_activity'], name='sc_session_activity_idx'),
+        ),
+    ]
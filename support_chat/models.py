@@ -58,6 +58,23 @@ class Conversation(models.Model):
     ended_at = models.DateTimeField(null=True, blank=True)
     rating = models.PositiveSmallIntegerField(null=True, blank=True)
     feedback = models.TextField(blank=True)
+    # Queue partition chosen by the group strategy when the conversation starts
+    queue_shard = models.CharField(max_length=64, blank=True, default='')
+    # Set once the messages have been moved to cold storage (services/archive.py)
+    archive_name = models.CharField(max_length=255, blank=True, default='')
+    archived_at = models.DateTimeField(null=True, blank=True)
+    # The visitor's conversation before this one, when they came back
+    previous_conversation = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'queue_shard', 'started_at'], name='sc_conv_queue_idx'),
+            models.Index(fields=['visitor', '-started_at'], name='sc_conv_visitor_idx'),
+            # Stale conversations for services/lifecycle.py, across all shards
+            models.Index(fields=['status', 'started_at'], name='sc_conv_status_started_idx'),
+        ]
 
     def __str__(self):
         return f"Conversation {self.id} ({self.status})"
@@ -79,10 +96,16 @@ class Message(models.Model):
     sender_type = models.CharField(max_length=10, choices=SENDER_TYPE)
     sender_id = models.UUIDField(null=True, blank=True)
     message = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Explicit default (not auto_now_add) so write-behind persistence can keep
+    # the timestamp that was assigned and broadcast in memory.
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
+    # No default ordering: sorting is requested explicitly where it matters,
+    # so unqualified queries never sort the whole table
     class Meta:
-        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['conversation', 'created_at'], name='sc_message_conv_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.sender_type}: {self.message[:50]}"
@@ -100,17 +123,28 @@ class ConversationRating(models.Model):
 
 
 class AgentOTP(models.Model):
-    email = models.EmailField(db_index=True)
+    LIFETIME = timedelta(minutes=10)
+
+    email = models.EmailField()
     otp = models.CharField(max_length=6)
     created_at = models.DateTimeField(auto_now_add=True)
     is_verified = models.BooleanField(default=False)
     attempts = models.PositiveIntegerField(default=0)
+    # Null while the email waits in the outbox (services/otp.py)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    # Set while a sender is delivering the email
+    claimed_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
-        ordering = ['-created_at']
+        indexes = [
+            # Latest OTP per email; also serves lookups by email alone
+            models.Index(fields=['email', '-created_at'], name='sc_otp_latest_idx'),
+            # Outbox scans and the purge job
+            models.Index(fields=['created_at'], name='sc_otp_created_idx'),
+        ]
 
     def is_expired(self):
-        return timezone.now() > self.created_at + timedelta(minutes=10)
+        return timezone.now() > self.created_at + self.LIFETIME
 
     def __str__(self):
         return f"OTP for {self.email}"
@@ -126,6 +160,11 @@ class AgentSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     last_activity = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_activity'], name='sc_session_activity_idx'),
+        ]
+
     def is_valid(self):
         return timezone.now() < self.last_activity + timedelta(hours=24)
 
@@ -0,0 +1,176 @@
+"""WebSocket frame encodings, negotiated through the Sec-WebSocket-Protocol header.
+
+- ``support_chat.v1`` (also used when a client offers no subprotocol): the
+  verbose JSON frames, e.g. ``{"type": "message", "payload": {...}}``.
+- ``support_chat.v2.json``: the same frames with short keys and type codes,
+  epoch-millisecond timestamps and without server-internal fields.
+- ``support_chat.v2.msgpack``: the compact frames as binary MessagePack;
+  only offered when the optional ``msgpack`` package is installed.
+
+Compact frames keep a fixed key order, which also helps permessage-deflate
+when the ASGI server has it enabled. ``static/support_chat/js/protocol.js``
+mirrors the tables below.
+"""
+import json
+from datetime import datetime
+
+from .settings import get_setting
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+V1 = 'support_chat.v1'
+V2_JSON = 'support_chat.v2.json'
+V2_MSGPACK = 'support_chat.v2.msgpack'
+
+KEYS = {
+    'type': 't',
+    'payload': 'p',
+    'message': 'm',
+    'id': 'i',
+    'conversation': 'cv',
+    'conversation_id': 'c',
+    'sender_type': 's',
+    'sender_id': 'u',
+    'created_at': 'ts',
+    'seq': 'q',
+    'last_seq': 'lq',
+    'visitor_name': 'n',
+    'visitor_email': 'e',
+    'agent_id': 'a',
+    'agent_name': 'an',
+    'typing': 'ty',
+    'state': 'st',
+    'online': 'o',
+    'waiting': 'w',
+    'status': 'x',
+    'retry_after': 'ra',
+    'messages': 'ms',
+    'last_id': 'li',
+    'since': 'sn',
+    'conversation_ids': 'cs',
+}
+TYPES = {
+    'message': 'm',
+    'typing': 'ty',
+    'activity': 'ac',
+    'close_conversation': 'cl',
+    'resume': 'r',
+    'conversation_closed': 'cc',
+    'visitor_presence': 'vp',
+    'agent_presence': 'ap',
+    'rate_limited': 'rl',
+    'new_conversation': 'nc',
+    'conversation_accepted': 'ca',
+    'queue_snapshot': 'qs',
+    'agent_assigned': 'aa',
+    'replay': 'rp',
+    'conversations_removed': 'cr',
+    'subscribe': 'sb',
+    'unsubscribe': 'us',
+    'subscribed': 'sd',
+    'unsubscribed': 'ud',
+}
+SENDERS = {'visitor': 'v', 'agent': 'a', 'system': 's'}
+TIMESTAMP_KEYS = frozenset({'created_at'})
+# Channel-layer bookkeeping that v1 frames happen to carry
+INTERNAL_KEYS = frozenset({'shard', 'sent_at', 'roles'})
+
+LONG_KEYS = {short: key for key, short in KEYS.items()}
+LONG_TYPES = {short: name for name, short in TYPES.items()}
+LONG_SENDERS = {short: name for name, short in SENDERS.items()}
+
+
+def _epoch_ms(value):
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        return value
+
+
+def compact(frame):
+    """Return the v2 form of a verbose frame."""
+    out = {}
+    for key, value in frame.items():
+        if key in INTERNAL_KEYS:
+            continue
+        if key == 'type':
+            value = TYPES.get(value, value)
+        elif key == 'sender_type':
+            value = SENDERS.get(value, value)
+        elif key in TIMESTAMP_KEYS and isinstance(value, str):
+            value = _epoch_ms(value)
+        elif isinstance(value, dict):
+            value = compact(value)
+        elif isinstance(value, list):
+            value = [compact(item) if isinstance(item, dict) else item for item in value]
+        out[KEYS.get(key, key)] = value
+    return out
+
+
+def expand(frame):
+    """Return the verbose form of a compact frame sent by a client."""
+    out = {}
+    for short, value in frame.items():
+        key = LONG_KEYS.get(short, short)
+        if key == 'type':
+            value = LONG_TYPES.get(value, value)
+        elif key == 'sender_type':
+            value = LONG_SENDERS.get(value, value)
+        elif isinstance(value, dict):
+            value = expand(value)
+        out[key] = value
+    return out
+
+
+class Protocol:
+    """One frame encoding; ``compact`` frames use the v2 tables."""
+
+    def __init__(self, name, compact=False, binary=False):
+        self.name = name
+        self.compact = compact
+        self.binary = binary
+
+    def encode(self, frame):
+        """Return ``(text_data, bytes_data)`` for a frame."""
+        if not self.compact:
+            return json.dumps(frame), None
+        frame = compact(frame)
+        if self.binary:
+            return None, msgpack.packb(frame)
+        return json.dumps(frame, ensure_ascii=False, separators=(',', ':')), None
+
+    def decode(self, text_data=None, bytes_data=None):
+        """Parse a client frame into its verbose form; raises ValueError."""
+        if text_data is not None:
+            frame = json.loads(text_data)
+        elif self.binary and bytes_data is not None:
+            frame = msgpack.unpackb(bytes_data)
+        else:
+            raise ValueError(f'Unexpected frame for {self.name}')
+        if not isinstance(frame, dict):
+            raise ValueError('Frames must be objects')
+        return expand(frame) if self.compact else frame
+
+
+PROTOCOLS = {
+    V1: Protocol(V1),
+    V2_JSON: Protocol(V2_JSON, compact=True),
+}
+if msgpack is not None:
+    PROTOCOLS[V2_MSGPACK] = Protocol(V2_MSGPACK, compact=True, binary=True)
+
+
+def negotiate(offered):
+    """Pick the first subprotocol the client offered that is enabled here.
+
+    Returns ``(protocol, subprotocol to accept)``; the subprotocol is None
+    when the client offered none we speak, and v1 frames are used.
+    """
+    enabled = get_setting('WS_COMPACT_PROTOCOLS')
+    for name in offered:
+        if name in PROTOCOLS and (name == V1 or name in enabled):
+            return PROTOCOLS[name], name
+    return PROTOCOLS[V1], None
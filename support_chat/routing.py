@@ -1,9 +1,41 @@
+import logging
+
 from django.urls import re_path
 from . import consumers
+from .middleware import SupportChatAuthMiddleware
+from .services.messages import drain_write_buffer
+
+logger = logging.getLogger(__name__)
 
-# WebSocket URL patterns - Channels passes path WITHOUT leading slash
+# WebSocket URL patterns - Channels passes path WITHOUT leading slash.
+# Every consumer is wrapped so the connecting agent/visitor is resolved once.
 websocket_urlpatterns = [
-    re_path(r'^ws/support/queue/?$', consumers.QueueConsumer.as_asgi()),
-    re_path(r'^ws/support/agent/(?P<agent_id>[^/]+)/?$', consumers.AgentConsumer.as_asgi()),
-    re_path(r'^ws/support/conversation/(?P<conversation_id>[^/]+)/?$', consumers.ConversationConsumer.as_asgi()),
+    re_path(r'^ws/support/queue/?$', SupportChatAuthMiddleware(consumers.QueueConsumer.as_asgi())),
+    re_path(r'^ws/support/agent/(?P<agent_id>[^/]+)/?$', SupportChatAuthMiddleware(consumers.AgentConsumer.as_asgi())),
+    re_path(r'^ws/support/agent/(?P<agent_id>[^/]+)/multiplex/?$', SupportChatAuthMiddleware(consumers.AgentMultiplexConsumer.as_asgi())),
+    re_path(r'^ws/support/conversation/(?P<conversation_id>[^/]+)/?$', SupportChatAuthMiddleware(consumers.ConversationConsumer.as_asgi())),
 ]
+
+
+class SupportChatLifespan:
+    """ASGI ``lifespan`` application that writes buffered messages on shutdown.
+
+    Route the ``lifespan`` scope to it in ProtocolTypeRouter. Servers that
+    implement lifespan (uvicorn, hypercorn) wait for the write-behind buffer
+    to be drained before the worker exits.
+    """
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await drain_write_buffer()
+                except Exception as exc:
+                    logger.exception('Draining the message write buffer on shutdown failed')
+                    await send({'type': 'lifespan.shutdown.failed', 'message': str(exc)})
+                else:
+                    await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,201 @@
+import gzip
+import json
+import logging
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .. import models
+from ..settings import get_path_setting, get_setting
+
+logger = logging.getLogger(__name__)
+
+ARCHIVABLE_STATUSES = (models.Conversation.STATUS_CLOSED, models.Conversation.STATUS_ABANDONED)
+
+# Archive files are assembled on disk once they outgrow this many bytes
+SPOOL_SIZE = 8 * 1024 * 1024
+
+MESSAGE_FIELDS = ('id', 'conversation_id', 'sender_type', 'sender_id', 'message', 'created_at')
+
+
+def get_archive_storage():
+    """Return the storage archive files are written to (ARCHIVE_STORAGE alias or ARCHIVE_DIR)."""
+    alias = get_setting('ARCHIVE_STORAGE')
+    if alias:
+        return storages[alias]
+    return FileSystemStorage(location=get_path_setting('ARCHIVE_DIR', 'support_chat_archive'))
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def _conversation_record(conversation, messages):
+    # 'id' must stay the first key; readers match lines on that prefix
+    rating = getattr(conversation, 'rating_obj', None)
+    return {
+        'id': str(conversation.id),
+        'visitor': {
+            'id': str(conversation.visitor_id),
+            'name': conversation.visitor.name,
+            'email': conversation.visitor.email,
+        },
+        'assigned_agent_id': str(conversation.assigned_agent_id) if conversation.assigned_agent_id else None,
+        'status': conversation.status,
+        'queue_shard': conversation.queue_shard,
+        'started_at': _isoformat(conversation.started_at),
+        'assigned_at': _isoformat(conversation.assigned_at),
+        'ended_at': _isoformat(conversation.ended_at),
+        'rating': conversation.rating,
+        'feedback': conversation.feedback,
+        'review': {
+            'agent_rating': rating.agent_rating,
+            'system_rating': rating.system_rating,
+            'comment': rating.comment,
+        } if rating else None,
+        'messages': [
+            {
+                'id': str(m['id']),
+                'sender_type': m['sender_type'],
+                'sender_id': str(m['sender_id']) if m['sender_id'] else None,
+                'message': m['message'],
+                'created_at': m['created_at'].isoformat(),
+            }
+            for m in messages
+        ],
+    }
+
+
+def _archivable(cutoff):
+    return models.Conversation.objects.filter(
+        Q(ended_at__lt=cutoff) | Q(ended_at__isnull=True, started_at__lt=cutoff),
+        status__in=ARCHIVABLE_STATUSES,
+        archived_at__isnull=True,
+    )
+
+
+def _write_chunk(conversations, storage):
+    """Stream one chunk of conversations and their messages into a gzip JSONL file."""
+    ids = [c.id for c in conversations]
+    # Both sides come back in the database's id order, so one pass over the
+    # message cursor pairs every conversation with its messages
+    rows = (
+        models.Message.objects
+        .filter(conversation_id__in=ids)
+        .order_by('conversation_id', 'created_at', 'id')
+        .values(*MESSAGE_FIELDS)
+        .iterator(chunk_size=get_setting('ARCHIVE_DELETE_BATCH_SIZE'))
+    )
+    pending = next(rows, None)
+    count = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+        with gzip.GzipFile(fileobj=spool, mode='wb') as gz:
+            for conversation in conversations:
+                messages = []
+                while pending is not None and pending['conversation_id'] == conversation.id:
+                    messages.append(pending)
+                    pending = next(rows, None)
+                count += len(messages)
+                line = json.dumps(_conversation_record(conversation, messages), ensure_ascii=False)
+                gz.write(line.encode('utf-8') + b'\n')
+        spool.seek(0)
+        now = timezone.now()
+        name = 'support_chat/{:%Y/%m}/{:%Y%m%dT%H%M%S}-{}.jsonl.gz'.format(now, now, conversations[0].id)
+        return storage.save(name, File(spool, name=name)), count
+
+
+def _delete_messages(filter_q):
+    """Delete messages matching filter_q in ARCHIVE_DELETE_BATCH_SIZE batches."""
+    batch_size = get_setting('ARCHIVE_DELETE_BATCH_SIZE')
+    deleted = 0
+    while True:
+        pks = list(models.Message.objects.filter(filter_q).values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        with transaction.atomic():
+            deleted += models.Message.objects.filter(pk__in=pks).delete()[0]
+
+
+def archive_conversations(older_than_days=None, chunk_size=None, limit=None, dry_run=False):
+    """Move ended conversations' messages out of the database into archive files.
+
+    Closed and abandoned conversations that ended more than
+    ``older_than_days`` (ARCHIVE_AFTER_DAYS) ago are written, ``chunk_size``
+    (ARCHIVE_CHUNK_SIZE) per file, to gzip-compressed JSON Lines in the
+    archive storage: one line per conversation with its visitor, rating and
+    messages. The conversation row is kept as a small tombstone pointing at
+    the file and its messages are deleted in batches, so history stays
+    readable through load_archived_messages(). Safe to run repeatedly, e.g.
+    from cron; returns a dict of counters.
+    """
+    days = get_setting('ARCHIVE_AFTER_DAYS') if older_than_days is None else older_than_days
+    chunk_size = chunk_size or get_setting('ARCHIVE_CHUNK_SIZE')
+    cutoff = timezone.now() - timedelta(days=days)
+    stats = {'conversations': 0, 'messages': 0, 'deleted': 0, 'files': []}
+
+    if dry_run:
+        qs = _archivable(cutoff)
+        stats['conversations'] = qs.count() if limit is None else min(qs.count(), limit)
+        stats['messages'] = models.Message.objects.filter(conversation__in=qs.values('id')).count()
+        return stats
+
+    storage = get_archive_storage()
+    # Finish deletions left behind by an interrupted run
+    stats['deleted'] += _delete_messages(Q(conversation__archived_at__isnull=False))
+
+    while limit is None or stats['conversations'] < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - stats['conversations'])
+        conversations = list(
+            _archivable(cutoff)
+            .select_related('visitor', 'rating_obj')
+            .order_by('id')[:size]
+        )
+        if not conversations:
+            break
+        name, count = _write_chunk(conversations, storage)
+        ids = [c.id for c in conversations]
+        models.Conversation.objects.filter(id__in=ids).update(archive_name=name, archived_at=timezone.now())
+        stats['deleted'] += _delete_messages(Q(conversation_id__in=ids))
+        stats['conversations'] += len(conversations)
+        stats['messages'] += count
+        stats['files'].append(name)
+        logger.info('Archived %d conversations (%d messages) to %s', len(conversations), count, name)
+    return stats
+
+
+def load_archived_messages(conversation):
+    """Return the archived messages of a conversation as unsaved Message objects.
+
+    The conversation's line is read from its archive file once and then
+    served from the cache for ARCHIVE_CACHE_TTL seconds.
+    """
+    key = f'support_chat:archive:{conversation.id}'
+    rows = cache.get(key)
+    if rows is None:
+        rows = []
+        prefix = json.dumps({'id': str(conversation.id)})[:-1]
+        with get_archive_storage().open(conversation.archive_name, 'rb') as fh:
+            with gzip.GzipFile(fileobj=fh) as lines:
+                for line in lines:
+                    if line.startswith(prefix.encode('utf-8')):
+                        rows = json.loads(line)['messages']
+                        break
+        cache.set(key, rows, get_setting('ARCHIVE_CACHE_TTL'))
+    return [
+        models.Message(
+            id=uuid.UUID(row['id']),
+            conversation_id=conversation.id,
+            sender_type=row['sender_type'],
+            sender_id=uuid.UUID(row['sender_id']) if row['sender_id'] else None,
+            message=row['message'],
+            created_at=datetime.fromisoformat(row['created_at']),
+        )
+        for row in rows
+    ]
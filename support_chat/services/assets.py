@@ -0,0 +1,194 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+from django.urls import reverse
+
+from ..settings import get_path_setting
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:  # optional dependency
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:  # optional dependency
+    rcssmin = None
+
+MANIFEST_NAME = 'manifest.json'
+HASHED_NAME = re.compile(r'^(loader|widget)\.[0-9a-f]{12}\.(js|css)$')
+
+# Built asset -> static files it is made of, in order
+BUNDLES = {
+    'loader.js': ['support_chat/js/loader.js'],
+    'widget.js': ['support_chat/js/protocol.js', 'support_chat/js/widget.js'],
+    'widget.css': ['support_chat/css/widget.css'],
+}
+
+# Not looked up yet; None once the lookup found no build
+_UNKNOWN = object()
+
+_manifest = _UNKNOWN
+_assets = {}
+
+
+def asset_dir():
+    """Return the absolute WIDGET_ASSET_DIR."""
+    return get_path_setting('WIDGET_ASSET_DIR', 'support_chat_assets')
+
+
+def minify_js(source):
+    if rjsmin is not None:
+        return rjsmin.jsmin(source)
+    # Without rjsmin only drop what is certainly safe to drop: indentation,
+    # blank lines and whole-line comments. Line breaks stay for ASI.
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//')) + '\n'
+
+
+def minify_css(source):
+    if rcssmin is not None:
+        return rcssmin.cssmin(source)
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,])\s*', r'\1', source)
+    source = re.sub(r':\s+', ':', source)
+    return source.replace(';}', '}').strip() + '\n'
+
+
+def _read_source(path):
+    found = finders.find(path)
+    if found is None:
+        raise FileNotFoundError(f'Static file {path} not found')
+    with open(found, encoding='utf-8') as f:
+        return f.read()
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build_assets(output_dir=None):
+    """Minify, content-hash and precompress the widget bundles.
+
+    Writes ``<name>.<hash>.<ext>`` plus ``.gz`` (and ``.br`` when the
+    ``brotli`` package is installed) for each bundle into WIDGET_ASSET_DIR,
+    then the manifest mapping bundle names to hashed file names. Files from
+    earlier builds are left in place for pages that still reference them.
+    Returns the manifest.
+    """
+    global _manifest
+    output_dir = output_dir or asset_dir()
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        minify = minify_css if name.endswith('.css') else minify_js
+        data = ''.join(minify(_read_source(path)) for path in sources).encode('utf-8')
+        stem, ext = os.path.splitext(name)
+        hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        path = os.path.join(output_dir, hashed)
+        _write(path, data)
+        _write(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(path + '.br', brotli.compress(data, mode=brotli.MODE_TEXT))
+        manifest[name] = hashed
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    _manifest = manifest
+    _assets.clear()
+    return manifest
+
+
+def get_manifest():
+    """Return the manifest of the last build, or None before the first one.
+
+    The result is kept for the life of the process, a missing manifest
+    included, so workers must be restarted after building in another process.
+    """
+    global _manifest
+    if _manifest is _UNKNOWN:
+        try:
+            with open(os.path.join(asset_dir(), MANIFEST_NAME)) as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            _manifest = None
+    return _manifest
+
+
+def widget_urls():
+    """Return the loader, script and stylesheet URLs the widget template uses.
+
+    Built assets are served by the ``widget_asset`` view; before
+    ``build_widget_assets`` has run, the unminified static files are used.
+    """
+    manifest = get_manifest()
+    if manifest is None:
+        return {
+            'loader': static(BUNDLES['loader.js'][0]),
+            'scripts': [static(path) for path in BUNDLES['widget.js']],
+            'css': static(BUNDLES['widget.css'][0]),
+        }
+
+    def url(name):
+        return reverse('support_chat:widget_asset', args=[manifest[name]])
+
+    return {'loader': url('loader.js'), 'scripts': [url('widget.js')], 'css': url('widget.css')}
+
+
+class Asset:
+    """A built file held in memory along with its precompressed variants."""
+
+    def __init__(self, path, digest):
+        self.digest = digest
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/') or self.content_type.endswith('javascript'):
+            self.content_type += '; charset=utf-8'
+        self.bodies = {}
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz'), (None, '')):
+            try:
+                with open(path + suffix, 'rb') as f:
+                    self.bodies[encoding] = f.read()
+            except FileNotFoundError:
+                pass
+
+    def pick(self, accept_encoding):
+        """Return ``(body, content encoding)`` for an Accept-Encoding header."""
+        accepted = set()
+        for part in accept_encoding.split(','):
+            coding, _, params = part.partition(';')
+            try:
+                quality = float(params.strip()[2:]) if params.strip().startswith('q=') else 1
+            except ValueError:
+                quality = 1
+            if quality > 0:
+                accepted.add(coding.strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.bodies:
+                return self.bodies[encoding], encoding
+        return self.bodies[None], None
+
+
+def get_asset(filename):
+    """Return the Asset for a built file name, or None."""
+    asset = _assets.get(filename)
+    if asset is None:
+        # Also serves earlier builds, for pages cached before a deploy
+        if not HASHED_NAME.match(filename):
+            return None
+        path = os.path.join(asset_dir(), filename)
+        if not os.path.exists(path):
+            return None
+        asset = _assets[filename] = Asset(path, filename.rsplit('.', 2)[-2])
+    return asset
@@ -1,16 +1,321 @@
-from django.db import transaction
+import heapq
+import itertools
+import threading
+import time
+import uuid
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.db.models import Count, Q
 from django.utils import timezone
 
+from .. import models
+from ..metrics import ASSIGNMENTS, DB_SECONDS, TIME_TO_ASSIGN
+from ..settings import get_setting
+from .conversations import invalidate_agent
+from .fanout import conversation_group
+from .groups import get_group_strategy
+from .queue import apublish_queue_event, publish_queue_event
+from .replay import remember_message
+
+OPEN_STATUSES = (models.Conversation.STATUS_ASSIGNED, models.Conversation.STATUS_ACTIVE)
 
-def assign_conversation(conversation_qs, agent):
+
+def _record_assignment(updated, assigned_at, started_at):
+    ASSIGNMENTS.inc(result='assigned' if updated == 1 else 'conflict')
+    if updated == 1 and started_at is not None:
+        TIME_TO_ASSIGN.observe((assigned_at - started_at).total_seconds())
+    return updated == 1
+
+
+def assign_conversation(conversation_qs, agent, started_at=None):
     """Attempt to atomically assign a waiting conversation to an agent.
 
     conversation_qs: a queryset filtered to the specific conversation id and status waiting
     agent: SupportAgent instance
+    started_at: the conversation's start time, if known, for the time-to-assign metric
 
     Returns True if assignment succeeded (row updated), False otherwise.
     """
-    updated = conversation_qs.update(
-        status='assigned', assigned_agent=agent, assigned_at=timezone.now()
-    )
-    return updated == 1
+    now = timezone.now()
+    with DB_SECONDS.time(operation='assign_conversation'):
+        updated = conversation_qs.update(status='assigned', assigned_agent=agent, assigned_at=now)
+    return _record_assignment(updated, now, started_at)
+
+
+async def aassign_conversation(conversation_qs, agent, started_at=None):
+    """Async variant of assign_conversation using the async ORM."""
+    now = timezone.now()
+    with DB_SECONDS.time(operation='assign_conversation'):
+        updated = await conversation_qs.aupdate(status='assigned', assigned_agent=agent, assigned_at=now)
+    return _record_assignment(updated, now, started_at)
+
+
+def _assignment_events(conversation_id, agent, visitor=None):
+    conversation_id = str(conversation_id)
+    queue_event = {
+        'type': 'conversation.accepted',
+        'conversation_id': conversation_id,
+        'agent_id': str(agent.id),
+        'agent_name': agent.name,
+    }
+    if visitor is not None:
+        queue_event['visitor_name'] = visitor.name
+        queue_event['visitor_email'] = visitor.email
+    group_events = [
+        (get_group_strategy().agent_group(agent.id), {
+            'type': 'agent_assigned',
+            'conversation_id': conversation_id,
+            'agent_name': agent.name,
+        }),
+        (conversation_group(conversation_id), {
+            'type': 'chat.message',
+            'message': {
+                'id': str(uuid.uuid4()),
+                'conversation': conversation_id,
+                'sender_type': 'system',
+                'sender_id': None,
+                'message': f'Agent {agent.name} has joined the chat.',
+                'created_at': timezone.now().isoformat(),
+            }
+        }),
+    ]
+    return queue_event, group_events
+
+
+def notify_assignment(conversation_id, agent, visitor=None, shard=''):
+    """Tell the queue, the agent and the visitor that a conversation was assigned."""
+    queue_event, group_events = _assignment_events(conversation_id, agent, visitor)
+    publish_queue_event(queue_event, shard)
+    channel_layer = get_channel_layer()
+    for group, event in group_events:
+        if event['type'] == 'chat.message':
+            remember_message(conversation_id, event['message'])
+        async_to_sync(channel_layer.group_send)(group, event)
+
+
+async def anotify_assignment(conversation_id, agent, visitor=None, shard=''):
+    """Async variant of notify_assignment."""
+    queue_event, group_events = _assignment_events(conversation_id, agent, visitor)
+    await apublish_queue_event(queue_event, shard)
+    channel_layer = get_channel_layer()
+    for group, event in group_events:
+        if event['type'] == 'chat.message':
+            await sync_to_async(remember_message)(conversation_id, event['message'])
+        await channel_layer.group_send(group, event)
+
+
+class AssignmentEngine:
+    """Routes waiting conversations to the least-loaded online agent.
+
+    Online agents live in one max-heap per queue shard they serve, keyed by
+    free capacity (max_concurrent_chats minus open conversations), so
+    choosing an agent is O(log n). Capacity changes push fresh heap entries
+    and stale entries are skipped when popped. The heap is rebuilt from the database on first use
+    and every AUTO_ASSIGN_RECONCILE_INTERVAL seconds, which also corrects
+    drift caused by assignments made in other processes. The conditional
+    UPDATE in assign_conversation remains the commit step, so two routers can
+    never assign the same conversation.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._heaps = {}
+        self._agents = {}
+        self._counter = itertools.count()
+        self._reconciled_at = None
+
+    def reconcile(self):
+        """Rebuild capacities from online, active agents and their open chats."""
+        agents = models.SupportAgent.objects.filter(is_active=True, is_online=True).annotate(
+            open_chats=Count('conversations', filter=Q(conversations__status__in=OPEN_STATUSES))
+        )
+        strategy = get_group_strategy()
+        with self._lock:
+            self._heaps = {}
+            self._agents = {}
+            for agent in agents:
+                self._set(agent, agent.max_concurrent_chats - agent.open_chats, strategy.agent_shards(agent))
+            self._reconciled_at = time.monotonic()
+
+    def _ensure_reconciled(self):
+        interval = get_setting('AUTO_ASSIGN_RECONCILE_INTERVAL')
+        if self._reconciled_at is None or time.monotonic() - self._reconciled_at > interval:
+            self.reconcile()
+
+    def _set(self, agent, free, shards):
+        version = next(self._counter)
+        self._agents[agent.id] = {'agent': agent, 'free': free, 'version': version, 'shards': shards}
+        for shard in shards:
+            heapq.heappush(self._heaps.setdefault(shard, []), [-free, version, agent.id])
+
+    def _pop_best(self, shard):
+        heap = self._heaps.get(shard, [])
+        while heap:
+            entry = heapq.heappop(heap)
+            state = self._agents.get(entry[2])
+            if state is None or state['version'] != entry[1]:
+                continue
+            if state['free'] <= 0:
+                # Best entry has no room, so nobody has; keep it for later
+                heapq.heappush(heap, entry)
+                return None
+            return state
+        return None
+
+    def agent_online(self, agent, open_chats=0):
+        """Start routing to an agent (e.g. when their presence goes online)."""
+        shards = get_group_strategy().agent_shards(agent)
+        with self._lock:
+            self._set(agent, agent.max_concurrent_chats - open_chats, shards)
+
+    def agent_offline(self, agent_id):
+        """Stop routing to an agent; their heap entries become stale."""
+        with self._lock:
+            self._agents.pop(agent_id, None)
+
+    def reserve(self, agent_id):
+        """Take one chat slot for a conversation assigned outside route()."""
+        with self._lock:
+            state = self._agents.get(agent_id)
+            if state is not None:
+                self._set(state['agent'], state['free'] - 1, state['shards'])
+
+    def release(self, agent_id):
+        """Give an agent back one chat slot after a conversation ends."""
+        with self._lock:
+            state = self._agents.get(agent_id)
+            if state is not None:
+                free = min(state['free'] + 1, state['agent'].max_concurrent_chats)
+                self._set(state['agent'], free, state['shards'])
+
+    def free_capacity(self):
+        with self._lock:
+            return sum(max(state['free'], 0) for state in self._agents.values())
+
+    def route(self, conversation_id, shard='', started_at=None):
+        """Assign a waiting conversation to the agent with the most free capacity.
+
+        Only agents serving the conversation's queue shard are considered.
+        Returns the agent, or None when none of them has room or the
+        conversation is no longer waiting.
+        """
+        self._ensure_reconciled()
+        with self._lock:
+            state = self._pop_best(shard)
+            if state is None:
+                return None
+            # Reserve the slot before leaving the lock
+            self._set(state['agent'], state['free'] - 1, state['shards'])
+        agent = state['agent']
+
+        conv_qs = models.Conversation.objects.filter(
+            id=conversation_id, status=models.Conversation.STATUS_WAITING
+        )
+        if assign_conversation(conv_qs, agent, started_at):
+            return agent
+        # Accepted manually or closed meanwhile: hand the slot back
+        self.release(agent.id)
+        return None
+
+    def assign_waiting(self):
+        """Route the oldest waiting conversations while capacity remains."""
+        self._ensure_reconciled()
+        capacity = self.free_capacity()
+        if capacity <= 0:
+            return []
+        waiting = (
+            models.Conversation.objects
+            .filter(status=models.Conversation.STATUS_WAITING)
+            .select_related('visitor')
+            .order_by('started_at')[:capacity]
+        )
+        assigned = []
+        for conv in waiting:
+            agent = self.route(conv.id, conv.queue_shard, conv.started_at)
+            if agent is None:
+                continue
+            notify_assignment(conv.id, agent, conv.visitor, conv.queue_shard)
+            assigned.append((conv, agent))
+        return assigned
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process-wide assignment engine."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AssignmentEngine()
+        return _engine
+
+
+def auto_assign(conversation):
+    """Route a new conversation if auto-assignment is enabled.
+
+    Returns the assigned agent (after notifying everyone) or None, in which
+    case the caller should announce the conversation to the queue as usual.
+    """
+    if not get_setting('AUTO_ASSIGN'):
+        return None
+    agent = get_engine().route(conversation.id, conversation.queue_shard, conversation.started_at)
+    if agent is not None:
+        notify_assignment(conversation.id, agent, conversation.visitor, conversation.queue_shard)
+    return agent
+
+
+def reserve_agent_capacity(agent_id):
+    """Count a manually accepted conversation against its agent's chat slots."""
+    if get_setting('AUTO_ASSIGN'):
+        get_engine().reserve(agent_id)
+
+
+def release_agent_capacity(agent_id):
+    """Free a chat slot when a conversation ends and refill it from the queue."""
+    if not agent_id or not get_setting('AUTO_ASSIGN'):
+        return
+    engine = get_engine()
+    engine.release(agent_id)
+    engine.assign_waiting()
+
+
+def _conversation_ended(agent_id):
+    invalidate_agent(agent_id)
+    release_agent_capacity(agent_id)
+
+
+def _close(conversation_id):
+    # Only the request that actually closes an open conversation frees its
+    # slot; closing twice must not hand the agent a second one
+    now = timezone.now()
+    conv_qs = models.Conversation.objects.filter(id=conversation_id)
+    if conv_qs.filter(status__in=OPEN_STATUSES).update(status=models.Conversation.STATUS_CLOSED, ended_at=now):
+        return now, conv_qs.values_list('assigned_agent_id', flat=True).first()
+    if conv_qs.filter(status=models.Conversation.STATUS_WAITING).update(
+        status=models.Conversation.STATUS_CLOSED, ended_at=now
+    ):
+        return now, None
+    return None, None
+
+
+def close_conversation(conversation):
+    """Close a waiting or open conversation and free its agent's list cache and chat slot.
+
+    Returns False when it had already ended, in which case nothing changes.
+    """
+    ended_at, agent_id = _close(conversation.id)
+    if ended_at is None:
+        return False
+    conversation.status = models.Conversation.STATUS_CLOSED
+    conversation.ended_at = ended_at
+    if agent_id:
+        _conversation_ended(agent_id)
+    return True
+
+
+async def aclose_conversation(conversation):
+    """Async variant of close_conversation."""
+    return await sync_to_async(close_conversation)(conversation)
@@ -1,59 +1,144 @@
+import hashlib
 import secrets
-from django.core.mail import send_mail
-from django.conf import settings
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+
+from django.core import signing
+from django.core.cache import caches
+from django.db.models import F
 from django.utils import timezone
 from django.db import transaction
 
 from .. import models
+from ..metrics import AUTH_REQUESTS, DB_SECONDS
+from ..settings import get_setting
+from .otp import get_otp_outbox
 
+SESSION_LIFETIME = timedelta(hours=24)
+VISITOR_TOKEN_SALT = 'support_chat.visitor'
+BROWSER_TOKEN_SALT = 'support_chat.browser'
 
-def send_otp_email(email):
-    """Generate, save, and send OTP to agent email."""
-    # Create or get latest OTP record
-    otp_record = models.AgentOTP.objects.create(
-        email=email,
-        otp=models.AgentOTP.generate_otp()
-    )
-    
-    subject = "Your Support Team Login OTP"
-    message = f"""
-Hello,
 
-Your login OTP is: {otp_record.otp}
+class SessionCache:
+    """Token -> (agent, last_activity) cache in front of AgentSession.
 
-This code will expire in 10 minutes.
+    A bounded, thread-safe LRU lives in each process; when
+    SESSION_CACHE_BACKEND names a Django cache alias, entries are shared
+    through it as well so other workers can skip the database too. Keys are
+    hashed so raw session tokens never reach the cache backend.
+    """
 
-If you did not request this, please ignore this email.
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-Support Team
-"""
-    
-    try:
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [email])
-        return True, otp_record
-    except Exception as e:
-        print(f"Email send error: {e}")
-        otp_record.delete()
-        return False, None
+    @staticmethod
+    def _key(token):
+        return 'support_chat:agent_session:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _shared():
+        alias = get_setting('SESSION_CACHE_BACKEND')
+        return caches[alias] if alias else None
+
+    def get_local(self, token):
+        """Return the entry from this process's LRU only, without any I/O."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1], entry[2]
+        return None
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(token)
+                    return entry[1], entry[2]
+                del self._entries[token]
+        shared = self._shared()
+        if shared is not None:
+            found = shared.get(self._key(token))
+            if found is not None:
+                self._store_local(token, *found)
+                return found
+        return None
+
+    def set(self, token, agent, last_activity):
+        self._store_local(token, agent, last_activity)
+        shared = self._shared()
+        if shared is not None:
+            shared.set(self._key(token), (agent, last_activity), get_setting('SESSION_CACHE_TTL'))
+
+    def _store_local(self, token, agent, last_activity):
+        expires = time.monotonic() + get_setting('SESSION_CACHE_TTL')
+        with self._lock:
+            self._entries[token] = (expires, agent, last_activity)
+            self._entries.move_to_end(token)
+            while len(self._entries) > get_setting('SESSION_CACHE_SIZE'):
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+        shared = self._shared()
+        if shared is not None:
+            shared.delete(self._key(token))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+session_cache = SessionCache()
+
+
+def send_otp_email(email):
+    """Queue an OTP email for the agent; the outbox sends it in the background.
+
+    Repeated requests while the latest OTP is still queued reuse it instead
+    of adding rows.
+    """
+    otp_record = models.AgentOTP.objects.filter(email=email).order_by('-created_at').first()
+    if otp_record is None or otp_record.sent_at is not None or otp_record.is_verified or otp_record.is_expired():
+        otp_record = models.AgentOTP.objects.create(
+            email=email,
+            otp=models.AgentOTP.generate_otp()
+        )
+    AUTH_REQUESTS.inc(event='otp_send', result='queued')
+    get_otp_outbox().notify()
+    return True, otp_record
 
 
 def verify_otp(email, otp_code):
     """Verify OTP and return agent if valid."""
-    # Find the latest non-expired OTP for this email
+    # The latest OTP for this email, through the (email, -created_at) index
     otp_record = models.AgentOTP.objects.filter(email=email).order_by('-created_at').first()
     
     if not otp_record:
+        AUTH_REQUESTS.inc(event='otp_verify', result='missing')
         return False, "No OTP found for this email"
     
     if otp_record.is_expired():
+        AUTH_REQUESTS.inc(event='otp_verify', result='expired')
         return False, "OTP has expired"
     
-    if otp_record.attempts >= 3:
+    # Every try takes one of the 3 attempts in a single conditional UPDATE
+    # before the code is compared, so parallel guesses cannot get more
+    claimed = models.AgentOTP.objects.filter(pk=otp_record.pk, attempts__lt=3).update(
+        attempts=F('attempts') + 1
+    )
+    if not claimed:
+        AUTH_REQUESTS.inc(event='otp_verify', result='locked')
         return False, "Too many attempts. Request a new OTP."
     
     if otp_record.otp != otp_code:
-        otp_record.attempts += 1
-        otp_record.save()
+        AUTH_REQUESTS.inc(event='otp_verify', result='invalid')
         return False, "Invalid OTP code"
     
     # OTP is valid, get or create agent
@@ -62,8 +147,8 @@ def verify_otp(email, otp_code):
         defaults={'name': email.split('@')[0]}
     )
     
-    otp_record.is_verified = True
-    otp_record.save()
+    models.AgentOTP.objects.filter(pk=otp_record.pk).update(is_verified=True)
+    AUTH_REQUESTS.inc(event='otp_verify', result='ok')
     
     return True, agent
 
@@ -76,6 +161,8 @@ def create_agent_session(agent):
         defaults={'session_token': token}
     )
     if not created:
+        # The previous token stops working, including cached copies of it
+        session_cache.invalidate(session.session_token)
         session.session_token = token
         session.last_activity = timezone.now()
         session.save()
@@ -83,18 +170,119 @@ def create_agent_session(agent):
 
 
 def get_agent_from_session(session_token):
-    """Retrieve agent from valid session token."""
-    try:
-        session = models.AgentSession.objects.select_related('agent').get(session_token=session_token)
-        if session.is_valid():
-            session.last_activity = timezone.now()
-            session.save()
-            return session.agent
-    except models.AgentSession.DoesNotExist:
-        pass
-    return None
+    """Retrieve agent from valid session token.
+
+    Served from the session cache in the common case. last_activity is only
+    written back when the stored value is older than
+    SESSION_TOUCH_INTERVAL seconds, instead of on every request.
+    """
+    cached = session_cache.get(session_token)
+    refresh = cached is None
+    source = 'database' if refresh else 'cache'
+    if refresh:
+        try:
+            with DB_SECONDS.time(operation='session_lookup'):
+                session = models.AgentSession.objects.select_related('agent').get(session_token=session_token)
+        except models.AgentSession.DoesNotExist:
+            AUTH_REQUESTS.inc(event='session', result='invalid')
+            return None
+        cached = (session.agent, session.last_activity)
+    agent, last_activity = cached
+
+    now = timezone.now()
+    if now >= last_activity + SESSION_LIFETIME:
+        AUTH_REQUESTS.inc(event='session', result='expired')
+        session_cache.invalidate(session_token)
+        return None
+
+    if now - last_activity >= timedelta(seconds=get_setting('SESSION_TOUCH_INTERVAL')):
+        with DB_SECONDS.time(operation='session_touch'):
+            updated = models.AgentSession.objects.filter(session_token=session_token).update(last_activity=now)
+        if not updated:
+            # Logged out or rotated by another worker
+            AUTH_REQUESTS.inc(event='session', result='invalid')
+            session_cache.invalidate(session_token)
+            return None
+        last_activity = now
+        refresh = True
+    AUTH_REQUESTS.inc(event='session', result=source)
+    if refresh:
+        session_cache.set(session_token, agent, last_activity)
+    return agent
+
+
+async def aget_agent_from_session(session_token):
+    """Async variant of get_agent_from_session.
+
+    Answers from the local LRU without leaving the event loop when the entry
+    needs no last_activity write; otherwise falls back to the sync path.
+    """
+    cached = session_cache.get_local(session_token)
+    if cached is not None:
+        agent, last_activity = cached
+        age = timezone.now() - last_activity
+        if age < timedelta(seconds=get_setting('SESSION_TOUCH_INTERVAL')):
+            AUTH_REQUESTS.inc(event='session', result='local')
+            return agent
+    return await sync_to_async(get_agent_from_session)(session_token)
 
 
 def logout_agent(session_token):
     """Delete agent session."""
+    session_cache.invalidate(session_token)
     models.AgentSession.objects.filter(session_token=session_token).delete()
+
+
+def _delete_in_batches(queryset, batch_size):
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        with transaction.atomic():
+            deleted += queryset.model.objects.filter(pk__in=pks).delete()[0]
+
+
+def purge_auth_records(batch_size=None):
+    """Delete expired OTPs and stale agent sessions in batches.
+
+    OTPs are kept for OTP_RETENTION seconds after they expire, for the
+    admin; sessions go once SESSION_LIFETIME has passed since their last
+    activity. Both deletes walk an index on their timestamp. Returns
+    ``{'otps': n, 'sessions': n}``.
+    """
+    batch_size = batch_size or get_setting('AUTH_PURGE_BATCH_SIZE')
+    now = timezone.now()
+    otp_cutoff = now - models.AgentOTP.LIFETIME - timedelta(seconds=get_setting('OTP_RETENTION'))
+    return {
+        'otps': _delete_in_batches(models.AgentOTP.objects.filter(created_at__lt=otp_cutoff), batch_size),
+        'sessions': _delete_in_batches(
+            models.AgentSession.objects.filter(last_activity__lt=now - SESSION_LIFETIME), batch_size
+        ),
+    }
+
+
+def make_visitor_token(conversation_id):
+    """Return a signed token proving the bearer started this conversation."""
+    return signing.dumps(str(conversation_id), salt=VISITOR_TOKEN_SALT)
+
+
+def get_conversation_from_visitor_token(token):
+    """Return the conversation id a visitor token was issued for, or None."""
+    try:
+        return signing.loads(token, salt=VISITOR_TOKEN_SALT)
+    except signing.BadSignature:
+        return None
+
+
+def make_browser_token(visitor_id):
+    """Return a signed token the widget keeps to be recognised as this visitor."""
+    return signing.dumps(str(visitor_id), salt=BROWSER_TOKEN_SALT)
+
+
+def get_visitor_from_browser_token(token):
+    """Return the visitor id a browser token was issued for, or None if invalid or expired."""
+    try:
+        return signing.loads(token, salt=BROWSER_TOKEN_SALT, max_age=get_setting('BROWSER_TOKEN_MAX_AGE'))
+    except signing.BadSignature:
+        return None
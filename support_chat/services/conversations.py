@@ -0,0 +1,162 @@
+from django.core.cache import cache
+from django.db.models import Case, CharField, F, IntegerField, Q, Value, When, Window
+from django.db.models.functions import RowNumber
+
+from .. import models
+from ..settings import get_setting
+from .groups import get_group_strategy
+
+BUCKET_WAITING = 'waiting'
+BUCKET_ACTIVE = 'active'
+BUCKET_CLOSED = 'closed'
+BUCKETS = (BUCKET_WAITING, BUCKET_ACTIVE, BUCKET_CLOSED)
+
+QUEUE_VERSION_KEY = 'support_chat:queue_version'
+
+
+def _agent_version_key(agent_id):
+    return f'support_chat:agent_version:{agent_id}'
+
+
+def _bump(key):
+    if cache.add(key, 1, timeout=None):
+        return 1
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+        return 1
+
+
+def get_queue_version():
+    """Return the current queue version (the last queue sequence number)."""
+    return cache.get(QUEUE_VERSION_KEY, 0)
+
+
+def invalidate_queue():
+    """Expire every agent's cached lists (the waiting bucket is shared).
+
+    Returns the new queue version, which doubles as the sequence number of
+    the queue event that caused it.
+    """
+    return _bump(QUEUE_VERSION_KEY)
+
+
+def invalidate_agent(agent_id):
+    """Expire the cached lists of a single agent."""
+    if agent_id:
+        _bump(_agent_version_key(agent_id))
+
+
+def load_agent_conversations(agent):
+    """Load the waiting, active and closed buckets for an agent in one query.
+
+    Each row is tagged with its bucket and ranked inside it with a window
+    function, so per-bucket limits are applied by the database and the cost
+    does not grow with the agent's history. Waiting conversations are ranked
+    oldest first (queue order), the agent's own conversations newest first.
+    Only the waiting conversations of the agent's queue shards are listed.
+    """
+    waiting_q = Q(
+        status=models.Conversation.STATUS_WAITING,
+        queue_shard__in=get_group_strategy().agent_shards(agent),
+    )
+    active_q = Q(
+        assigned_agent=agent,
+        status__in=[models.Conversation.STATUS_ASSIGNED, models.Conversation.STATUS_ACTIVE],
+    )
+    closed_q = Q(assigned_agent=agent, status=models.Conversation.STATUS_CLOSED)
+
+    bucket = Case(
+        When(waiting_q, then=Value(BUCKET_WAITING)),
+        When(active_q, then=Value(BUCKET_ACTIVE)),
+        When(closed_q, then=Value(BUCKET_CLOSED)),
+        output_field=CharField(),
+    )
+    bucket_limit = Case(
+        When(waiting_q, then=Value(get_setting('WAITING_LIST_LIMIT'))),
+        When(active_q, then=Value(get_setting('ACTIVE_LIST_LIMIT'))),
+        default=Value(get_setting('CLOSED_LIST_LIMIT')),
+        output_field=IntegerField(),
+    )
+    queue_order = Case(When(waiting_q, then=F('started_at')))
+
+    rows = (
+        models.Conversation.objects
+        .filter(waiting_q | active_q | closed_q)
+        .annotate(bucket=bucket, bucket_limit=bucket_limit)
+        .annotate(bucket_rank=Window(
+            RowNumber(),
+            partition_by=[F('bucket')],
+            order_by=[queue_order.asc(), F('started_at').desc()],
+        ))
+        .filter(bucket_rank__lte=F('bucket_limit'))
+        .values(
+            'id', 'status', 'started_at', 'ended_at',
+            'visitor__name', 'visitor__email', 'bucket', 'bucket_rank',
+        )
+    )
+
+    data = {name: [] for name in BUCKETS}
+    for row in sorted(rows, key=lambda r: r['bucket_rank']):
+        data[row['bucket']].append(_list_item(row))
+    return data
+
+
+def _list_item(row):
+    return {
+        'id': str(row['id']),
+        'visitor_name': row['visitor__name'],
+        'visitor_email': row['visitor__email'],
+        'status': row['status'],
+        'started_at': row['started_at'],
+        'ended_at': row['ended_at'],
+    }
+
+
+def get_agent_conversations(agent):
+    """Return the agent's conversation buckets, served from a short-TTL cache.
+
+    The cache key embeds the shared queue version and the agent's own
+    version, so publishing a queue event or closing a conversation makes
+    stale entries unreachable without having to delete them.
+    """
+    ttl = get_setting('CONVERSATION_LIST_CACHE_TTL')
+    if not ttl:
+        return load_agent_conversations(agent)
+
+    agent_key = _agent_version_key(agent.id)
+    versions = cache.get_many([QUEUE_VERSION_KEY, agent_key])
+    key = 'support_chat:conversations:{}:{}:{}'.format(
+        agent.id, versions.get(QUEUE_VERSION_KEY, 0), versions.get(agent_key, 0)
+    )
+    data = cache.get(key)
+    if data is None:
+        data = load_agent_conversations(agent)
+        cache.set(key, data, ttl)
+    return data
+
+
+def get_waiting_conversations(shards=('',)):
+    """Return ``(queue_version, waiting)`` for queue snapshots.
+
+    The waiting list of a set of shards is the same for every agent serving
+    them, so it is cached once per queue version; a burst of reconnecting
+    dashboards costs one query.
+    """
+    version = get_queue_version()
+    ttl = get_setting('CONVERSATION_LIST_CACHE_TTL')
+    key = 'support_chat:waiting:{}:{}'.format(version, ','.join(sorted(shards)))
+    data = cache.get(key) if ttl else None
+    if data is None:
+        rows = (
+            models.Conversation.objects
+            .filter(status=models.Conversation.STATUS_WAITING, queue_shard__in=shards)
+            .order_by('started_at')
+            .values('id', 'status', 'started_at', 'ended_at', 'visitor__name', 'visitor__email')
+            [:get_setting('WAITING_LIST_LIMIT')]
+        )
+        data = [_list_item(row) for row in rows]
+        if ttl:
+            cache.set(key, data, ttl)
+    return version, data
@@ -0,0 +1,54 @@
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+
+from .groups import get_group_strategy
+from .replay import remember_message
+
+
+def conversation_group(conversation_id):
+    """Channel-layer group joined by every socket of a conversation."""
+    return get_group_strategy().conversation_group(conversation_id)
+
+
+def _conversation_event(conversation_id, event, roles):
+    # Without roles the event goes to every participant; otherwise only to
+    # sockets whose sender_type is listed. sent_at lets consumers measure
+    # channel-layer latency; conversation_id lets multiplexed agent sockets
+    # tell their conversations apart.
+    event = dict(event, conversation_id=str(conversation_id), sent_at=time.time())
+    if roles:
+        event['roles'] = list(roles)
+    return event
+
+
+def publish_conversation_event(conversation_id, event, roles=None):
+    """Send an event once to everyone connected to a conversation.
+
+    Visitor and agent sockets share a single group, so each event crosses the
+    channel layer once; ``roles`` (e.g. ``['agent']``) narrows delivery to
+    the given participant types.
+    """
+    async_to_sync(get_channel_layer().group_send)(
+        conversation_group(conversation_id), _conversation_event(conversation_id, event, roles)
+    )
+
+
+async def apublish_conversation_event(conversation_id, event, roles=None):
+    """Async variant of publish_conversation_event."""
+    await get_channel_layer().group_send(
+        conversation_group(conversation_id), _conversation_event(conversation_id, event, roles)
+    )
+
+
+async def apublish_message(conversation_id, message, roles=None):
+    """Broadcast a serialized message to a conversation.
+
+    The message is also kept in the recent-message ring that reconnecting
+    sockets replay from.
+    """
+    await sync_to_async(remember_message)(conversation_id, message, roles)
+    await apublish_conversation_event(
+        conversation_id, {'type': 'chat.message', 'message': message}, roles
+    )
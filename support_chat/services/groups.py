@@ -0,0 +1,75 @@
+import re
+import uuid
+
+from django.utils.module_loading import import_string
+
+from ..settings import get_setting
+
+QUEUE_GROUP = 'support_queue'
+
+# Channel layers accept ASCII letters, digits, hyphens, underscores and periods
+_INVALID_GROUP_CHARS = re.compile(r'[^a-zA-Z0-9_.-]')
+
+
+class GroupStrategy:
+    """Names the channel-layer groups used for queue, agent and conversation events.
+
+    The waiting queue is split into shards. Every conversation is given a
+    shard when it is created (stored in Conversation.queue_shard) and each
+    agent's dashboard joins only the queue groups of agent_shards(), so a
+    queue event reaches the agents of one shard instead of every agent in
+    the cluster. This default puts everything in a single shard; subclass it
+    and set SUPPORT_CHAT['GROUP_STRATEGY'] to shard by site, department, etc.
+    """
+
+    def conversation_shard(self, conversation, request=None):
+        """Return the shard of a new conversation (request is the create_session request)."""
+        return ''
+
+    def agent_shards(self, agent):
+        """Return the shards whose queue the agent sees and is routed from."""
+        return ['']
+
+    def queue_group(self, shard):
+        if not shard:
+            return QUEUE_GROUP
+        return f'{QUEUE_GROUP}.{_INVALID_GROUP_CHARS.sub("_", shard)}'[:99]
+
+    def agent_group(self, agent_id):
+        return f'agent_{agent_id}'
+
+    def conversation_group(self, conversation_id):
+        return f'conversation_{conversation_id}'
+
+
+class HashShardStrategy(GroupStrategy):
+    """Spreads conversations over QUEUE_SHARDS shards by id.
+
+    Each agent serves QUEUE_SHARDS_PER_AGENT consecutive shards starting at
+    the hash of their own id; keep enough agents per shard that none is left
+    unattended.
+    """
+
+    def _hash(self, value):
+        return uuid.UUID(str(value)).int % get_setting('QUEUE_SHARDS')
+
+    def conversation_shard(self, conversation, request=None):
+        return str(self._hash(conversation.id))
+
+    def agent_shards(self, agent):
+        count = get_setting('QUEUE_SHARDS')
+        first = self._hash(agent.id)
+        per_agent = min(get_setting('QUEUE_SHARDS_PER_AGENT'), count)
+        return [str((first + offset) % count) for offset in range(per_agent)]
+
+
+_strategy = None
+
+
+def get_group_strategy():
+    """Return the configured GroupStrategy instance."""
+    global _strategy
+    path = get_setting('GROUP_STRATEGY')
+    if _strategy is None or _strategy[0] != path:
+        _strategy = (path, import_string(path)())
+    return _strategy[1]
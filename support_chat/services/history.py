@@ -0,0 +1,74 @@
+import base64
+import binascii
+import uuid
+from datetime import datetime
+
+from django.db.models import Q
+
+from .. import models
+from ..settings import get_setting
+from .archive import load_archived_messages
+
+
+class InvalidCursor(ValueError):
+    """Raised when a history cursor cannot be decoded."""
+
+
+def encode_cursor(message):
+    """Return an opaque cursor pointing just before ``message``."""
+    raw = f'{message.created_at.isoformat()}|{message.id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (created_at, id) keyset position encoded in ``cursor``."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, message_id = base64.urlsafe_b64decode(padded).decode('utf-8').split('|')
+        return datetime.fromisoformat(created_at), uuid.UUID(message_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+
+
+def get_message_page(conversation_id, before=None, limit=None):
+    """Return one page of history, newest window first.
+
+    Pages are found by seeking on (created_at, id) through the
+    (conversation, created_at) index, so older pages cost the same as the
+    first one. Messages come back oldest-first for display, together with the
+    cursor for the next older page (None when the start has been reached).
+    """
+    max_size = get_setting('HISTORY_MAX_PAGE_SIZE')
+    limit = max(1, min(limit or get_setting('HISTORY_PAGE_SIZE'), max_size))
+
+    qs = models.Message.objects.filter(conversation_id=conversation_id)
+    if before:
+        created_at, message_id = decode_cursor(before)
+        qs = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))
+
+    return _page(list(qs.order_by('-created_at', '-id')[:limit + 1]), limit)
+
+
+def _page(rows, limit):
+    # rows are newest-first and hold up to limit + 1 messages
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    next_cursor = encode_cursor(rows[0]) if has_more else None
+    return rows, next_cursor
+
+
+def get_conversation_page(conversation, before=None, limit=None):
+    """Like get_message_page, reading archived conversations from their archive file."""
+    if not conversation.archived_at:
+        return get_message_page(conversation.id, before, limit)
+
+    max_size = get_setting('HISTORY_MAX_PAGE_SIZE')
+    limit = max(1, min(limit or get_setting('HISTORY_PAGE_SIZE'), max_size))
+
+    rows = load_archived_messages(conversation)
+    rows.sort(key=lambda m: (m.created_at, m.id), reverse=True)
+    if before:
+        position = decode_cursor(before)
+        rows = [m for m in rows if (m.created_at, m.id) < position]
+    return _page(rows[:limit + 1], limit)
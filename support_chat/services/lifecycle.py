@@ -0,0 +1,110 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .. import models
+from ..checks import default_cache_is_shared
+from ..settings import get_setting
+from .assignment import OPEN_STATUSES, get_engine
+from .conversations import invalidate_agent
+from .fanout import publish_conversation_event
+from .queue import publish_queue_event
+
+SWEEP_LOCK_KEY = 'support_chat:lifecycle:sweep'
+
+
+def _rules(now):
+    # (status, cutoff on started_at, status to set)
+    rules = []
+    abandon_after = get_setting('ABANDON_WAITING_AFTER')
+    if abandon_after:
+        rules.append((
+            models.Conversation.STATUS_WAITING,
+            now - timedelta(seconds=abandon_after),
+            models.Conversation.STATUS_ABANDONED,
+        ))
+    max_time = get_setting('MAX_CONVERSATION_TIME')
+    if max_time:
+        for status in OPEN_STATUSES:
+            rules.append((status, now - timedelta(seconds=max_time), models.Conversation.STATUS_CLOSED))
+    return rules
+
+
+def _expire(status, cutoff, new_status, now, batch_size):
+    # Batches come from the (status, started_at) index; the status filter on
+    # the UPDATE leaves alone rows that were accepted or closed meanwhile
+    expired = []
+    while True:
+        rows = list(
+            models.Conversation.objects.filter(status=status, started_at__lt=cutoff)
+            .order_by('started_at')
+            .values_list('id', 'queue_shard', 'assigned_agent_id')[:batch_size]
+        )
+        if not rows:
+            return expired
+        ids = [row[0] for row in rows]
+        updated = models.Conversation.objects.filter(id__in=ids, status=status).update(
+            status=new_status, ended_at=now
+        )
+        if updated < len(rows):
+            # Some changed under us (or another sweep got there first)
+            mine = set(models.Conversation.objects.filter(
+                id__in=ids, status=new_status, ended_at=now
+            ).values_list('id', flat=True))
+            expired.extend(row for row in rows if row[0] in mine)
+        else:
+            expired.extend(rows)
+        if len(rows) < batch_size:
+            return expired
+
+
+def sweep_conversations(force=False):
+    """Abandon stale waiting conversations and close ones past MAX_CONVERSATION_TIME.
+
+    Waiting conversations older than ABANDON_WAITING_AFTER seconds become
+    abandoned; assigned and active ones older than MAX_CONVERSATION_TIME are
+    closed. Rows are updated in CONVERSATION_SWEEP_BATCH_SIZE batches, then
+    each queue shard gets one ``conversations_removed`` event for the whole
+    sweep and each closed conversation a ``conversation.closed`` event.
+
+    Unless ``force`` is set, runs at most once per CONVERSATION_SWEEP_INTERVAL
+    across all processes sharing the cache, and not at all when the cache is
+    per-process (the lock could not stop other workers). Returns None when
+    skipped, otherwise ``{'abandoned': n, 'closed': n}``.
+    """
+    if not force and (
+        not default_cache_is_shared()
+        or not cache.add(SWEEP_LOCK_KEY, True, get_setting('CONVERSATION_SWEEP_INTERVAL'))
+    ):
+        return None
+    now = timezone.now()
+    batch_size = get_setting('CONVERSATION_SWEEP_BATCH_SIZE')
+    stats = {models.Conversation.STATUS_ABANDONED: 0, models.Conversation.STATUS_CLOSED: 0}
+    removed = defaultdict(list)
+    closed = []
+    for status, cutoff, new_status in _rules(now):
+        for conversation_id, shard, agent_id in _expire(status, cutoff, new_status, now, batch_size):
+            stats[new_status] += 1
+            removed[shard].append(str(conversation_id))
+            if new_status == models.Conversation.STATUS_CLOSED:
+                closed.append((conversation_id, agent_id))
+
+    for shard, conversation_ids in removed.items():
+        publish_queue_event({'type': 'conversations_removed', 'conversation_ids': conversation_ids}, shard)
+    agent_ids = [agent_id for _, agent_id in closed if agent_id]
+    for agent_id in set(agent_ids):
+        invalidate_agent(agent_id)
+    if agent_ids and get_setting('AUTO_ASSIGN'):
+        # Free every slot first so the queue is refilled in one pass
+        engine = get_engine()
+        for agent_id in agent_ids:
+            engine.release(agent_id)
+        engine.assign_waiting()
+    for conversation_id, _ in closed:
+        publish_conversation_event(conversation_id, {
+            'type': 'conversation.closed',
+            'conversation_id': str(conversation_id),
+        })
+    return {'abandoned': stats[models.Conversation.STATUS_ABANDONED], 'closed': stats[models.Conversation.STATUS_CLOSED]}
@@ -0,0 +1,177 @@
+import asyncio
+import atexit
+import logging
+import uuid
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.db import transaction
+from django.utils import timezone
+
+from .. import models
+from ..settings import get_setting
+from .search import index_messages
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_message(m):
+    """Return the payload broadcast to chat sockets for a message."""
+    return {
+        'id': str(m.id),
+        'conversation': str(m.conversation_id),
+        'sender_type': m.sender_type,
+        'sender_id': str(m.sender_id) if m.sender_id else None,
+        'message': m.message,
+        'created_at': m.created_at.isoformat(),
+    }
+
+
+async def acreate_message(conversation_id, sender_type, sender_id, message_text):
+    """Insert a message through the async ORM, queue it for indexing and return it."""
+    m = await models.Message.objects.acreate(
+        conversation_id=conversation_id,
+        sender_type=sender_type,
+        sender_id=sender_id,
+        message=message_text,
+    )
+    index_messages([m])
+    return m
+
+
+class MessageWriteBuffer:
+    """Per-process write-behind buffer for chat messages.
+
+    Messages get their id and created_at in memory so they can be broadcast
+    straight away; a background task on the event loop persists them with
+    bulk_create once flush_size messages are pending or flush_interval
+    seconds have passed. A single FIFO list and a single flusher keep rows in
+    arrival order, and created_at is kept strictly increasing per conversation
+    so history queries return messages in the order they were broadcast.
+    """
+
+    def __init__(self, flush_size=None, flush_interval=None):
+        self.flush_size = flush_size or get_setting('MESSAGE_FLUSH_SIZE')
+        self.flush_interval = flush_interval or get_setting('MESSAGE_FLUSH_INTERVAL')
+        self._pending = []
+        self._last_created = {}
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._flush_lock = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, conversation_id, sender_type, sender_id, message_text):
+        """Stamp and queue a message; returns the unsaved Message instance."""
+        created_at = timezone.now()
+        last = self._last_created.get(conversation_id)
+        if last is not None and created_at <= last:
+            created_at = last + timedelta(microseconds=1)
+        self._last_created[conversation_id] = created_at
+
+        m = models.Message(
+            id=uuid.uuid4(),
+            conversation_id=conversation_id,
+            sender_type=sender_type,
+            sender_id=uuid.UUID(str(sender_id)) if sender_id else None,
+            message=message_text,
+            created_at=created_at,
+        )
+        self._pending.append(m)
+        self._ensure_flusher()
+        if len(self._pending) >= self.flush_size:
+            self._wakeup.set()
+        return m
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._task = None
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        # Exit once the buffer is empty so idle workers do not keep waking up.
+        while self._pending:
+            if len(self._pending) < self.flush_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write everything currently buffered; returns the number of rows."""
+        if not self._pending:
+            return 0
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if batch:
+                await database_sync_to_async(self._write)(batch)
+            self._prune()
+            return len(batch)
+
+    async def drain(self):
+        """Persist all buffered messages; await this on worker shutdown."""
+        while self._pending:
+            await self.flush()
+
+    def drain_sync(self):
+        """Synchronous drain used from atexit once the event loop is gone."""
+        batch, self._pending = self._pending, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            with transaction.atomic():
+                models.Message.objects.bulk_create(batch, batch_size=self.flush_size)
+        except Exception:
+            logger.exception('Bulk insert of %d messages failed, retrying row by row', len(batch))
+            # Isolate the bad rows so one message cannot take the batch down.
+            saved = []
+            for m in batch:
+                try:
+                    m.save(force_insert=True)
+                    saved.append(m)
+                except Exception:
+                    logger.exception('Dropping message %s for conversation %s', m.id, m.conversation_id)
+            batch = saved
+        index_messages(batch)
+
+    def _prune(self):
+        # Ordering only needs the last stamp of recently active conversations.
+        cutoff = timezone.now() - timedelta(seconds=5)
+        self._last_created = {
+            conv_id: ts for conv_id, ts in self._last_created.items() if ts > cutoff
+        }
+
+
+_write_buffer = None
+
+
+def get_write_buffer():
+    """Return the process-wide write buffer.
+
+    The buffer is drained on ASGI lifespan shutdown (see
+    routing.SupportChatLifespan); the atexit drain is only a fallback for
+    servers without lifespan support, since it is skipped when a worker
+    is killed.
+    """
+    global _write_buffer
+    if _write_buffer is None:
+        _write_buffer = MessageWriteBuffer()
+        atexit.register(_write_buffer.drain_sync)
+    return _write_buffer
+
+
+async def drain_write_buffer():
+    """Persist everything in the process-wide write buffer, if one exists."""
+    if _write_buffer is not None:
+        await _write_buffer.drain()
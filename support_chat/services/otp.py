@@ -0,0 +1,169 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .. import models
+from ..metrics import AUTH_REQUESTS
+from ..settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+OTP_SUBJECT = "Your Support Team Login OTP"
+OTP_BODY = """
+Hello,
+
+Your login OTP is: {otp}
+
+This code will expire in 10 minutes.
+
+If you did not request this, please ignore this email.
+
+Support Team
+"""
+
+
+def otp_message(otp_record):
+    return EmailMessage(
+        OTP_SUBJECT, OTP_BODY.format(otp=otp_record.otp), settings.DEFAULT_FROM_EMAIL, [otp_record.email]
+    )
+
+
+class OTPOutbox:
+    """Sends queued OTP emails so that login requests never wait on the mail server.
+
+    AgentOTP rows with no ``sent_at`` are the outbox. A daemon thread per
+    process, woken whenever an OTP is queued, sends them through one mail
+    connection that is kept open between batches until it has been idle for
+    OTP_CONNECTION_IDLE seconds. Failed sends are retried every
+    OTP_RETRY_INTERVAL seconds until the OTP expires. Rows are claimed
+    before they are sent, so several processes can drain the outbox without
+    sending an email twice. Set OTP_OUTBOX_THREAD to False to leave sending
+    to the ``send_otp_outbox`` command instead.
+    """
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._mail = None
+
+    def notify(self):
+        """Wake the sender after an OTP was queued, starting it if needed."""
+        if not get_setting('OTP_OUTBOX_THREAD'):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='support-chat-otp-outbox', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        retry = False
+        while True:
+            if retry:
+                timeout = get_setting('OTP_RETRY_INTERVAL')
+            elif self._mail is not None:
+                timeout = get_setting('OTP_CONNECTION_IDLE')
+            else:
+                timeout = None
+            woken = self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if not woken and not retry:
+                self.close()
+                continue
+            try:
+                retry = self.send_pending() > 0
+            except Exception:
+                logger.exception('Sending queued OTP emails failed')
+                retry = True
+            finally:
+                close_old_connections()
+
+    def _connection(self):
+        if self._mail is None:
+            self._mail = get_connection(get_setting('OTP_EMAIL_BACKEND'))
+            self._mail.open()
+        return self._mail
+
+    def close(self):
+        """Close the pooled mail connection, if open."""
+        mail, self._mail = self._mail, None
+        if mail is not None:
+            try:
+                mail.close()
+            except Exception:
+                logger.exception('Closing the OTP mail connection failed')
+
+    def _claim(self, batch_size):
+        """Mark up to ``batch_size`` queued OTPs as being sent by this process.
+
+        Returns the number of candidates found and the claimed rows. A row
+        is claimed with a conditional UPDATE on the ``claimed_at`` value that
+        was read, so two senders never both get it; a claim older than
+        OTP_CLAIM_TIMEOUT is left by a sender that died and is taken over.
+        """
+        now = timezone.now()
+        stale = now - timedelta(seconds=get_setting('OTP_CLAIM_TIMEOUT'))
+        with transaction.atomic():
+            pending = models.AgentOTP.objects.filter(
+                Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale),
+                sent_at__isnull=True, is_verified=False, created_at__gt=now - models.AgentOTP.LIFETIME,
+            ).order_by('created_at')
+            if connection.features.has_select_for_update_skip_locked:
+                pending = pending.select_for_update(skip_locked=True)
+            rows = list(pending[:batch_size])
+            claimed = [
+                otp_record for otp_record in rows
+                if models.AgentOTP.objects.filter(
+                    pk=otp_record.pk, sent_at__isnull=True, claimed_at=otp_record.claimed_at
+                ).update(claimed_at=now)
+            ]
+        return len(rows), claimed
+
+    def send_pending(self):
+        """Send every queued, unexpired OTP; returns how many sends failed.
+
+        Rows are claimed in a short transaction and sent after it has been
+        committed, so no row locks are held while talking to the mail server.
+        """
+        batch_size = get_setting('OTP_SEND_BATCH_SIZE')
+        failed = 0
+        while True:
+            found, claimed = self._claim(batch_size)
+            sent, unsent = [], []
+            for otp_record in claimed:
+                try:
+                    self._connection().send_messages([otp_message(otp_record)])
+                except Exception:
+                    logger.exception('Sending the OTP for %s failed', otp_record.email)
+                    AUTH_REQUESTS.inc(event='otp_send', result='failed')
+                    failed += 1
+                    unsent.append(otp_record.pk)
+                    # Reconnect for the next one
+                    self.close()
+                else:
+                    AUTH_REQUESTS.inc(event='otp_send', result='ok')
+                    sent.append(otp_record.pk)
+            if sent:
+                models.AgentOTP.objects.filter(pk__in=sent).update(sent_at=timezone.now(), claimed_at=None)
+            if unsent:
+                # Release the claim so the next retry picks them up again
+                models.AgentOTP.objects.filter(pk__in=unsent).update(claimed_at=None)
+            if failed or found < batch_size:
+                return failed
+
+_outbox = None
+
+
+def get_otp_outbox():
+    """Return the process-wide OTPOutbox."""
+    global _outbox
+    if _outbox is None:
+        _outbox = OTPOutbox()
+    return _outbox
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from collections import deque
+
+from ..metrics import OUTBOUND_DROPPED, OUTBOUND_FRAMES
+from ..settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_COALESCE = 'coalesce'
+POLICY_DISCONNECT = 'disconnect'
+POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+# Frames that must reach the client, or the connection is given up on
+KIND_MESSAGE = 'message'
+# Queue notifications: may be dropped or replaced by a snapshot
+KIND_QUEUE = 'queue'
+# Typing/presence updates: only the latest per key matters
+KIND_TRANSIENT = 'transient'
+
+RESYNC_KEY = 'resync'
+
+
+class OutboundQueue:
+    """Bounded per-connection send queue drained by a single writer task.
+
+    Channel-layer handlers put frames here instead of awaiting send_json, so
+    a client that reads slowly cannot hold up the consumer or grow the
+    worker's buffers: at most SEND_QUEUE_SIZE frames wait per socket. When
+    the queue is full, ``policy`` decides:
+
+    - drop_oldest: discard the oldest queue notification or transient frame.
+    - coalesce: replace every pending queue notification with one resync
+      entry, which sends a fresh snapshot when the writer gets to it.
+    - disconnect: close the socket; the client reconnects and resumes.
+
+    Frames with a ``key`` replace a pending frame with the same key. If only
+    KIND_MESSAGE frames are left, or one send takes longer than SEND_TIMEOUT,
+    the connection is closed under every policy.
+
+    A slow client is only noticed if ``send`` waits for it. Servers that
+    apply backpressure (uvicorn with the ``websockets`` implementation) do;
+    Daphne's send returns at once and buffers without limit in its
+    transport, so under Daphne the policies and SEND_TIMEOUT never fire.
+    """
+
+    def __init__(self, send, on_overflow, label, resync=None, size=None, policy=None, timeout=None):
+        self._send = send
+        self._on_overflow = on_overflow
+        self._resync = resync
+        self.label = label
+        self.size = size or get_setting('SEND_QUEUE_SIZE')
+        self.policy = policy or get_setting('SEND_QUEUE_POLICY')
+        if self.policy not in POLICIES:
+            raise ValueError(f'Unknown SEND_QUEUE_POLICY {self.policy!r}')
+        self.timeout = timeout or get_setting('SEND_TIMEOUT')
+        self._entries = deque()
+        self._keyed = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+        OUTBOUND_FRAMES.dec(len(self._entries), consumer=self.label)
+        self._entries.clear()
+        self._keyed.clear()
+
+    def put(self, frame, kind=KIND_MESSAGE, key=None):
+        """Queue a frame (or an async callable that sends one)."""
+        if self.closed:
+            return
+        if key is not None and key in self._keyed:
+            self._keyed[key][2] = frame
+            return
+        if len(self._entries) >= self.size and not self._make_room():
+            return
+        entry = [kind, key, frame]
+        self._entries.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        OUTBOUND_FRAMES.inc(consumer=self.label)
+        self._wakeup.set()
+
+    def _remove(self, predicate, reason):
+        kept = deque()
+        removed = 0
+        for entry in self._entries:
+            if predicate(entry):
+                removed += 1
+                if entry[1] is not None:
+                    del self._keyed[entry[1]]
+            else:
+                kept.append(entry)
+        self._entries = kept
+        if removed:
+            OUTBOUND_FRAMES.dec(removed, consumer=self.label)
+            OUTBOUND_DROPPED.inc(removed, consumer=self.label, reason=reason)
+        return removed
+
+    def _make_room(self):
+        if self.policy == POLICY_COALESCE and self._resync is not None:
+            if self._remove(lambda e: e[0] == KIND_QUEUE, POLICY_COALESCE):
+                self.put(self._resync, KIND_QUEUE, RESYNC_KEY)
+                return len(self._entries) < self.size
+        if self.policy in (POLICY_DROP_OLDEST, POLICY_COALESCE):
+            for entry in self._entries:
+                if entry[0] != KIND_MESSAGE and entry[1] != RESYNC_KEY:
+                    self._remove(lambda e: e is entry, POLICY_DROP_OLDEST)
+                    return True
+        self._overflow('full')
+        return False
+
+    def _overflow(self, reason):
+        if self.closed:
+            return
+        logger.info('Closing slow %s socket (%s, %d frames queued)', self.label, reason, len(self._entries))
+        OUTBOUND_DROPPED.inc(len(self._entries), consumer=self.label, reason=POLICY_DISCONNECT)
+        self.stop()
+        asyncio.get_running_loop().create_task(self._on_overflow())
+
+    async def _run(self):
+        while not self.closed:
+            if not self._entries:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            kind, key, frame = self._entries.popleft()
+            if key is not None:
+                del self._keyed[key]
+            OUTBOUND_FRAMES.dec(consumer=self.label)
+            try:
+                await asyncio.wait_for(frame() if callable(frame) else self._send(frame), self.timeout)
+            except asyncio.TimeoutError:
+                self._overflow('timeout')
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Sending a frame to a %s socket failed', self.label)
@@ -0,0 +1,152 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from .. import models
+from ..settings import get_setting
+from .assignment import OPEN_STATUSES, get_engine
+from .fanout import publish_conversation_event
+from .groups import get_group_strategy
+
+SWEEP_LOCK_KEY = 'support_chat:presence:sweep'
+
+
+def _presence_key(agent_id):
+    return f'support_chat:presence:agent:{agent_id}'
+
+
+class EventCoalescer:
+    """Forward at most one event per key per window, keeping only the latest.
+
+    Used per socket for typing and activity events: the first change in a
+    quiet window goes out straight away, later ones within the window replace
+    each other and only the last is sent when the window closes. Repeats of
+    the state that was last sent are dropped.
+    """
+
+    def __init__(self, send, window):
+        self._send = send
+        self.window = window
+        self._sent = {}
+        self._pending = {}
+        self._timers = {}
+
+    async def offer(self, key, event):
+        if key in self._timers:
+            self._pending[key] = event
+            return
+        last = self._sent.get(key)
+        if last is not None and last[1] == event:
+            return
+        now = time.monotonic()
+        if last is None or now - last[0] >= self.window:
+            self._sent[key] = (now, event)
+            await self._send(event)
+            return
+        self._pending[key] = event
+        self._timers[key] = asyncio.get_running_loop().create_task(
+            self._flush_later(key, last[0] + self.window - now)
+        )
+
+    async def _flush_later(self, key, delay):
+        await asyncio.sleep(delay)
+        del self._timers[key]
+        event = self._pending.pop(key)
+        if self._sent[key][1] != event:
+            self._sent[key] = (time.monotonic(), event)
+            await self._send(event)
+
+    def last_sent(self, key):
+        """Return the last event actually sent for key, if any.
+
+        Pending events are ignored: after cancel() they never go out, so the
+        other side still shows the state that was last sent.
+        """
+        last = self._sent.get(key)
+        return last[1] if last else None
+
+    def cancel(self):
+        for task in self._timers.values():
+            task.cancel()
+        self._timers.clear()
+        self._pending.clear()
+
+
+def _broadcast_agent_presence(agent, online):
+    event = {
+        'type': 'agent.presence',
+        'agent_id': str(agent.id),
+        'agent_name': agent.name,
+        'online': online,
+    }
+    strategy = get_group_strategy()
+    for shard in strategy.agent_shards(agent):
+        async_to_sync(get_channel_layer().group_send)(strategy.queue_group(shard), event)
+    # Visitors currently talking to this agent see them come and go
+    open_conversations = models.Conversation.objects.filter(
+        assigned_agent_id=agent.id, status__in=OPEN_STATUSES
+    ).values_list('id', flat=True)
+    for conversation_id in open_conversations:
+        publish_conversation_event(conversation_id, event, roles=[models.Message.SENDER_VISITOR])
+
+
+def agent_heartbeat(agent):
+    """Keep an agent marked online; returns True if they just came online.
+
+    Presence is a cache key that expires PRESENCE_TTL seconds after the last
+    heartbeat, so the cache must be shared by every process. Each heartbeat
+    also sets SupportAgent.is_online with a conditional UPDATE that changes
+    nothing while the row already says online, which brings back an agent
+    that a sweep marked offline while their socket was still open.
+    """
+    ttl = get_setting('PRESENCE_TTL')
+    key = _presence_key(agent.id)
+    if not cache.touch(key, ttl):
+        cache.set(key, True, ttl)
+    came_online = bool(
+        models.SupportAgent.objects.filter(id=agent.id, is_online=False).update(is_online=True)
+    )
+    if came_online:
+        if get_setting('AUTO_ASSIGN') and agent.is_active:
+            open_chats = models.Conversation.objects.filter(
+                assigned_agent_id=agent.id, status__in=OPEN_STATUSES
+            ).count()
+            engine = get_engine()
+            engine.agent_online(agent, open_chats)
+            engine.assign_waiting()
+        _broadcast_agent_presence(agent, True)
+    sweep_presence()
+    return came_online
+
+
+def set_agents_offline(agent_ids):
+    """Mark agents offline now (logout, expired heartbeat)."""
+    cache.delete_many([_presence_key(agent_id) for agent_id in agent_ids])
+    agents = list(models.SupportAgent.objects.filter(id__in=agent_ids, is_online=True))
+    if not agents:
+        return []
+    models.SupportAgent.objects.filter(id__in=[a.id for a in agents]).update(is_online=False)
+    engine = get_engine()
+    for agent in agents:
+        engine.agent_offline(agent.id)
+        _broadcast_agent_presence(agent, False)
+    return agents
+
+
+def sweep_presence():
+    """Mark agents whose heartbeat expired offline.
+
+    Runs at most once per PRESENCE_HEARTBEAT_INTERVAL across all processes
+    sharing the cache. Returns the agents that went offline.
+    """
+    if not cache.add(SWEEP_LOCK_KEY, True, get_setting('PRESENCE_HEARTBEAT_INTERVAL')):
+        return []
+    online = list(models.SupportAgent.objects.filter(is_online=True).values_list('id', flat=True))
+    if not online:
+        return []
+    alive = cache.get_many([_presence_key(agent_id) for agent_id in online])
+    expired = [agent_id for agent_id in online if _presence_key(agent_id) not in alive]
+    return set_agents_offline(expired) if expired else []
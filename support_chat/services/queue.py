@@ -0,0 +1,67 @@
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from .conversations import get_queue_version, invalidate_queue
+from .groups import get_group_strategy
+from ..metrics import QUEUE_EVENTS
+from ..settings import get_setting
+
+
+def _event_key(seq):
+    return f'support_chat:queue_event:{seq}'
+
+
+def _record_queue_event(event, shard):
+    seq = invalidate_queue()
+    event = dict(event, seq=seq, shard=shard)
+    cache.set(_event_key(seq), event, get_setting('QUEUE_EVENT_RING_TTL'))
+    QUEUE_EVENTS.inc(event=event['type'])
+    return dict(event, sent_at=time.time())
+
+
+def publish_queue_event(event, shard=''):
+    """Broadcast an event to the QueueConsumers of a queue shard.
+
+    Any queue event changes the waiting list, so the cached conversation
+    lists are expired first. The new queue version becomes the event's
+    ``seq`` and the event is kept in the recent-event ring so that
+    reconnecting dashboards can replay what they missed.
+    """
+    event = _record_queue_event(event, shard)
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(get_group_strategy().queue_group(shard), event)
+    return event['seq']
+
+
+async def apublish_queue_event(event, shard=''):
+    """Async variant of publish_queue_event for async views and consumers."""
+    event = await sync_to_async(_record_queue_event)(event, shard)
+    await get_channel_layer().group_send(get_group_strategy().queue_group(shard), event)
+    return event['seq']
+
+
+def get_events_since(last_seq, shards=None):
+    """Return the queue events published after ``last_seq``, oldest first.
+
+    Sequence numbers are shared by all shards; pass ``shards`` to keep only
+    the events of the shards a dashboard subscribes to. Returns None when
+    the client has fallen off the ring (too far behind, events expired, or a
+    sequence from before a cache flush); the caller should then send a full
+    snapshot instead.
+    """
+    current = get_queue_version()
+    if last_seq > current or current - last_seq > get_setting('QUEUE_EVENT_RING_SIZE'):
+        return None
+    keys = [_event_key(seq) for seq in range(last_seq + 1, current + 1)]
+    if not keys:
+        return []
+    found = cache.get_many(keys)
+    if len(found) != len(keys):
+        return None
+    events = [found[key] for key in keys]
+    if shards is not None:
+        events = [event for event in events if event.get('shard', '') in shards]
+    return events
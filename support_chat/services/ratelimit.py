@@ -0,0 +1,200 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.utils.module_loading import import_string
+
+from ..metrics import RATE_LIMITED
+from ..settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBackend:
+    """Token buckets kept in this process, in a bounded LRU.
+
+    Limits are per worker: with N processes a client can get up to N times
+    the configured rate. Use RedisBackend to enforce them cluster-wide.
+    """
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_size = get_setting('RATE_LIMIT_LOCAL_SIZE')
+
+    def consume(self, key, capacity, rate):
+        """Take one token; returns ``(allowed, retry_after_seconds)``."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    async def aconsume(self, key, capacity, rate):
+        return self.consume(key, capacity, rate)
+
+
+class RedisBackend:
+    """Token buckets shared by every worker through Redis (or a compatible server).
+
+    Each bucket is a hash updated atomically by a Lua script using the
+    server clock, so one round trip decides a request.
+    """
+
+    SCRIPT = '''
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local t = redis.call('TIME')
+        local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(state[1]) or capacity
+        local ts = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+        redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+        return {allowed, tostring(tokens)}
+    '''
+
+    def __init__(self):
+        import redis
+        import redis.asyncio
+
+        url = get_setting('RATE_LIMIT_REDIS_URL')
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+        # The asyncio client binds its connections to the event loop it is
+        # first used on, which is the single loop of an ASGI worker
+        self._async_client = redis.asyncio.Redis.from_url(url)
+        self._async_script = self._async_client.register_script(self.SCRIPT)
+
+    @staticmethod
+    def _result(result, rate):
+        allowed, tokens = int(result[0]), float(result[1])
+        return bool(allowed), 0 if allowed else (1 - tokens) / rate
+
+    def consume(self, key, capacity, rate):
+        return self._result(self._script(keys=[key], args=[capacity, rate]), rate)
+
+    async def aconsume(self, key, capacity, rate):
+        return self._result(await self._async_script(keys=[key], args=[capacity, rate]), rate)
+
+
+class RateLimiter:
+    """Applies the RATE_LIMITS rules and counts throttled requests per rule.
+
+    A rule is ``'<scope>:<key type>': (tokens, seconds)``: a bucket of
+    ``tokens`` that refills completely in ``seconds``, one bucket per key
+    (client IP, conversation, visitor email). Backend errors fail open.
+    """
+
+    def __init__(self):
+        self.backend = import_string(get_setting('RATE_LIMIT_BACKEND'))()
+
+    def _rule(self, rule, key):
+        limit = get_setting('RATE_LIMITS').get(rule)
+        if limit is None or key is None or key == '':
+            return None
+        tokens, seconds = limit
+        return f'support_chat:ratelimit:{rule}:{key}', tokens, tokens / seconds
+
+    def _record(self, rule, key, allowed, retry_after):
+        if allowed:
+            return None
+        RATE_LIMITED.inc(rule=rule)
+        logger.info('Rate limit %s exceeded for %s', rule, key)
+        return retry_after
+
+    def check(self, rule, key):
+        """Take a token for key under rule; returns None or seconds to wait."""
+        bucket = self._rule(rule, key)
+        if bucket is None or not get_setting('RATE_LIMIT_ENABLED'):
+            return None
+        try:
+            allowed, retry_after = self.backend.consume(*bucket)
+        except Exception:
+            logger.exception('Rate limit backend failed; allowing %s', rule)
+            return None
+        return self._record(rule, key, allowed, retry_after)
+
+    async def acheck(self, rule, key):
+        """Async variant of check()."""
+        bucket = self._rule(rule, key)
+        if bucket is None or not get_setting('RATE_LIMIT_ENABLED'):
+            return None
+        try:
+            allowed, retry_after = await self.backend.aconsume(*bucket)
+        except Exception:
+            logger.exception('Rate limit backend failed; allowing %s', rule)
+            return None
+        return self._record(rule, key, allowed, retry_after)
+
+    async def acheck_all(self, checks):
+        """Check (rule, key) pairs in order; returns the first wait time or None.
+
+        Every pair is checked even after one fails so that each bucket is
+        charged for the attempt.
+        """
+        retry_after = None
+        for rule, key in checks:
+            wait = await self.acheck(rule, key)
+            if wait is not None and retry_after is None:
+                retry_after = wait
+        return retry_after
+
+    def throttled_counts(self):
+        """Return ``{rule: requests rejected}`` for this process."""
+        return {key[0]: count for key, count in RATE_LIMITED.values().items()}
+
+
+def request_key(request, key_type):
+    """Return the bucket key of an HTTP request for 'ip', 'email' or 'conversation'."""
+    if key_type == 'ip':
+        return request.META.get('REMOTE_ADDR')
+    data = getattr(request, '_rate_limit_data', None)
+    if data is None:
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        request._rate_limit_data = data
+    if key_type == 'email':
+        email = data.get('email')
+        return email.strip().lower() if isinstance(email, str) else None
+    if key_type == 'conversation':
+        # Only the conversation: anything else in the body is up to the client
+        conversation_id = data.get('conversation_id')
+        if not conversation_id:
+            return None
+        try:
+            return str(uuid.UUID(str(conversation_id)))
+        except ValueError:
+            return str(conversation_id)
+    raise ValueError(f'Unknown rate limit key type: {key_type}')
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    """Return the process-wide RateLimiter."""
+    global _limiter
+    path = get_setting('RATE_LIMIT_BACKEND')
+    if _limiter is None or _limiter[0] != path:
+        _limiter = (path, RateLimiter())
+    return _limiter[1]
@@ -0,0 +1,127 @@
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .. import models
+from ..settings import get_setting
+from .messages import serialize_message
+
+# Sorts after every id, so a bare timestamp skips all messages stamped with it
+_LAST_ID = uuid.UUID(int=(1 << 128) - 1)
+
+
+def _seq_key(conversation_id):
+    return f'support_chat:conversation_seq:{conversation_id}'
+
+
+def _message_key(conversation_id, seq):
+    return f'support_chat:conversation_message:{conversation_id}:{seq}'
+
+
+def _parse_time(value):
+    # Clients echo created_at back; match the project's USE_TZ either way
+    moment = datetime.fromisoformat(value)
+    if settings.USE_TZ and timezone.is_naive(moment):
+        return timezone.make_aware(moment)
+    if not settings.USE_TZ and timezone.is_aware(moment):
+        return timezone.make_naive(moment)
+    return moment
+
+
+def _position(message):
+    return datetime.fromisoformat(message['created_at']), uuid.UUID(message['id'])
+
+
+def remember_message(conversation_id, message, roles=None):
+    """Keep a published message in the conversation's recent-message ring.
+
+    Like the queue event ring, each conversation has a sequence counter and
+    one cache entry per message, so concurrent publishers never overwrite
+    each other. Only the last RESUME_RING_SIZE entries are ever read.
+    """
+    key = _seq_key(conversation_id)
+    ttl = get_setting('RESUME_RING_TTL')
+    if cache.add(key, 1, ttl):
+        seq = 1
+    else:
+        try:
+            seq = cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, ttl)
+            seq = 1
+    cache.set(_message_key(conversation_id, seq), {'message': message, 'roles': roles}, ttl)
+
+
+def _recent_entries(conversation_id):
+    # The unbroken run of newest entries, oldest first
+    current = cache.get(_seq_key(conversation_id))
+    if not current:
+        return []
+    seqs = range(max(1, current - get_setting('RESUME_RING_SIZE') + 1), current + 1)
+    found = cache.get_many([_message_key(conversation_id, seq) for seq in seqs])
+    entries = []
+    for seq in reversed(seqs):
+        entry = found.get(_message_key(conversation_id, seq))
+        if entry is None:
+            break
+        entries.append(entry)
+    entries.reverse()
+    return entries
+
+
+def _message_position(conversation_id, message_id, entries):
+    for entry in entries:
+        if entry['message']['id'] == message_id:
+            return _position(entry['message'])
+    created_at = (
+        models.Message.objects.filter(conversation_id=conversation_id, id=message_id)
+        .values_list('created_at', flat=True).first()
+    )
+    return (created_at, uuid.UUID(message_id)) if created_at else None
+
+
+def get_missed_messages(conversation_id, last_id=None, since=None):
+    """Return the messages published after the client's last seen one.
+
+    ``last_id`` is the id of the last message the client saw; ``since`` its
+    created_at, used alone when the id is unknown. Messages come back as
+    ``{'message': ..., 'roles': ...}`` entries, oldest first and at most
+    RESUME_MAX_MESSAGES (the newest ones). Without a position, the latest
+    messages are returned, which is what a reloaded page needs.
+
+    The recent-message ring answers when it reaches back to the client's
+    position; otherwise the (conversation, created_at) index is used and the
+    ring's messages are merged in, as they may still sit in the write-behind
+    buffer.
+    """
+    limit = get_setting('RESUME_MAX_MESSAGES')
+    entries = _recent_entries(conversation_id)
+    after = None
+    try:
+        if last_id:
+            uuid.UUID(last_id)
+            after = _message_position(conversation_id, last_id, entries)
+        if after is None and since:
+            after = _parse_time(since), _LAST_ID
+    except (TypeError, ValueError):
+        after = None
+
+    if after is not None and entries and _position(entries[0]['message']) <= after:
+        missed = [entry for entry in entries if _position(entry['message']) > after]
+        return missed[-limit:]
+
+    qs = models.Message.objects.filter(conversation_id=conversation_id)
+    if after is not None:
+        created_at, message_id = after
+        qs = qs.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id))
+    rows = list(qs.order_by('-created_at', '-id')[:limit])
+    missed = {str(m.id): {'message': serialize_message(m), 'roles': None} for m in rows}
+    for entry in entries:
+        if after is None or _position(entry['message']) > after:
+            missed.setdefault(entry['message']['id'], entry)
+    ordered = sorted(missed.values(), key=lambda entry: _position(entry['message']))
+    return ordered[-limit:]
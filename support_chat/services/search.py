@@ -0,0 +1,423 @@
+import json
+import logging
+import math
+import os
+import queue
+import re
+import threading
+import uuid
+from collections import Counter
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .. import models
+from ..settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Split text into lowercase search terms."""
+    return [t[:64] for t in _TOKEN_RE.findall((text or '').lower()) if len(t) > 1 or t.isdigit()]
+
+
+def _indexable(messages):
+    return [m for m in messages if m.sender_type != models.Message.SENDER_SYSTEM and m.message]
+
+
+class SearchBackend:
+    """Interface of search backends (SUPPORT_CHAT['SEARCH_BACKEND']).
+
+    Backends are told about every new conversation and message and answer
+    ranked queries over the conversations assigned to one agent.
+    """
+
+    def index_conversation(self, conversation, visitor):
+        """Index the visitor details of a new conversation."""
+
+    def index_messages(self, messages):
+        """Index newly saved messages."""
+
+    def search(self, query, agent, offset, limit):
+        """Return ``(total, hits)`` where hits are ``(conversation_id, message_id, score)``.
+
+        Hits are ranked best first, one per conversation; message_id is None
+        when only the visitor details matched.
+        """
+        raise NotImplementedError
+
+    def rebuild(self):
+        """Re-index everything in the database."""
+
+
+class InvertedIndexBackend(SearchBackend):
+    """In-process inverted index, persisted as an append-only journal.
+
+    Every indexed document (a message, or a conversation's visitor details)
+    is appended to SEARCH_INDEX_PATH as one JSON line of term counts and
+    applied to in-memory posting lists. Before each query the journal is
+    read from the last known offset, so every process sharing the file sees
+    documents indexed by the others. Queries only consider documents of the
+    agent's own conversations, match those containing all terms and rank
+    them with BM25.
+
+    The journal only grows; ``rebuild()`` (``rebuild_search_index``, also run
+    by ``archive_conversations``) rewrites it from the database, dropping
+    archived and deleted rows.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, path=None):
+        self.path = path or get_setting('SEARCH_INDEX_PATH')
+        if not self.path or not os.path.isabs(self.path):
+            raise ImproperlyConfigured('InvertedIndexBackend requires an absolute SEARCH_INDEX_PATH.')
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self, inode=None):
+        self._inode = inode
+        self._offset = 0
+        self._postings = {}
+        self._conversations = []
+        self._conversation_ix = {}
+        # Per conversation: its document ids
+        self._conversation_docs = []
+        # Per document: conversation index, message id (None for visitor
+        # documents) and length in terms
+        self._doc_conversation = []
+        self._doc_message = []
+        self._doc_length = []
+        self._total_length = 0
+
+    def _document(self, conversation_id, message_id, text):
+        terms = Counter(tokenize(text))
+        if not terms:
+            return None
+        return json.dumps({
+            'c': str(conversation_id),
+            'm': str(message_id) if message_id else None,
+            't': terms,
+        }, separators=(',', ':'))
+
+    def _append(self, lines):
+        lines = [line for line in lines if line]
+        if not lines:
+            return
+        with self._lock:
+            # O_APPEND keeps lines from concurrent processes intact; they are
+            # applied, ours included, by the catch-up below in file order
+            with open(self.path, 'a', encoding='utf-8') as fh:
+                fh.write(''.join(line + '\n' for line in lines))
+            self._catch_up()
+
+    def _catch_up(self):
+        try:
+            fh = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with fh:
+            inode = os.fstat(fh.fileno()).st_ino
+            if inode != self._inode:
+                # First read, or the journal was replaced by rebuild()
+                self._reset(inode)
+            fh.seek(self._offset)
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    # Still being written by another process
+                    break
+                self._offset += len(line)
+                try:
+                    self._apply(json.loads(line))
+                except ValueError:
+                    logger.warning('Skipping corrupt search index line at offset %d', self._offset - len(line))
+
+    def _apply(self, doc):
+        conversation = self._conversation_ix.get(doc['c'])
+        if conversation is None:
+            conversation = self._conversation_ix[doc['c']] = len(self._conversations)
+            self._conversations.append(doc['c'])
+            self._conversation_docs.append([])
+        doc_id = len(self._doc_conversation)
+        self._conversation_docs[conversation].append(doc_id)
+        self._doc_conversation.append(conversation)
+        self._doc_message.append(doc['m'])
+        length = sum(doc['t'].values())
+        self._doc_length.append(length)
+        self._total_length += length
+        for term, count in doc['t'].items():
+            self._postings.setdefault(term, {})[doc_id] = count
+
+    def index_conversation(self, conversation, visitor):
+        self._append([self._document(conversation.id, None, f'{visitor.name} {visitor.email}')])
+
+    def index_messages(self, messages):
+        self._append([self._document(m.conversation_id, m.id, m.message) for m in _indexable(messages)])
+
+    def _rank(self, terms, conversations):
+        postings = sorted((self._postings.get(term, {}) for term in set(terms)), key=len)
+        if not postings or not postings[0] or not conversations:
+            return []
+        count = len(self._doc_length)
+        average = self._total_length / count
+        weights = [math.log(1 + (count - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+
+        # Walk whichever is shorter: the rarest term's postings or the
+        # documents of the given conversations
+        candidates = [doc_id for c in conversations for doc_id in self._conversation_docs[c]]
+        if len(candidates) >= len(postings[0]):
+            candidates = (doc_id for doc_id in postings[0] if self._doc_conversation[doc_id] in conversations)
+        best = {}
+        for doc_id in candidates:
+            length_norm = self.K1 * (1 - self.B + self.B * self._doc_length[doc_id] / average)
+            score = 0.0
+            for weight, posting in zip(weights, postings):
+                tf = posting.get(doc_id)
+                if tf is None:
+                    break
+                score += weight * tf * (self.K1 + 1) / (tf + length_norm)
+            else:
+                conversation = self._doc_conversation[doc_id]
+                # Prefer message hits over visitor hits, then newer messages
+                key = (score, self._doc_message[doc_id] is not None, doc_id)
+                if conversation not in best or key > best[conversation]:
+                    best[conversation] = key
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)
+        return [
+            (self._conversations[conversation], self._doc_message[key[2]], key[0])
+            for conversation, key in ranked
+        ]
+
+    def search(self, query, agent, offset, limit):
+        terms = tokenize(query)
+        if not terms:
+            return 0, []
+        owned = [
+            str(pk) for pk in
+            models.Conversation.objects.filter(assigned_agent=agent).values_list('id', flat=True)
+        ]
+        with self._lock:
+            self._catch_up()
+            conversations = {self._conversation_ix[c] for c in owned if c in self._conversation_ix}
+            ranked = self._rank(terms, conversations)
+        return len(ranked), ranked[offset:offset + limit]
+
+    def rebuild(self):
+        with self._lock:
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as fh:
+                conversations = (
+                    models.Conversation.objects
+                    .values_list('id', 'visitor__name', 'visitor__email')
+                    .iterator(chunk_size=2000)
+                )
+                for conversation_id, name, email in conversations:
+                    line = self._document(conversation_id, None, f'{name} {email}')
+                    if line:
+                        fh.write(line + '\n')
+                messages = (
+                    models.Message.objects
+                    .exclude(sender_type=models.Message.SENDER_SYSTEM)
+                    .order_by('created_at', 'id')
+                    .values_list('conversation_id', 'id', 'message')
+                    .iterator(chunk_size=2000)
+                )
+                for conversation_id, message_id, text in messages:
+                    line = self._document(conversation_id, message_id, text)
+                    if line:
+                        fh.write(line + '\n')
+            os.replace(tmp_path, self.path)
+            self._reset()
+            self._catch_up()
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """PostgreSQL full-text search over the messages and visitors tables.
+
+    Nothing is indexed in Python: migration 0007 adds a GIN index on
+    to_tsvector('simple', message) when the database is PostgreSQL.
+    """
+
+    SQL = '''
+        WITH q AS (SELECT plainto_tsquery('simple', %s) AS query),
+        hits AS (
+            SELECT m.conversation_id, m.id AS message_id,
+                   ts_rank(to_tsvector('simple', m.message), q.query) AS score
+            FROM {message} m JOIN {conversation} c ON c.id = m.conversation_id, q
+            WHERE c.assigned_agent_id = %s AND to_tsvector('simple', m.message) @@ q.query
+            UNION ALL
+            SELECT c.id, NULL, ts_rank(to_tsvector('simple', v.name || ' ' || v.email), q.query)
+            FROM {conversation} c JOIN {visitor} v ON v.id = c.visitor_id, q
+            WHERE c.assigned_agent_id = %s
+              AND to_tsvector('simple', v.name || ' ' || v.email) @@ q.query
+        )
+        SELECT conversation_id,
+               (array_agg(message_id ORDER BY message_id IS NULL, score DESC))[1],
+               MAX(score) AS best,
+               COUNT(*) OVER ()
+        FROM hits
+        GROUP BY conversation_id
+        ORDER BY best DESC, conversation_id
+        LIMIT %s OFFSET %s
+    '''
+
+    def search(self, query, agent, offset, limit):
+        if connection.vendor != 'postgresql':
+            raise ImproperlyConfigured('DatabaseSearchBackend requires PostgreSQL.')
+        if not tokenize(query):
+            return 0, []
+        sql = self.SQL.format(
+            message=connection.ops.quote_name(models.Message._meta.db_table),
+            conversation=connection.ops.quote_name(models.Conversation._meta.db_table),
+            visitor=connection.ops.quote_name(models.Visitor._meta.db_table),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [query, agent.id, agent.id, limit, offset])
+            rows = cursor.fetchall()
+        total = rows[0][3] if rows else 0
+        return total, [
+            (str(conversation_id), str(message_id) if message_id else None, float(score))
+            for conversation_id, message_id, score, _ in rows
+        ]
+
+
+_backend = None
+
+
+def get_search_backend():
+    """Return the configured search backend instance, or None when search is off."""
+    global _backend
+    path = get_setting('SEARCH_BACKEND')
+    if not path:
+        return None
+    if _backend is None or _backend[0] != path:
+        _backend = (path, import_string(path)())
+    return _backend[1]
+
+
+class SearchIndexer:
+    """Hands new conversations and messages to the search backend off the request path.
+
+    Writers only enqueue; a daemon thread per process passes everything
+    queued so far to the backend in one batch. Whatever is still queued when
+    a process exits is lost until ``rebuild_search_index`` runs.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, conversations=(), messages=()):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='support-chat-search-indexer', daemon=True)
+                self._thread.start()
+        self._queue.put((list(conversations), list(messages)))
+
+    def _run(self):
+        while True:
+            batches = [self._queue.get()]
+            while True:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.index(
+                [item for conversations, _ in batches for item in conversations],
+                [m for _, messages in batches for m in messages],
+            )
+
+    def index(self, conversations, messages):
+        backend = get_search_backend()
+        if backend is None:
+            return
+        for conversation, visitor in conversations:
+            try:
+                backend.index_conversation(conversation, visitor)
+            except Exception:
+                logger.exception('Failed to index conversation %s', conversation.id)
+        if messages:
+            try:
+                backend.index_messages(messages)
+            except Exception:
+                logger.exception('Failed to index %d messages', len(messages))
+
+
+_indexer = None
+_indexer_lock = threading.Lock()
+
+
+def get_search_indexer():
+    """Return the process-wide SearchIndexer."""
+    global _indexer
+    with _indexer_lock:
+        if _indexer is None:
+            _indexer = SearchIndexer()
+        return _indexer
+
+
+def index_messages(messages):
+    """Queue newly saved messages for indexing; never blocks or fails a write."""
+    if messages and get_setting('SEARCH_BACKEND'):
+        get_search_indexer().put(messages=messages)
+
+
+def index_conversation(conversation, visitor):
+    """Queue a new conversation's visitor details for indexing."""
+    if get_setting('SEARCH_BACKEND'):
+        get_search_indexer().put(conversations=[(conversation, visitor)])
+
+
+def _snippet(text, terms, width=160):
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms]
+    start = min((p for p in positions if p >= 0), default=0)
+    start = max(0, start - width // 4)
+    snippet = text[start:start + width]
+    if start:
+        snippet = '…' + snippet
+    if start + width < len(text):
+        snippet += '…'
+    return snippet
+
+
+def search_conversations(agent, query, page=1, page_size=None):
+    """Return one page of the agent's conversations matching query, best first.
+
+    Callers check that a SEARCH_BACKEND is configured first.
+    """
+    page_size = max(1, min(page_size or get_setting('SEARCH_PAGE_SIZE'), get_setting('SEARCH_MAX_PAGE_SIZE')))
+    page = max(1, page)
+    total, hits = get_search_backend().search(query, agent, (page - 1) * page_size, page_size)
+
+    conversations = models.Conversation.objects.select_related('visitor').in_bulk([h[0] for h in hits])
+    messages = models.Message.objects.in_bulk([h[1] for h in hits if h[1]])
+    terms = tokenize(query)
+    results = []
+    for conversation_id, message_id, score in hits:
+        # Hits for deleted conversations or archived messages are skipped
+        conversation = conversations.get(uuid.UUID(conversation_id))
+        if conversation is None:
+            continue
+        message = messages.get(uuid.UUID(message_id)) if message_id else None
+        results.append({
+            'conversation_id': str(conversation.id),
+            'visitor_name': conversation.visitor.name,
+            'visitor_email': conversation.visitor.email,
+            'status': conversation.status,
+            'started_at': conversation.started_at.isoformat(),
+            'score': round(score, 4),
+            'message': {
+                'id': str(message.id),
+                'sender_type': message.sender_type,
+                'snippet': _snippet(message.message, terms),
+                'created_at': message.created_at.isoformat(),
+            } if message else None,
+        })
+    return {'total': total, 'page': page, 'page_size': page_size, 'results': results}
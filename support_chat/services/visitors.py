@@ -0,0 +1,117 @@
+from django.core.cache import cache
+from django.db.models import OuterRef, Subquery
+
+from .. import models
+from ..settings import get_setting
+from .auth import get_visitor_from_browser_token
+
+HISTORY_FIELDS = ('id', 'status', 'started_at', 'ended_at', 'rating', 'assigned_agent__name')
+
+
+def normalize_email(email):
+    return email.strip().lower() if isinstance(email, str) else ''
+
+
+def _visitor_key(visitor_id):
+    return f'support_chat:visitor:{visitor_id}'
+
+
+def _cache_entry(entry):
+    cache.set(_visitor_key(entry['visitor'].id), entry, get_setting('VISITOR_CACHE_TTL'))
+    return entry
+
+
+def _lookup(visitor_id):
+    entry = cache.get(_visitor_key(visitor_id))
+    if entry is not None:
+        return entry
+    # The visitor and their latest conversation id in one query
+    latest = (
+        models.Conversation.objects.filter(visitor=OuterRef('pk'))
+        .order_by('-started_at').values('id')[:1]
+    )
+    visitor = (
+        models.Visitor.objects.filter(id=visitor_id)
+        .annotate(last_conversation_id=Subquery(latest))
+        .first()
+    )
+    if visitor is None:
+        return None
+    return _cache_entry({'visitor': visitor, 'last_conversation': visitor.last_conversation_id})
+
+
+def resolve_visitor(name, email, mobile=None, ip_address=None, user_agent='', browser_token=None):
+    """Return ``(visitor, previous conversation id)`` for a new widget session.
+
+    Only the visitor named by a valid signed browser token is reused, and
+    only when the email matches theirs (case-insensitively); changed contact
+    details are then written back to it. Anyone else gets a new visitor with
+    no previous conversation: an email alone proves nothing, so it never
+    touches another visitor's row or links to their history. Lookups go
+    through the cache, so a returning visitor usually costs no query; on a
+    miss, one query by primary key also finds their latest conversation.
+    """
+    email = normalize_email(email)
+    entry = None
+    visitor_id = get_visitor_from_browser_token(browser_token) if browser_token else None
+    if visitor_id is not None:
+        entry = _lookup(visitor_id)
+        # Someone else on a shared browser
+        if entry is not None and normalize_email(entry['visitor'].email) != email:
+            entry = None
+
+    if entry is None:
+        visitor = models.Visitor.objects.create(
+            name=name, email=email, mobile=mobile, ip_address=ip_address, user_agent=user_agent
+        )
+        _cache_entry({'visitor': visitor, 'last_conversation': None})
+        return visitor, None
+
+    visitor = entry['visitor']
+    changes = {
+        field: value
+        for field, value in (('name', name), ('mobile', mobile), ('ip_address', ip_address), ('user_agent', user_agent))
+        if value and getattr(visitor, field) != value
+    }
+    if changes:
+        models.Visitor.objects.filter(id=visitor.id).update(**changes)
+        for field, value in changes.items():
+            setattr(visitor, field, value)
+        _cache_entry(entry)
+    return visitor, entry['last_conversation']
+
+
+def remember_conversation(visitor, conversation_id):
+    """Record the visitor's newest conversation so the next one can link to it."""
+    _cache_entry({'visitor': visitor, 'last_conversation': conversation_id})
+
+
+def get_visitor_conversations(conversation_id, agent, limit=None):
+    """Return the other conversations of a conversation's visitor, newest first.
+
+    One query through the (visitor, started_at) index; the conversation
+    itself is fetched along with them to check that ``agent`` is assigned
+    to it. Returns None when they are not.
+    """
+    max_size = get_setting('VISITOR_HISTORY_LIMIT')
+    limit = max(1, min(limit or max_size, max_size))
+    visitor = models.Conversation.objects.filter(id=conversation_id, assigned_agent=agent).values('visitor_id')[:1]
+    rows = list(
+        models.Conversation.objects.filter(visitor_id=Subquery(visitor))
+        .order_by('-started_at').values(*HISTORY_FIELDS)[:limit + 1]
+    )
+    if not any(row['id'] == conversation_id for row in rows):
+        # Either not authorized, or the conversation is older than the window
+        if not models.Conversation.objects.filter(id=conversation_id, assigned_agent=agent).exists():
+            return None
+    return [
+        {
+            'id': str(row['id']),
+            'status': row['status'],
+            'started_at': row['started_at'].isoformat(),
+            'ended_at': row['ended_at'].isoformat() if row['ended_at'] else None,
+            'rating': row['rating'],
+            'agent_name': row['assigned_agent__name'],
+        }
+        for row in rows if row['id'] != conversation_id
+    ][:limit]
@@ -1,6 +1,156 @@
 # Default configuration for support_chat package
+import os
+
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+
 SUPPORT_CHAT = {
     'SOCKET_URL': '',
     'AUTO_GREETING': 'Hello! How may I help you?',
     'MAX_CONVERSATION_TIME': 3600,
+    # Conversation sweeper (services/lifecycle.py): waiting conversations are
+    # abandoned after ABANDON_WAITING_AFTER seconds and open ones closed after
+    # MAX_CONVERSATION_TIME (None disables either). It runs at most every
+    # CONVERSATION_SWEEP_INTERVAL seconds from `manage.py sweep_conversations
+    # --loop`, or from agent sockets' heartbeat when CONVERSATION_SWEEP_IN_PROCESS
+    # is set (needs a cache shared by all workers)
+    'ABANDON_WAITING_AFTER': 1800,
+    'CONVERSATION_SWEEP_INTERVAL': 60,
+    'CONVERSATION_SWEEP_BATCH_SIZE': 500,
+    'CONVERSATION_SWEEP_IN_PROCESS': False,
+    # Write-behind message persistence: broadcast first, bulk insert later
+    'MESSAGE_WRITE_BEHIND': False,
+    'MESSAGE_FLUSH_SIZE': 500,
+    'MESSAGE_FLUSH_INTERVAL': 0.05,
+    # Agent chat history pagination
+    'HISTORY_PAGE_SIZE': 50,
+    'HISTORY_MAX_PAGE_SIZE': 200,
+    # Agent conversation lists: per-bucket limits and cache lifetime (seconds)
+    'WAITING_LIST_LIMIT': 100,
+    'ACTIVE_LIST_LIMIT': 50,
+    'CLOSED_LIST_LIMIT': 20,
+    'CONVERSATION_LIST_CACHE_TTL': 5,
+    # Recent queue events kept for reconnecting dashboards to replay
+    'QUEUE_EVENT_RING_SIZE': 500,
+    'QUEUE_EVENT_RING_TTL': 600,
+    # Recent messages per conversation that reconnecting sockets replay
+    # from, and the most messages one resume sends
+    'RESUME_RING_SIZE': 50,
+    'RESUME_RING_TTL': 3600,
+    'RESUME_MAX_MESSAGES': 100,
+    # OTP outbox: mail backend (None for EMAIL_BACKEND), whether web workers
+    # run the sender thread, retry delay and pooled connection idle time
+    # (seconds), rows per batch, and after how long (seconds) a row claimed
+    # by a sender that never finished is sent again
+    'OTP_EMAIL_BACKEND': None,
+    'OTP_OUTBOX_THREAD': True,
+    'OTP_RETRY_INTERVAL': 30,
+    'OTP_CONNECTION_IDLE': 60,
+    'OTP_SEND_BATCH_SIZE': 50,
+    'OTP_CLAIM_TIMEOUT': 300,
+    # purge_auth_records: how long expired OTPs are kept (seconds), rows per delete
+    'OTP_RETENTION': 24 * 3600,
+    'AUTH_PURGE_BATCH_SIZE': 1000,
+    # Returning visitors: how long the widget's browser token stays valid,
+    # how long resolved visitors are cached (seconds), and how many earlier
+    # conversations the agent API returns at most
+    'BROWSER_TOKEN_MAX_AGE': 365 * 24 * 3600,
+    'VISITOR_CACHE_TTL': 300,
+    'VISITOR_HISTORY_LIMIT': 20,
+    # Route new conversations to the least-loaded online agent
+    'AUTO_ASSIGN': False,
+    'AUTO_ASSIGN_RECONCILE_INTERVAL': 60,
+    # Agent session lookups: cache lifetime, LRU size, optional shared cache
+    # alias, and how stale last_activity may get before it is written back
+    'SESSION_CACHE_TTL': 30,
+    'SESSION_CACHE_SIZE': 1024,
+    'SESSION_CACHE_BACKEND': None,
+    'SESSION_TOUCH_INTERVAL': 60,
+    # Typing/activity events: at most one per sender per window (seconds);
+    # agent presence expires PRESENCE_TTL seconds after the last heartbeat
+    'TYPING_WINDOW': 1.0,
+    'PRESENCE_TTL': 45,
+    'PRESENCE_HEARTBEAT_INTERVAL': 15,
+    # Channel-layer group naming and queue sharding (see services/groups.py)
+    'GROUP_STRATEGY': 'support_chat.services.groups.GroupStrategy',
+    'QUEUE_SHARDS': 8,
+    'QUEUE_SHARDS_PER_AGENT': 1,
+    # Archiving of ended conversations (archive_conversations command)
+    'ARCHIVE_AFTER_DAYS': 90,
+    'ARCHIVE_CHUNK_SIZE': 500,
+    'ARCHIVE_DELETE_BATCH_SIZE': 1000,
+    'ARCHIVE_STORAGE': None,
+    # Absolute directory used when ARCHIVE_STORAGE is unset; None for
+    # support_chat_archive under BASE_DIR
+    'ARCHIVE_DIR': None,
+    'ARCHIVE_CACHE_TTL': 300,
+    # Agent search (see services/search.py), off unless a backend is set;
+    # InvertedIndexBackend needs an absolute path for its journal file
+    'SEARCH_BACKEND': None,
+    'SEARCH_INDEX_PATH': None,
+    'SEARCH_PAGE_SIZE': 20,
+    'SEARCH_MAX_PAGE_SIZE': 50,
+    # Token-bucket rate limits for visitor traffic: '<scope>:<key>' ->
+    # (tokens, seconds to refill them all), keyed by client IP, visitor
+    # email or conversation. Use RedisBackend to share buckets across workers.
+    'RATE_LIMIT_ENABLED': True,
+    'RATE_LIMIT_BACKEND': 'support_chat.services.ratelimit.LocalBackend',
+    'RATE_LIMIT_REDIS_URL': 'redis://127.0.0.1:6379/0',
+    'RATE_LIMIT_LOCAL_SIZE': 10000,
+    'RATE_LIMITS': {
+        'create_session:ip': (10, 60),
+        'create_session:email': (5, 300),
+        'message:ip': (60, 60),
+        'message:conversation': (30, 30),
+        'feedback:ip': (10, 60),
+        'frame:conversation': (60, 10),
+    },
+    # Conversations one multiplexed agent socket may subscribe to at once
+    'AGENT_SOCKET_MAX_SUBSCRIPTIONS': 20,
+    # Per-socket send queues, off by default: they only notice slow clients
+    # when the ASGI server's send waits for the client (not under Daphne).
+    # Frames kept for a slow client, what to do when the queue is full
+    # (drop_oldest, coalesce or disconnect) and how long one send may take
+    # before the socket is closed
+    'SEND_QUEUE_ENABLED': False,
+    'SEND_QUEUE_SIZE': 100,
+    'SEND_QUEUE_POLICY': 'coalesce',
+    'SEND_TIMEOUT': 10,
+    # Widget bundles built by build_widget_assets (an absolute directory;
+    # None for support_chat_assets under BASE_DIR), and how long browsers
+    # may cache them (seconds; file names change with their content)
+    'WIDGET_ASSET_DIR': None,
+    'WIDGET_ASSET_MAX_AGE': 365 * 24 * 3600,
+    # Compact socket encodings clients may negotiate (see protocol.py);
+    # verbose support_chat.v1 frames are always available
+    'WS_COMPACT_PROTOCOLS': ('support_chat.v2.msgpack', 'support_chat.v2.json'),
+    # Prometheus endpoint at <prefix>/metrics, served only when enabled and
+    # METRICS_TOKEN is set; scrapers send "Authorization: Bearer <token>"
+    'METRICS_ENABLED': False,
+    'METRICS_TOKEN': None,
 }
+
+
+def get_setting(name):
+    """Return a SUPPORT_CHAT option, preferring the project's override."""
+    overrides = getattr(django_settings, 'SUPPORT_CHAT', {})
+    return overrides.get(name, SUPPORT_CHAT[name])
+
+
+def get_path_setting(name, default):
+    """Return a SUPPORT_CHAT directory option as an absolute path.
+
+    None means ``default`` under the project's BASE_DIR. Relative paths are
+    rejected, since each process would resolve them against its own
+    working directory.
+    """
+    path = get_setting(name)
+    if path is None:
+        base_dir = getattr(django_settings, 'BASE_DIR', None)
+        if base_dir is None:
+            raise ImproperlyConfigured(f'Set SUPPORT_CHAT {name} to an absolute path or define BASE_DIR.')
+        path = os.path.join(base_dir, default)
+    path = os.fspath(path)
+    if not os.path.isabs(path):
+        raise ImproperlyConfigured(f'SUPPORT_CHAT {name} must be an absolute path.')
+    return path
@@ -0,0 +1,72 @@
+// Loads the chat widget on demand. The page only renders the launcher
+// button; the widget markup, styles and scripts follow once the browser is
+// idle, the visitor reaches for the button, or this tab already has a
+// conversation. widget.js opens a socket only when a session starts.
+(function () {
+  var IDLE_TIMEOUT_MS = 5000;
+  // Same key as widget.js
+  var STORAGE_KEY = 'support_chat_session';
+  var root = document.getElementById('support-chat-root');
+  var fab = document.getElementById('support-chat-open');
+  if (!root || !fab) return;
+  var loading = false;
+  var openOnLoad = false;
+
+  function hasSession() {
+    try {
+      return !!sessionStorage.getItem(STORAGE_KEY);
+    } catch (e) {
+      return false;
+    }
+  }
+
+  function start() {
+    window.SupportChat.init({ws_url: root.getAttribute('data-socket-url') || undefined});
+    // The widget's own click handler is bound now
+    if (openOnLoad) fab.click();
+  }
+
+  function load() {
+    if (loading) return;
+    loading = true;
+    var css = document.createElement('link');
+    css.rel = 'stylesheet';
+    css.href = root.getAttribute('data-css');
+    document.head.appendChild(css);
+    var markup = document.getElementById('support-chat-markup');
+    if (markup) root.appendChild(markup.content.cloneNode(true));
+    var scripts = root.getAttribute('data-scripts').split(' ');
+    scripts.forEach(function (src, i) {
+      var script = document.createElement('script');
+      script.src = src;
+      // Dynamic scripts run in insertion order only with async off
+      script.async = false;
+      if (i === scripts.length - 1) script.onload = start;
+      document.head.appendChild(script);
+    });
+  }
+
+  function loadWhenIdle() {
+    if (window.requestIdleCallback) {
+      window.requestIdleCallback(load, {timeout: IDLE_TIMEOUT_MS});
+    } else {
+      setTimeout(load, 1);
+    }
+  }
+
+  fab.addEventListener('click', function () {
+    openOnLoad = true;
+    load();
+  });
+  ['pointerenter', 'touchstart', 'focus'].forEach(function (type) {
+    fab.addEventListener(type, load, {passive: true});
+  });
+
+  if (hasSession()) {
+    load();
+  } else if (document.readyState === 'complete') {
+    loadWhenIdle();
+  } else {
+    window.addEventListener('load', loadWhenIdle);
+  }
+})();
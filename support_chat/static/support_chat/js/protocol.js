@@ -0,0 +1,94 @@
+// Socket frame encodings shared by the widget and the agent dashboard.
+// Mirrors support_chat/protocol.py: sockets offer the compact v2 encodings
+// and fall back to verbose v1 JSON; MessagePack is used only when a
+// MessagePack global (e.g. @msgpack/msgpack) is loaded on the page.
+var SupportChatProtocol = (function () {
+  var V1 = 'support_chat.v1';
+  var V2_JSON = 'support_chat.v2.json';
+  var V2_MSGPACK = 'support_chat.v2.msgpack';
+
+  var KEYS = {
+    type: 't', payload: 'p', message: 'm', id: 'i', conversation: 'cv', conversation_id: 'c',
+    sender_type: 's', sender_id: 'u', created_at: 'ts', seq: 'q', last_seq: 'lq',
+    visitor_name: 'n', visitor_email: 'e', agent_id: 'a', agent_name: 'an', typing: 'ty',
+    state: 'st', online: 'o', waiting: 'w', status: 'x', retry_after: 'ra', messages: 'ms',
+    last_id: 'li', since: 'sn', conversation_ids: 'cs'
+  };
+  var TYPES = {
+    message: 'm', typing: 'ty', activity: 'ac', close_conversation: 'cl', resume: 'r',
+    conversation_closed: 'cc', visitor_presence: 'vp', agent_presence: 'ap', rate_limited: 'rl',
+    new_conversation: 'nc', conversation_accepted: 'ca', queue_snapshot: 'qs', agent_assigned: 'aa',
+    replay: 'rp', conversations_removed: 'cr', subscribe: 'sb', unsubscribe: 'us', subscribed: 'sd',
+    unsubscribed: 'ud'
+  };
+  var SENDERS = {visitor: 'v', agent: 'a', system: 's'};
+
+  function invert(map) {
+    var out = {};
+    Object.keys(map).forEach(function (key) { out[map[key]] = key; });
+    return out;
+  }
+
+  var LONG_KEYS = invert(KEYS);
+  var LONG_TYPES = invert(TYPES);
+  var LONG_SENDERS = invert(SENDERS);
+
+  function isObject(value) {
+    return value !== null && typeof value === 'object' && !Array.isArray(value);
+  }
+
+  function compact(frame) {
+    var out = {};
+    Object.keys(frame).forEach(function (key) {
+      var value = frame[key];
+      if (key === 'type') value = TYPES[value] || value;
+      else if (key === 'sender_type') value = SENDERS[value] || value;
+      else if (isObject(value)) value = compact(value);
+      out[KEYS[key] || key] = value;
+    });
+    return out;
+  }
+
+  function expand(frame) {
+    var out = {};
+    Object.keys(frame).forEach(function (short) {
+      var key = LONG_KEYS[short] || short;
+      var value = frame[short];
+      if (key === 'type') value = LONG_TYPES[value] || value;
+      else if (key === 'sender_type') value = LONG_SENDERS[value] || value;
+      else if (key === 'created_at' && typeof value === 'number') value = new Date(value).toISOString();
+      else if (Array.isArray(value)) value = value.map(function (item) { return isObject(item) ? expand(item) : item; });
+      else if (isObject(value)) value = expand(value);
+      out[key] = value;
+    });
+    return out;
+  }
+
+  function offered() {
+    var protocols = [V2_JSON, V1];
+    if (window.MessagePack) protocols.unshift(V2_MSGPACK);
+    return protocols;
+  }
+
+  // Open a socket offering every encoding this page can handle
+  function open(url) {
+    var ws = new WebSocket(url, offered());
+    ws.binaryType = 'arraybuffer';
+    return ws;
+  }
+
+  // Parse a received frame into the verbose v1 shape
+  function decode(ws, data) {
+    if (ws.protocol !== V2_JSON && ws.protocol !== V2_MSGPACK) return JSON.parse(data);
+    var frame = typeof data === 'string' ? JSON.parse(data) : window.MessagePack.decode(new Uint8Array(data));
+    return expand(frame);
+  }
+
+  function encode(ws, frame) {
+    if (ws.protocol === V2_MSGPACK) return window.MessagePack.encode(compact(frame));
+    if (ws.protocol === V2_JSON) return JSON.stringify(compact(frame));
+    return JSON.stringify(frame);
+  }
+
+  return {open: open, decode: decode, encode: encode};
+})();
@@ -2,18 +2,49 @@ var SupportChat = (function () {
   var config = {};
   var state = {
     conv: null,
+    token: null,
     ws: null,
     connected: false,
     visitor_name: null,
     visitor_email: null,
     rating: 0,
+    typing: false,
+    typingTimer: null,
+    // Last message seen, sent back when (re)connecting to replay what was missed
+    lastId: null,
+    lastAt: null,
+    replayAll: false,
+    retries: 0,
+    reconnectTimer: null,
+  };
+
+  // Stop showing "typing" this long after the last keystroke
+  var TYPING_IDLE_MS = 3000;
+  // Reconnect delays double from RECONNECT_BASE_MS up to RECONNECT_MAX_MS
+  var RECONNECT_BASE_MS = 1000;
+  var RECONNECT_MAX_MS = 30000;
+  var RECONNECT_ATTEMPTS = 10;
+  // loader.js checks this key too
+  var STORAGE_KEY = 'support_chat_session';
+  var BROWSER_TOKEN_KEY = 'support_chat_browser';
+  var RATE_LIMITED_TEXT = 'You are sending messages too quickly. Your last message was not delivered.';
+  // Compact frames when protocol.js is on the page, plain JSON otherwise
+  var protocol = window.SupportChatProtocol || {
+    open: function (url) { return new WebSocket(url); },
+    decode: function (ws, data) { return JSON.parse(data); },
+    encode: function (ws, frame) { return JSON.stringify(frame); }
   };
 
   function init(opts) {
     config = opts || {};
-    document.addEventListener('DOMContentLoaded', function () {
+    // loader.js calls this once the page has been parsed
+    if (document.readyState === 'loading') {
+      document.addEventListener('DOMContentLoaded', function () {
+        bindUI();
+      });
+    } else {
       bindUI();
-    });
+    }
   }
 
   function bindUI() {
@@ -33,6 +64,8 @@ var SupportChat = (function () {
     var feedbackSubmit = document.getElementById('sc-feedback-submit');
     var stars = document.querySelectorAll('.sc-star');
 
+    // Pick up the conversation of this tab after a reload
+    restoreSession();
     // Initialize visibility: show pre-chat if no existing session
     toggleChat(!!state.conv);
 
@@ -72,10 +105,21 @@ var SupportChat = (function () {
         if (!text) return;
         input.value = '';
         input.focus();
+        setTyping(false);
         sendMessage(text);
       });
     }
 
+    if (input) {
+      input.addEventListener('input', function () {
+        setTyping(!!input.value);
+      });
+    }
+
+    document.addEventListener('visibilitychange', function () {
+      sendFrame({type: 'activity', state: document.hidden ? 'idle' : 'active'});
+    });
+
     if (endChatBtn) {
       endChatBtn.addEventListener('click', function () {
         endChat();
@@ -149,19 +193,27 @@ var SupportChat = (function () {
     fetch((config.api_root || '') + '/support_chat/api/create_session/', {
       method: 'POST',
       headers: {'Content-Type': 'application/json'},
-      body: JSON.stringify({name: name, email: email})
-    }).then(function (r) { return r.json(); })
+      body: JSON.stringify({name: name, email: email, browser_token: readBrowserToken()})
+    }).then(function (r) {
+        if (r.status === 429) throw new Error('rate_limited');
+        return r.json();
+      })
       .then(function (data) {
         state.conv = data.conversation_id;
+        state.token = data.token;
+        if (data.browser_token) saveBrowserToken(data.browser_token);
         state.visitor_name = name;
         state.visitor_email = email;
+        saveSession();
         updateHeader();
         toggleChat(true);
         appendSystem('Hi ' + name + '! 👋 How can we help you today?');
         var input = document.getElementById('sc-input');
         if (input) input.focus();
         connectWS();
-      }).catch(function () { alert('Could not create session'); });
+      }).catch(function (e) {
+        alert(e.message === 'rate_limited' ? 'Too many attempts. Please wait a minute and try again.' : 'Could not create session');
+      });
   }
 
   function endChat() {
@@ -208,11 +260,24 @@ var SupportChat = (function () {
   }
 
   function closeChat() {
+    var ws = state.ws;
     state.conv = null;
+    state.token = null;
     state.ws = null;
     state.connected = false;
+    state.lastId = null;
+    state.lastAt = null;
+    state.retries = 0;
+    clearTimeout(state.reconnectTimer);
+    if (ws) ws.close();
+    try {
+      sessionStorage.removeItem(STORAGE_KEY);
+    } catch (e) {}
     state.visitor_name = null;
     state.visitor_email = null;
+    state.typing = false;
+    clearTimeout(state.typingTimer);
+    showTyping(false);
     
     // Clear messages
     var messages = document.getElementById('sc-messages');
@@ -240,57 +305,158 @@ var SupportChat = (function () {
 
   function connectWS() {
     if (!state.conv) return;
-    var url = wsOrigin() + '/ws/support/conversation/' + state.conv + '/';
+    var url = wsOrigin() + '/ws/support/conversation/' + state.conv + '/?token=' + encodeURIComponent(state.token || '');
+    var ws;
     try {
-      state.ws = new WebSocket(url);
+      ws = protocol.open(url);
     } catch (err) {
       console.warn('WebSocket not available', err);
       state.ws = null;
       return;
     }
+    state.ws = ws;
 
-    state.ws.onopen = function () {
+    ws.onopen = function () {
       state.connected = true;
-      appendSystem('Connected to support team');
+      appendSystem(state.retries ? 'Reconnected' : 'Connected to support team');
+      state.retries = 0;
+      // Without a last message (new or reloaded page) the server sends the
+      // latest history, including the visitor's own messages
+      state.replayAll = !state.lastId;
+      sendFrame({type: 'resume', last_id: state.lastId, since: state.lastAt});
+      sendFrame({type: 'activity', state: document.hidden ? 'idle' : 'active'});
     };
-    state.ws.onmessage = function (ev) {
+    ws.onmessage = function (ev) {
       try {
-        var data = JSON.parse(ev.data);
+        var data = protocol.decode(ws, ev.data);
         if (data.type === 'message' && data.payload) {
-          var p = data.payload;
-          if (p.sender_type !== 'visitor') {
-            appendMessage(p.sender_type || 'system', p.message);
-          }
+          showMessage(data.payload, false);
         } else if (data.type === 'message' && data.message) {
-          if (data.message.sender_type !== 'visitor') {
-            appendMessage(data.message.sender_type || 'system', data.message.message);
-          }
+          showMessage(data.message, false);
+        } else if (data.type === 'replay') {
+          data.messages.forEach(function (m) { showMessage(m, state.replayAll); });
         } else if (data.type === 'agent_assigned') {
           appendSystem('Agent ' + (data.agent_name || 'joined'));
+        } else if (data.type === 'typing') {
+          showTyping(data.typing);
+        } else if (data.type === 'agent_presence') {
+          appendSystem((data.agent_name || 'Agent') + (data.online ? ' is back online' : ' went offline'));
+        } else if (data.type === 'rate_limited') {
+          appendSystem(RATE_LIMITED_TEXT);
         }
       } catch (e) {
         console.error('WS message error:', e);
       }
     };
-    state.ws.onclose = function () {
+    ws.onclose = function () {
+      if (state.ws !== ws) return;
       state.connected = false;
-      appendSystem('Connection lost. Please try again.');
       state.ws = null;
+      showTyping(false);
+      if (state.conv) scheduleReconnect();
     };
-    state.ws.onerror = function () { /* ignore */ };
+    ws.onerror = function () { /* ignore */ };
+  }
+
+  function scheduleReconnect() {
+    if (state.retries >= RECONNECT_ATTEMPTS) {
+      appendSystem('Connection lost. Please refresh the page.');
+      return;
+    }
+    if (!state.retries) appendSystem('Connection lost. Reconnecting…');
+    // Full jitter, so visitors dropped together (e.g. by a deploy) do not
+    // all come back at the same moment
+    var ceiling = Math.min(RECONNECT_MAX_MS, RECONNECT_BASE_MS * Math.pow(2, state.retries));
+    state.retries += 1;
+    state.reconnectTimer = setTimeout(connectWS, Math.random() * ceiling);
+  }
+
+  function showMessage(m, includeOwn) {
+    if (!m) return;
+    if (m.id) {
+      state.lastId = m.id;
+      state.lastAt = m.created_at;
+    }
+    // The visitor's own messages were shown when they were typed
+    if (includeOwn || m.sender_type !== 'visitor') {
+      appendMessage(m.sender_type || 'system', m.message);
+    }
+  }
+
+  function saveSession() {
+    try {
+      sessionStorage.setItem(STORAGE_KEY, JSON.stringify({
+        conv: state.conv,
+        token: state.token,
+        visitor_name: state.visitor_name,
+        visitor_email: state.visitor_email
+      }));
+    } catch (e) {}
+  }
+
+  // Lets the server recognise a returning visitor across visits
+  function readBrowserToken() {
+    try {
+      return localStorage.getItem(BROWSER_TOKEN_KEY);
+    } catch (e) {
+      return null;
+    }
+  }
+
+  function saveBrowserToken(token) {
+    try {
+      localStorage.setItem(BROWSER_TOKEN_KEY, token);
+    } catch (e) {}
+  }
+
+  function restoreSession() {
+    var saved = null;
+    try {
+      saved = JSON.parse(sessionStorage.getItem(STORAGE_KEY) || 'null');
+    } catch (e) {}
+    if (!saved || !saved.conv) return;
+    state.conv = saved.conv;
+    state.token = saved.token;
+    state.visitor_name = saved.visitor_name;
+    state.visitor_email = saved.visitor_email;
+    updateHeader();
+    connectWS();
+  }
+
+  function sendFrame(frame) {
+    if (state.connected && state.ws) state.ws.send(protocol.encode(state.ws, frame));
+  }
+
+  // The server throttles these too; only state changes are sent from here
+  function setTyping(typing) {
+    clearTimeout(state.typingTimer);
+    if (typing) {
+      state.typingTimer = setTimeout(function () { setTyping(false); }, TYPING_IDLE_MS);
+    }
+    if (state.typing === typing) return;
+    state.typing = typing;
+    sendFrame({type: 'typing', typing: typing});
+  }
+
+  function showTyping(typing) {
+    var el = document.getElementById('sc-typing');
+    if (!el) return;
+    el.textContent = typing ? 'Agent is typing…' : '';
+    el.style.display = typing ? '' : 'none';
   }
 
   function sendMessage(text) {
     appendMessage('visitor', text);
     
     if (state.connected && state.ws) {
-      var payload = JSON.stringify({type: 'message', sender_type: 'visitor', sender_id: null, message: text});
-      state.ws.send(payload);
+      sendFrame({type: 'message', message: text});
     } else {
       fetch((config.api_root || '') + '/support_chat/api/send_message/', {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({conversation_id: state.conv, sender_type: 'visitor', sender_id: null, message: text})
+        body: JSON.stringify({conversation_id: state.conv, token: state.token, message: text})
+      }).then(function (r) {
+        if (r.status === 429) appendSystem(RATE_LIMITED_TEXT);
       }).catch(function () { appendSystem('Failed to send message'); });
     }
   }
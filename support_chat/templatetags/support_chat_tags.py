@@ -1,5 +1,8 @@
 from django import template
 
+from ..services.assets import widget_urls
+from ..settings import get_setting
+
 register = template.Library()
 
 @register.inclusion_tag('support_chat/widget_include.html')
@@ -12,3 +15,9 @@ def support_chat_widget():
         {% support_chat_widget %}
     """
     return {}
+
+
+@register.simple_tag
+def support_chat_assets():
+    """URLs of the widget loader, scripts and stylesheet, plus the socket origin."""
+    return dict(widget_urls(), socket_url=get_setting('SOCKET_URL'))
@@ -10,6 +10,8 @@ urlpatterns = [
     path('api/leave_conversation/', views.leave_conversation, name='leave_conversation'),
     path('api/submit_feedback/', views.submit_feedback, name='submit_feedback'),
     path('api/accept_conversation/', views.accept_conversation, name='accept_conversation'),
+    path('metrics', views.metrics, name='metrics'),
+    path('assets/<str:filename>', views.widget_asset, name='widget_asset'),
     
     # Agent authentication
     path('agent/login/', agent_views.agent_login, name='agent_login'),
@@ -23,6 +25,9 @@ urlpatterns = [
     path('agent/sidebar/', agent_views.agent_sidebar, name='agent_sidebar'),
     path('api/agent/conversations/', agent_views.agent_conversations_api, name='agent_conversations_api'),
     path('agent/chat/<uuid:conversation_id>/', agent_views.agent_chat, name='agent_chat'),
+    path('api/agent/conversations/<uuid:conversation_id>/messages/', agent_views.agent_messages_api, name='agent_messages_api'),
+    path('api/agent/conversations/<uuid:conversation_id>/history/', agent_views.agent_visitor_history_api, name='agent_visitor_history_api'),
+    path('api/agent/search/', agent_views.agent_search_api, name='agent_search_api'),
     path('api/agent/accept-conversation/', agent_views.agent_accept_conversation, name='agent_accept_conversation'),
     path('api/agent/send-message/', agent_views.agent_send_message, name='agent_send_message'),
     path('api/agent/close-conversation/', agent_views.agent_close_conversation, name='agent_close_conversation'),
@@ -1,18 +1,37 @@
 import json
+import secrets
 import uuid
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.utils import timezone
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.shortcuts import get_object_or_404
+from asgiref.sync import sync_to_async
 
 from . import models
-from .services.assignment import assign_conversation
+from .metrics import CONTENT_TYPE, MESSAGES, registry
+from .settings import get_setting
+from .services.assets import get_asset
+from .services.assignment import (
+    aassign_conversation, aclose_conversation, anotify_assignment, auto_assign, reserve_agent_capacity,
+)
+from .services.fanout import apublish_message
+from .services.groups import get_group_strategy
+from .services.messages import acreate_message, serialize_message
+from .services.queue import apublish_queue_event
+from .services.search import index_conversation
+from .services.auth import get_conversation_from_visitor_token, make_browser_token, make_visitor_token
+from .services.visitors import remember_conversation, resolve_visitor
+from .decorators import rate_limit
+
+
+async def aget_object_or_404(model, **kwargs):
+    try:
+        return await model.objects.aget(**kwargs)
+    except model.DoesNotExist:
+        raise Http404(f'No {model._meta.object_name} matches the given query.')
 
 
 @csrf_exempt
-def create_session(request):
+@rate_limit('create_session', keys=('ip', 'email'))
+async def create_session(request):
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required'}, status=405)
     data = json.loads(request.body.decode('utf-8'))
@@ -21,64 +40,89 @@ def create_session(request):
     mobile = data.get('mobile')
     ip = request.META.get('REMOTE_ADDR')
     ua = request.META.get('HTTP_USER_AGENT', '')
-    visitor = models.Visitor.objects.create(name=name, email=email, mobile=mobile, ip_address=ip, user_agent=ua)
-    conv = models.Conversation.objects.create(visitor=visitor, status=models.Conversation.STATUS_WAITING)
-
-    # Broadcast to support queue
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)('support_queue', {
-        'type': 'new_conversation',
+    # Returning visitors (browser token, then email) keep their Visitor row
+    visitor, previous_id = await sync_to_async(resolve_visitor)(
+        name, email, mobile, ip, ua, data.get('browser_token')
+    )
+    conv = models.Conversation(
+        visitor=visitor, previous_conversation_id=previous_id, status=models.Conversation.STATUS_WAITING
+    )
+    conv.queue_shard = get_group_strategy().conversation_shard(conv, request)
+    await conv.asave(force_insert=True)
+    await sync_to_async(remember_conversation)(visitor, conv.id)
+    index_conversation(conv, visitor)
+
+    # Route straight to an agent when auto-assignment is on, otherwise
+    # broadcast to support queue
+    if await sync_to_async(auto_assign)(conv) is None:
+        await apublish_queue_event({
+            'type': 'new_conversation',
+            'conversation_id': str(conv.id),
+            'visitor_name': visitor.name,
+            'visitor_email': visitor.email,
+        }, conv.queue_shard)
+
+    # The signed token authorizes the visitor's conversation socket; the
+    # browser token lets the widget be recognised next time
+    return JsonResponse({
         'conversation_id': str(conv.id),
-        'visitor_name': visitor.name,
-        'visitor_email': visitor.email,
+        'token': make_visitor_token(conv.id),
+        'browser_token': make_browser_token(visitor.id),
     })
 
-    return JsonResponse({'conversation_id': str(conv.id)})
+
+def _visitor_conversation_id(data):
+    # Visitor endpoints act on the conversation their signed token names
+    token_id = get_conversation_from_visitor_token(data.get('token') or '')
+    try:
+        requested_id = str(uuid.UUID(str(data.get('conversation_id'))))
+    except ValueError:
+        return None
+    return requested_id if token_id == requested_id else None
 
 
 @csrf_exempt
-def send_message(request):
+@rate_limit('message', keys=('ip', 'conversation'))
+async def send_message(request):
+    """Post a visitor message over HTTP, e.g. while the socket reconnects.
+
+    Needs the visitor ``token`` from create_session; the sender is always
+    the visitor.
+    """
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required'}, status=405)
     data = json.loads(request.body.decode('utf-8'))
-    conv_id = data.get('conversation_id')
-    sender_type = data.get('sender_type')
-    sender_id = data.get('sender_id')
+    conv_id = _visitor_conversation_id(data)
+    if conv_id is None:
+        return JsonResponse({'error': 'Not authorized'}, status=403)
     message = data.get('message')
-    conv = get_object_or_404(models.Conversation, id=conv_id)
-    m = models.Message.objects.create(conversation=conv, sender_type=sender_type, sender_id=sender_id, message=message)
+    if not isinstance(message, str) or not message.strip():
+        return JsonResponse({'error': 'Message required'}, status=400)
+    conv = await aget_object_or_404(models.Conversation, id=conv_id)
+    m = await acreate_message(conv.id, models.Message.SENDER_VISITOR, None, message)
+    MESSAGES.inc(sender_type=m.sender_type, transport='http')
 
     # Broadcast to conversation group
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(f'visitor_{conv_id}', {
-        'type': 'chat.message',
-        'message': {
-            'id': str(m.id),
-            'conversation': str(conv.id),
-            'sender_type': m.sender_type,
-            'sender_id': str(m.sender_id) if m.sender_id else None,
-            'message': m.message,
-            'created_at': m.created_at.isoformat(),
-        }
-    })
+    await apublish_message(conv.id, serialize_message(m))
     return JsonResponse({'ok': True})
 
 
 @csrf_exempt
-def leave_conversation(request):
+async def leave_conversation(request):
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required'}, status=405)
     data = json.loads(request.body.decode('utf-8'))
-    conv_id = data.get('conversation_id')
-    conv = get_object_or_404(models.Conversation, id=conv_id)
-    conv.status = models.Conversation.STATUS_CLOSED
-    conv.ended_at = timezone.now()
-    conv.save()
+    conv_id = _visitor_conversation_id(data)
+    if conv_id is None:
+        return JsonResponse({'error': 'Not authorized'}, status=403)
+    conv = await aget_object_or_404(models.Conversation, id=conv_id)
+    await aclose_conversation(conv)
     return JsonResponse({'ok': True})
 
 
 @csrf_exempt
-def submit_feedback(request):
+@rate_limit('feedback')
+async def submit_feedback(request):
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required'}, status=405)
     data = json.loads(request.body.decode('utf-8'))
@@ -86,8 +130,8 @@ def submit_feedback(request):
     agent_rating = data.get('agent_rating', 5)
     system_rating = data.get('system_rating', 5)
     comment = data.get('comment', '')
-    conv = get_object_or_404(models.Conversation, id=conv_id)
-    models.ConversationRating.objects.update_or_create(
+    conv = await aget_object_or_404(models.Conversation, id=conv_id)
+    await models.ConversationRating.objects.aupdate_or_create(
         conversation=conv,
         defaults={'agent_rating': agent_rating, 'system_rating': system_rating, 'comment': comment},
     )
@@ -95,36 +139,59 @@ def submit_feedback(request):
 
 
 @csrf_exempt
-def accept_conversation(request):
+async def accept_conversation(request):
     # Simple agent acceptance endpoint — expects agent_id and conversation_id
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required'}, status=405)
     data = json.loads(request.body.decode('utf-8'))
     conv_id = data.get('conversation_id')
     agent_id = data.get('agent_id')
-    agent = get_object_or_404(models.SupportAgent, id=agent_id)
+    agent = await aget_object_or_404(models.SupportAgent, id=agent_id)
     conv_qs = models.Conversation.objects.filter(id=conv_id, status=models.Conversation.STATUS_WAITING)
-    ok = assign_conversation(conv_qs, agent)
+    shard, started_at = await conv_qs.values_list('queue_shard', 'started_at').afirst() or ('', None)
+    ok = await aassign_conversation(conv_qs, agent, started_at)
     if not ok:
         return JsonResponse({'ok': False, 'reason': 'already_assigned_or_closed'})
+    await sync_to_async(reserve_agent_capacity)(agent.id)
 
-    # Notify agent group and visitor group
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(f'agent_{agent_id}', {
-        'type': 'agent_assigned',
-        'conversation_id': conv_id,
-        'agent_name': agent.name,
-    })
-    async_to_sync(channel_layer.group_send)(f'visitor_{conv_id}', {
-        'type': 'chat.message',
-        'message': {
-            'id': str(uuid.uuid4()),
-            'conversation': conv_id,
-            'sender_type': 'system',
-            'sender_id': None,
-            'message': f'Agent {agent.name} has joined the chat.',
-            'created_at': timezone.now().isoformat(),
-        }
-    })
+    # Remove it from every agent's queue, then notify agent group and visitor group
+    await anotify_assignment(conv_id, agent, shard=shard)
 
     return JsonResponse({'ok': True})
+
+
+def metrics(request):
+    """Expose this process's metrics in the Prometheus text format.
+
+    Off unless METRICS_ENABLED and METRICS_TOKEN are both set, so anonymous
+    clients can neither read the metrics nor trigger the queue depth query.
+    """
+    token = get_setting('METRICS_TOKEN')
+    if not get_setting('METRICS_ENABLED') or not token:
+        raise Http404
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(registry.expose(), content_type=CONTENT_TYPE)
+
+
+def widget_asset(request, filename):
+    """Serve a built widget asset, precompressed and cacheable for good.
+
+    File names carry a content hash, so a changed asset is a new URL and
+    clients never need to revalidate.
+    """
+    asset = get_asset(filename)
+    if asset is None:
+        raise Http404
+    etag = f'"{asset.digest}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        body, encoding = asset.pick(request.headers.get('Accept-Encoding', ''))
+        response = HttpResponse(body, content_type=asset.content_type)
+        if encoding:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = f"public, max-age={get_setting('WIDGET_ASSET_MAX_AGE')}, immutable"
+    return response